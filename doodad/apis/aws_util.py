@@ -1,29 +1,162 @@
-import subprocess
+"""
+S3 helpers built on a shared boto3 client.
 
-def s3_exists(bucket, path, region=None):
-    cmd = 'aws s3 ls s3://%s/%s' % (bucket, path)
-    if region is not None:
-        cmd += ' --region %s'%region
+Clients are created once per region, endpoint and set of credentials
+(see client_registry), and reused by every call, so their connection
+pools are shared between uploads. Large files are uploaded in concurrent multipart chunks as
+configured by a boto3 TransferConfig.
+
+Pass endpoint_url to talk to an S3-compatible stand-in (e.g. a local
+minio or moto server) instead of AWS.
+"""
+from doodad.utils import safe_import, retry
+from doodad.apis import client_registry
+
+boto3 = safe_import.try_import('boto3')
+boto3.s3 = safe_import.try_import('boto3.s3')
+boto3.s3.transfer = safe_import.try_import('boto3.s3.transfer')
+botocore = safe_import.try_import('botocore')
+botocore.config = safe_import.try_import('botocore.config')
+botocore.exceptions = safe_import.try_import('botocore.exceptions')
+
+MB = 1024 * 1024
+DEFAULT_MULTIPART_THRESHOLD = 8 * MB
+DEFAULT_MULTIPART_CHUNKSIZE = 8 * MB
+DEFAULT_MAX_CONCURRENCY = 10
+MAX_POOL_CONNECTIONS = 50
+THROTTLING_ERROR_CODES = ('RequestLimitExceeded', 'Throttling', 'ThrottlingException', 'SlowDown')
+
+
+def s3_client(region=None, credentials=None, endpoint_url=None):
+    """
+    A boto3 S3 client shared by every caller with the same arguments.
+
+    Args:
+        region (str): AWS region, or None for the default
+        credentials (AWSCredentials): Credentials, or None to use
+            boto3's default credential chain
+        endpoint_url (str): Endpoint of an S3-compatible service
+
+    Returns:
+        A boto3 S3 client
+    """
+    key_pair = _key_pair(credentials)
+    return client_registry.get_client(
+        ('aws', 's3', endpoint_url), key_pair, region,
+        lambda: boto3.client(
+            's3',
+            region_name=region,
+            endpoint_url=endpoint_url,
+            aws_access_key_id=key_pair[0],
+            aws_secret_access_key=key_pair[1],
+            config=botocore.config.Config(max_pool_connections=MAX_POOL_CONNECTIONS),
+        ))
+
+
+def ec2_client(region, credentials=None):
+    """
+    A boto3 EC2 client shared by every caller with the same arguments.
+
+    Args:
+        region (str): AWS region
+        credentials (AWSCredentials): Credentials, or None to use
+            boto3's default credential chain
+
+    Returns:
+        A boto3 EC2 client
+    """
+    key_pair = _key_pair(credentials)
+    return client_registry.get_client(
+        ('aws', 'ec2'), key_pair, region,
+        lambda: boto3.client(
+            'ec2',
+            region_name=region,
+            aws_access_key_id=key_pair[0],
+            aws_secret_access_key=key_pair[1],
+        ))
+
+
+def retry_throttled(fn, timeout=300):
+    """
+    Call fn, retrying with exponential backoff for as long as AWS
+    throttles the request. Other errors are raised immediately.
+    """
+    return retry.retry(
+        fn,
+        exceptions=(botocore.exceptions.ClientError,),
+        retry_if=lambda e: e.response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES,
+        timeout=timeout,
+    )
+
+
+def _key_pair(credentials):
+    if credentials is None:
+        return None, None
+    return credentials.aws_key, credentials.aws_secret_key
+
+
+def transfer_config(multipart_threshold=DEFAULT_MULTIPART_THRESHOLD,
+                    multipart_chunksize=DEFAULT_MULTIPART_CHUNKSIZE,
+                    max_concurrency=DEFAULT_MAX_CONCURRENCY):
+    """
+    Args:
+        multipart_threshold (int): Files at least this many bytes large are
+            uploaded in parts
+        multipart_chunksize (int): Size of each part in bytes
+        max_concurrency (int): Number of parts to upload concurrently.
+            Keep this below MAX_POOL_CONNECTIONS.
+
+    Returns:
+        boto3.s3.transfer.TransferConfig
+    """
+    return boto3.s3.transfer.TransferConfig(
+        multipart_threshold=multipart_threshold,
+        multipart_chunksize=multipart_chunksize,
+        max_concurrency=max_concurrency,
+        use_threads=max_concurrency > 1,
+    )
+
+
+def s3_exists(bucket, path, region=None, credentials=None, endpoint_url=None):
+    """
+    Returns:
+        bool: True if any object's key in bucket starts with path,
+            as `aws s3 ls s3://bucket/path` would list it.
+    """
+    client = s3_client(region=region, credentials=credentials, endpoint_url=endpoint_url)
     try:
-        result = subprocess.check_output(cmd, shell=True)
-    except subprocess.CalledProcessError:
+        response = client.list_objects_v2(Bucket=bucket, Prefix=path, MaxKeys=1)
+    except botocore.exceptions.ClientError:
         return False
+    return response.get('KeyCount', 0) > 0
 
-    if result:
-        return True
-    else:
-        return False
 
+def s3_upload(local_file_name, s3_bucket, s3_path, dry=False, region=None,
+              credentials=None, endpoint_url=None, config=None):
+    """
+    Upload a file to S3.
 
-def s3_upload(local_file_name, s3_bucket, s3_path, dry=False, region=None):
+    Args:
+        local_file_name (str): File to upload
+        s3_bucket (str): Bucket name
+        s3_path (str): Key to upload the file to
+        dry (bool): If True, print the upload rather than doing it
+        region (str): AWS region, or None for the default
+        credentials (AWSCredentials): Credentials, or None to use
+            boto3's default credential chain
+        endpoint_url (str): Endpoint of an S3-compatible service
+        config (TransferConfig): Multipart upload settings.
+            Defaults to transfer_config().
+
+    Returns:
+        str: The s3:// path of the uploaded file
+    """
     remote_path = "s3://%s/%s" % (s3_bucket, s3_path)
-    if region is None:
-        upload_cmd = ["aws", "s3", "cp", local_file_name, remote_path]
-    else:
-        upload_cmd = ["aws", "s3", "cp", '--region', region, local_file_name, remote_path]
-    if not dry:
-        subprocess.check_call(upload_cmd)
-    else:
-        print(' '.join(upload_cmd))
+    if dry:
+        print('upload: %s to %s' % (local_file_name, remote_path))
+        return remote_path
+    if config is None:
+        config = transfer_config()
+    client = s3_client(region=region, credentials=credentials, endpoint_url=endpoint_url)
+    client.upload_file(local_file_name, s3_bucket, s3_path, Config=config)
     return remote_path
-
@@ -1,14 +1,183 @@
 import os
+import threading
 
 from doodad.utils import REPO_DIR, safe_import
+from doodad.apis import client_registry
 
 blob = safe_import.try_import('azure.storage.blob')
 azure = safe_import.try_import('azure')
+azure_exceptions = safe_import.try_import('msrestazure.azure_exceptions')
 
 AZURE_STARTUP_SCRIPT_PATH = os.path.join(REPO_DIR, "scripts/azure/azure_startup_script.sh")
 AZURE_SHUTDOWN_SCRIPT_PATH = os.path.join(REPO_DIR, "scripts/azure/azure_shutdown_script.sh")
 AZURE_CLOUD_INIT_PATH = os.path.join(REPO_DIR, "scripts/azure/cloud-init.txt")
 
+SHARED_VNET_NAME = 'doodadVNet'
+SHARED_SUBNET_NAME = 'doodadSubnet'
+# large enough for a few thousand concurrent VMs
+SHARED_ADDRESS_PREFIX = '10.0.0.0/16'
+
+# returned while a new VM's managed identity replicates through Azure AD
+PRINCIPAL_NOT_FOUND_ERROR_CODES = ('PrincipalNotFound',)
+
+# (subscription id, resource group, region) -> subnet
+_shared_subnets = {}
+_shared_network_lock = threading.Lock()
+
+
+def is_principal_not_found(e):
+    """
+    Whether a CloudError only means that a principal (e.g. a new VM's
+    managed identity) has not replicated yet, so the request should be
+    retried.
+    """
+    return getattr(e.error, 'error', None) in PRINCIPAL_NOT_FOUND_ERROR_CODES
+
+
+def service_principal_credentials(client_id, secret, tenant):
+    """ ServicePrincipalCredentials, authenticated once per process """
+    from azure.common.credentials import ServicePrincipalCredentials
+    return client_registry.get_client(
+        ('azure', 'credentials'), (client_id, secret, tenant), None,
+        lambda: ServicePrincipalCredentials(client_id=client_id, secret=secret, tenant=tenant))
+
+
+def management_client(client_cls, client_id, secret, tenant, subscription_id):
+    """
+    A management client (e.g. ComputeManagementClient) shared by every
+    caller with the same credentials and subscription.
+    """
+    return client_registry.get_client(
+        ('azure', client_cls.__name__), (client_id, secret, tenant, subscription_id), None,
+        lambda: client_cls(service_principal_credentials(client_id, secret, tenant), subscription_id))
+
+
+def blob_service_client(connection_str):
+    """ A BlobServiceClient shared by every caller with the same connection string """
+    return client_registry.get_client(
+        ('azure', 'blob'), connection_str, None,
+        lambda: blob.BlobServiceClient.from_connection_string(connection_str))
+
+
+def shared_network_resource_group(base_name, region):
+    return '{}-network-{}'.format(base_name, region)
+
+
+def shared_subnet(resource_group_client, network_client, subscription_id, resource_group, region,
+                  tags=None):
+    """
+    Get the subnet of a long-lived vnet shared by every VM launched in a
+    region, creating the resource group and vnet the first time.
+
+    The subnet is looked up once per process.
+
+    Args:
+        resource_group (str): Resource group which holds the shared vnet
+        region (str): Azure region
+        tags (dict): Tags for a newly created resource group
+
+    Returns:
+        The Subnet
+    """
+    key = (subscription_id, resource_group, region)
+    with _shared_network_lock:
+        if key in _shared_subnets:
+            return _shared_subnets[key]
+        try:
+            subnet = network_client.subnets.get(resource_group, SHARED_VNET_NAME, SHARED_SUBNET_NAME)
+        except azure_exceptions.CloudError:
+            resource_group_client.resource_groups.create_or_update(
+                resource_group,
+                {'location': region, 'tags': tags or {}}
+            )
+            vnet = network_client.virtual_networks.create_or_update(
+                resource_group,
+                SHARED_VNET_NAME,
+                {
+                    'location': region,
+                    'address_space': {
+                        'address_prefixes': [SHARED_ADDRESS_PREFIX]
+                    },
+                    'subnets': [{
+                        'name': SHARED_SUBNET_NAME,
+                        'address_prefix': SHARED_ADDRESS_PREFIX
+                    }]
+                }
+            ).result()
+            subnet = vnet.subnets[0]
+        _shared_subnets[key] = subnet
+        return subnet
+
+
+class RegionRanking(object):
+    """
+    Remembers which regions recently had capacity for each instance type,
+    so later launches try those first.
+    """
+    def __init__(self):
+        self._succeeded = {}
+        self._failed = {}
+        self._lock = threading.Lock()
+
+    def order(self, instance_type, regions):
+        """
+        Reorder regions: the most recently successful first, then those
+        not tried yet (in the given order), then those which failed, the
+        most recently failed last.
+        """
+        with self._lock:
+            succeeded = [region for region in self._succeeded.get(instance_type, []) if region in regions]
+            failed = [region for region in self._failed.get(instance_type, []) if region in regions]
+        untried = [region for region in regions if region not in succeeded and region not in failed]
+        return succeeded + untried + [region for region in failed if region not in succeeded]
+
+    def record(self, instance_type, region, success):
+        with self._lock:
+            for ranking in (self._succeeded, self._failed):
+                regions = ranking.setdefault(instance_type, [])
+                if region in regions:
+                    regions.remove(region)
+            if success:
+                self._succeeded[instance_type].insert(0, region)
+            else:
+                self._failed[instance_type].append(region)
+
+    def clear(self):
+        with self._lock:
+            self._succeeded.clear()
+            self._failed.clear()
+
+
+region_ranking = RegionRanking()
+
+# (subscription id, instance type) -> regions where it is restricted
+_unavailable_regions = {}
+_unavailable_regions_lock = threading.Lock()
+
+
+def unavailable_regions(compute_client, subscription_id, instance_type):
+    """
+    Regions where instance_type is not offered to the subscription,
+    according to the resource SKUs API. Looked up once per process.
+
+    Returns:
+        set: Region names
+    """
+    key = (subscription_id, instance_type)
+    with _unavailable_regions_lock:
+        if key in _unavailable_regions:
+            return _unavailable_regions[key]
+    regions = set()
+    for sku in compute_client.resource_skus.list():
+        if sku.resource_type != 'virtualMachines' or sku.name != instance_type:
+            continue
+        for restriction in sku.restrictions or []:
+            if restriction.type == 'Location':
+                regions.update(location.lower() for location in restriction.restriction_info.locations)
+    with _unavailable_regions_lock:
+        _unavailable_regions[key] = regions
+    return regions
+
 
 def upload_file_to_azure_storage(
     filename,
@@ -24,8 +193,7 @@ def upload_file_to_azure_storage(
     remote_path = 'doodad/mount/' + remote_filename
 
     if not dry:
-        blob_service_client = blob.BlobServiceClient.from_connection_string(connection_str)
-        blob_client = blob_service_client.get_blob_client(container=container_name, blob=remote_path)
+        blob_client = blob_service_client(connection_str).get_blob_client(container=container_name, blob=remote_path)
         if check_exists:
             try:
                 blob_client.get_blob_properties()
@@ -0,0 +1,71 @@
+"""
+A process-wide registry of authenticated cloud SDK clients.
+
+Creating a client usually means authenticating (and sometimes a network
+round-trip), so clients are created once per provider, service,
+credentials and region and shared by every launch for the lifetime of
+the process.
+
+Example usage:
+
+client = client_registry.get_client(
+    ('aws', 'ec2'), credentials_key, region,
+    lambda: boto3.client('ec2', region_name=region))
+"""
+import threading
+
+_clients = {}
+_lock = threading.Lock()
+# key -> lock held while the client for key is being created
+_creating = {}
+
+
+def get_client(service, credentials_key, region, factory, per_thread=False):
+    """
+    Return the client registered under (service, credentials_key, region),
+    calling factory() to create it the first time.
+
+    Concurrent calls for the same key wait for a single client to be created.
+
+    Args:
+        service (tuple): Identifies the provider and client type,
+            e.g. ('aws', 'ec2')
+        credentials_key (tuple): Hashable identity of the credentials the
+            client is authenticated with
+        region (str): Region or zone the client is bound to, or None
+        factory (callable): Creates the client
+        per_thread (bool): If True, each thread gets its own client. Use
+            this for clients which are not thread-safe.
+
+    Returns:
+        The client
+    """
+    key = (service, credentials_key, region)
+    if per_thread:
+        key += (threading.current_thread().ident,)
+    with _lock:
+        if key in _clients:
+            return _clients[key]
+        create_lock = _creating.setdefault(key, threading.Lock())
+    with create_lock:
+        with _lock:
+            if key in _clients:
+                return _clients[key]
+        client = factory()
+        with _lock:
+            _clients[key] = client
+            _creating.pop(key, None)
+    return client
+
+
+def clear(service=None):
+    """
+    Forget registered clients, e.g. after credentials were rotated.
+
+    Args:
+        service (tuple): If given, only forget clients of this service
+    """
+    with _lock:
+        for key in list(_clients):
+            if service is None or key[0] == service:
+                del _clients[key]
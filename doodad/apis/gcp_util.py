@@ -2,7 +2,10 @@ import os
 import time
 
 from doodad.utils import hash_file, REPO_DIR, safe_import
+from doodad.apis import client_registry
 storage = safe_import.try_import('google.cloud.storage')
+googleapiclient = safe_import.try_import('googleapiclient')
+googleapiclient.discovery = safe_import.try_import('googleapiclient.discovery')
 
 GCP_STARTUP_SCRIPT_PATH = os.path.join(REPO_DIR, "scripts/gcp/gcp_startup_script.sh")
 GCP_SHUTDOWN_SCRIPT_PATH = os.path.join(REPO_DIR, "scripts/gcp/gcp_shutdown_script.sh")
@@ -10,6 +13,24 @@ GCP_SHUTDOWN_SCRIPT_PATH = os.path.join(REPO_DIR, "scripts/gcp/gcp_shutdown_scri
 def make_timekey():
         return '%d'%(int(time.time()*1000))
 
+def storage_client():
+    """ A google.cloud.storage Client shared by the whole process """
+    return client_registry.get_client(('gcp', 'storage'), None, None, storage.Client)
+
+def storage_bucket(bucket_name):
+    """ A storage Bucket, looked up once per process """
+    return client_registry.get_client(('gcp', 'bucket', bucket_name), None, None,
+                                      lambda: storage_client().get_bucket(bucket_name))
+
+def compute_client():
+    """
+    A compute API client. googleapiclient clients are not thread-safe,
+    so each thread gets its own.
+    """
+    return client_registry.get_client(('gcp', 'compute'), None, None,
+                                      lambda: googleapiclient.discovery.build('compute', 'v1'),
+                                      per_thread=True)
+
 def upload_file_to_gcp_storage(
     bucket_name,
     file_name,
@@ -21,10 +42,9 @@ def upload_file_to_gcp_storage(
         remote_filename = os.path.basename(file_name)
     remote_path = 'doodad/mount/' + remote_filename
     if not dry:
-        storage_client = storage.Client()
-        bucket = storage_client.get_bucket(bucket_name)
+        bucket = storage_bucket(bucket_name)
         blob = bucket.blob(remote_path)
-        if check_exists and blob.exists(storage_client):
+        if check_exists and blob.exists(storage_client()):
             print("{remote_path} already exists".format(remote_path=remote_path))
             return remote_path
         blob.upload_from_filename(file_name)
@@ -0,0 +1,56 @@
+import unittest
+import os
+import os.path as path
+import shutil
+import tempfile
+
+from botocore.stub import Stubber
+
+from doodad.apis import aws_util
+from doodad.credentials import ec2
+
+
+class TestS3(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.credentials = ec2.AWSCredentials(aws_key='123', aws_secret='abc')
+        self.client = aws_util.s3_client(region='us-west-1', credentials=self.credentials)
+        self.stubber = Stubber(self.client)
+        self.stubber.activate()
+
+    def tearDown(self):
+        self.stubber.deactivate()
+        shutil.rmtree(self.work_dir)
+
+    def test_shared_client(self):
+        self.assertIs(aws_util.s3_client(region='us-west-1', credentials=self.credentials), self.client)
+        self.assertIsNot(aws_util.s3_client(region='us-east-1', credentials=self.credentials), self.client)
+
+    def test_exists(self):
+        params = {'Bucket': 'bucket', 'Prefix': 'doodad/a.dar', 'MaxKeys': 1}
+        self.stubber.add_response('list_objects_v2', {'KeyCount': 1}, params)
+        self.stubber.add_response('list_objects_v2', {'KeyCount': 0}, params)
+        self.stubber.add_client_error('list_objects_v2', 'NoSuchBucket', expected_params=params)
+        for expected in [True, False, False]:
+            self.assertEqual(aws_util.s3_exists('bucket', 'doodad/a.dar', region='us-west-1',
+                                                credentials=self.credentials), expected)
+        self.stubber.assert_no_pending_responses()
+
+    def test_upload(self):
+        filename = path.join(self.work_dir, 'a.dar')
+        with open(filename, 'wb') as f:
+            f.write(b'abc')
+        self.stubber.add_response('put_object', {})
+        remote_path = aws_util.s3_upload(filename, 'bucket', 'doodad/a.dar', region='us-west-1',
+                                         credentials=self.credentials,
+                                         config=aws_util.transfer_config(max_concurrency=1))
+        self.assertEqual(remote_path, 's3://bucket/doodad/a.dar')
+        self.stubber.assert_no_pending_responses()
+
+    def test_dry(self):
+        remote_path = aws_util.s3_upload('a.dar', 'bucket', 'doodad/a.dar', dry=True)
+        self.assertEqual(remote_path, 's3://bucket/doodad/a.dar')
+
+
+if __name__ == '__main__':
+    unittest.main()
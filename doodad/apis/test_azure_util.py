@@ -0,0 +1,40 @@
+import unittest
+import json
+
+import requests
+from msrestazure.azure_exceptions import CloudError
+
+from doodad.apis import azure_util
+from doodad.utils import retry
+
+
+def cloud_error(code):
+    response = requests.Response()
+    response.status_code = 400
+    response.headers['content-type'] = 'application/json'
+    response._content = json.dumps({'error': {'code': code, 'message': code + ' error'}}).encode('utf-8')
+    return CloudError(response)
+
+
+class TestPrincipalNotFound(unittest.TestCase):
+    def test_error_codes(self):
+        self.assertTrue(azure_util.is_principal_not_found(cloud_error('PrincipalNotFound')))
+        self.assertFalse(azure_util.is_principal_not_found(cloud_error('AuthorizationFailed')))
+
+    def test_retry(self):
+        errors = [cloud_error('PrincipalNotFound'), cloud_error('PrincipalNotFound'),
+                  cloud_error('AuthorizationFailed')]
+        calls = []
+        def create():
+            calls.append(None)
+            raise errors[len(calls) - 1]
+        # permanent errors are raised without waiting for the timeout
+        with self.assertRaises(CloudError) as cm:
+            retry.retry(create, exceptions=(CloudError,), retry_if=azure_util.is_principal_not_found,
+                        timeout=600, sleep=lambda delay: None)
+        self.assertIs(cm.exception, errors[2])
+        self.assertEqual(len(calls), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
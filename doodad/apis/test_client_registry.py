@@ -0,0 +1,55 @@
+import unittest
+import threading
+from concurrent import futures
+
+from doodad.apis import client_registry
+
+
+class TestClientRegistry(unittest.TestCase):
+    def setUp(self):
+        client_registry.clear()
+        self.created = []
+
+    def _factory(self, name):
+        def factory():
+            self.created.append(name)
+            return object()
+        return factory
+
+    def test_memoized(self):
+        a = client_registry.get_client(('test', 'a'), ('key', 'secret'), 'us-west-1', self._factory('a'))
+        self.assertIs(client_registry.get_client(('test', 'a'), ('key', 'secret'), 'us-west-1',
+                                                 self._factory('a')), a)
+        client_registry.get_client(('test', 'a'), ('key', 'secret'), 'us-east-1', self._factory('a'))
+        client_registry.get_client(('test', 'a'), ('key', 'other'), 'us-west-1', self._factory('a'))
+        client_registry.get_client(('test', 'b'), ('key', 'secret'), 'us-west-1', self._factory('b'))
+        self.assertEqual(self.created, ['a', 'a', 'a', 'b'])
+
+        client_registry.clear(('test', 'a'))
+        client_registry.get_client(('test', 'a'), ('key', 'secret'), 'us-west-1', self._factory('a'))
+        client_registry.get_client(('test', 'b'), ('key', 'secret'), 'us-west-1', self._factory('b'))
+        self.assertEqual(self.created, ['a', 'a', 'a', 'b', 'a'])
+
+    def test_concurrent(self):
+        with futures.ThreadPoolExecutor(8) as executor:
+            clients = list(executor.map(
+                lambda _: client_registry.get_client(('test', 'a'), None, None, self._factory('a')),
+                range(32)))
+        self.assertEqual(len(set(map(id, clients))), 1)
+        self.assertEqual(self.created, ['a'])
+
+    def test_per_thread(self):
+        client = client_registry.get_client(('test', 'a'), None, None, self._factory('a'), per_thread=True)
+        self.assertIs(client_registry.get_client(('test', 'a'), None, None, self._factory('a'),
+                                                 per_thread=True), client)
+        other = []
+        thread = threading.Thread(target=lambda: other.append(client_registry.get_client(
+            ('test', 'a'), None, None, self._factory('a'), per_thread=True)))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], client)
+        self.assertEqual(self.created, ['a', 'a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
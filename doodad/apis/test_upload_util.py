@@ -0,0 +1,63 @@
+import unittest
+import os
+import os.path as path
+import shutil
+import tempfile
+from concurrent import futures
+
+from doodad.apis import upload_util
+
+
+class TestUploadOnce(unittest.TestCase):
+    def setUp(self):
+        upload_util.clear()
+        self.work_dir = tempfile.mkdtemp()
+        self.uploads = []
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def _write(self, fname, contents):
+        filename = path.join(self.work_dir, fname)
+        with open(filename, 'w') as f:
+            f.write(contents)
+        return filename
+
+    def _upload(self, remote_filename):
+        self.uploads.append(remote_filename)
+        return 'bucket/' + remote_filename
+
+    def test_content_addressed(self):
+        a = self._write('a.dar', 'apple')
+        b = self._write('b.dar', 'apple')
+        self.assertEqual(upload_util.remote_filename(a), '1f3870be274f6c49b3e31a0c6728957f.dar')
+        self.assertEqual(upload_util.remote_filename(a), upload_util.remote_filename(b))
+
+    def test_upload_once(self):
+        a = self._write('a.dar', 'apple')
+        b = self._write('b.dar', 'apple')
+        for filename in [a, a, b]:
+            remote_path = upload_util.upload_once(('s3', 'bucket'), filename, self._upload)
+            self.assertEqual(remote_path, 'bucket/1f3870be274f6c49b3e31a0c6728957f.dar')
+        self.assertEqual(len(self.uploads), 1)
+        # a different destination, or different contents
+        upload_util.upload_once(('s3', 'other'), a, self._upload)
+        upload_util.upload_once(('s3', 'bucket'), self._write('c.dar', 'banana'), self._upload)
+        self.assertEqual(len(self.uploads), 3)
+
+    def test_concurrent(self):
+        a = self._write('a.dar', 'apple')
+        with futures.ThreadPoolExecutor(8) as executor:
+            paths = list(executor.map(
+                lambda _: upload_util.upload_once(('s3', 'bucket'), a, self._upload), range(32)))
+        self.assertEqual(len(set(paths)), 1)
+        self.assertEqual(len(self.uploads), 1)
+
+    def test_dry(self):
+        upload_util.upload_once(('s3', 'bucket'), path.join(self.work_dir, 'missing.dar'),
+                                self._upload, dry=True)
+        self.assertEqual(self.uploads, ['missing.dar'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+"""
+Upload archives to cloud storage once per process.
+
+Archives are stored under a name derived from their contents, so an
+archive which is launched many times (e.g. every job of a sweep) is
+uploaded by the first launch only. Later launches reuse the remote copy
+without any further requests to the storage service.
+"""
+import os
+import threading
+
+from doodad.utils import hash_file
+
+_lock = threading.Lock()
+# (realpath, size, mtime_ns) -> md5 of the file
+_digests = {}
+# (destination, remote filename) -> remote path
+_uploaded = {}
+# (destination, remote filename) -> lock held while uploading
+_uploading = {}
+
+
+def file_digest(filename):
+    """
+    md5 of a file's contents, computed once for as long as its size and
+    modification time do not change.
+    """
+    stat = os.stat(filename)
+    key = (os.path.realpath(filename), stat.st_size, stat.st_mtime_ns)
+    with _lock:
+        digest = _digests.get(key)
+    if digest is None:
+        digest = hash_file(filename)
+        with _lock:
+            _digests[key] = digest
+    return digest
+
+
+def remote_filename(filename):
+    """
+    A content-addressed name for filename, keeping its extension.
+    i.e. 'runfile.dar' -> '3858f62230ac3c915f300c664312c63f.dar'
+    """
+    return file_digest(filename) + os.path.splitext(filename)[1]
+
+
+def upload_once(destination, filename, upload_fn, dry=False):
+    """
+    Upload filename under its content-addressed name, unless a file with
+    the same contents was already uploaded to destination by this process.
+
+    Concurrent calls for the same file wait for a single upload.
+
+    Args:
+        destination (tuple): Identifies where files are uploaded to,
+            e.g. ('s3', bucket_name)
+        filename (str): Local file to upload
+        upload_fn (callable): Called with the remote filename to upload
+            the file, returning its remote path
+        dry (bool): If True, upload_fn is called with the file's own
+            basename and the upload is not recorded.
+
+    Returns:
+        The remote path returned by upload_fn.
+    """
+    if dry:
+        return upload_fn(os.path.basename(filename))
+    key = (destination, remote_filename(filename))
+    with _lock:
+        if key in _uploaded:
+            return _uploaded[key]
+        upload_lock = _uploading.setdefault(key, threading.Lock())
+    with upload_lock:
+        with _lock:
+            if key in _uploaded:
+                return _uploaded[key]
+        remote_path = upload_fn(key[1])
+        with _lock:
+            _uploaded[key] = remote_path
+            del _uploading[key]
+    return remote_path
+
+
+def clear():
+    """ Forget which files have been uploaded """
+    with _lock:
+        _digests.clear()
+        _uploaded.clear()
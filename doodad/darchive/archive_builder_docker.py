@@ -4,8 +4,9 @@ Library for building runnable Doodad Archives.
 Doodad Archives package code and data into a single
 executable shell script, which runs within a docker container.
 
-Currently, doodad uses makeself as a backend to build these
-packaged scripts.
+Archives use the makeself self-extracting format. They are either written
+natively by streaming the payload through tarfile (see dar_writer), or built
+by staging files into a directory and running makeself.
 """
 import os
 import sys
@@ -13,21 +14,35 @@ import tempfile
 import shutil
 import time
 import subprocess
+import tarfile
+import warnings
 import uuid
 import contextlib
 import uuid
+from concurrent import futures
 
 import doodad
+from doodad import mount, utils
+from doodad.darchive import archive_cache, archive_stage, dar_writer
+from doodad.darchive.report import BuildReport, RecordingStage
 from doodad.utils import cmd_builder, which
 
 THIS_FILE_DIR = os.path.dirname(__file__)
 MAKESELF_PATH = os.path.join(THIS_FILE_DIR, 'makeself.sh')
-MAKESELF_ARGS = ''
-if which('pigz') is not None:
-    MAKESELF_ARGS = '--pigz'
 MAKESELF_HEADER_PATH = os.path.join(THIS_FILE_DIR, 'makeself-header.sh')
 BEGIN_HEADER = '--- BEGIN DAR OUTPUT ---'
 DAR_PAYLOAD_MOUNT = 'dar_payload'
+BIND_SCRIPT_MOUNT = 'dar_script'
+
+# compression -> (makeself flag, compressor binary, default level, default threads)
+COMPRESSION_BACKENDS = {
+    'none': ('--nocomp', None, None, None),
+    'gzip': ('--gzip', 'gzip', 9, None),
+    'pigz': ('--pigz', 'pigz', 9, None),
+    'zstd': ('--zstd', 'zstd', 3, 0),
+    'xz': ('--xz', 'xz', 6, None),
+}
+DEFAULT_COMPRESSION = 'pigz' if which('pigz') is not None else 'gzip'
 
 
 def build_archive(archive_filename='runfile.dar',
@@ -36,7 +51,19 @@ def build_archive(archive_filename='runfile.dar',
                   payload_script='',
                   mounts=(),
                   use_nvidia_docker=False,
-                  verbose=False):
+                  verbose=False,
+                  cache=None,
+                  layer_cache=None,
+                  staging_workers=1,
+                  staging_times=None,
+                  compression=None,
+                  compression_level=None,
+                  compression_threads=None,
+                  writer='native',
+                  timings=None,
+                  report=None,
+                  dedupe=False,
+                  direct_extract=False):
     """
     Construct a Doodad Archive
 
@@ -46,50 +73,265 @@ def build_archive(archive_filename='runfile.dar',
         payload_script (str): A command or sequence of shell commands to be
             executed inside the container on when the script is run.
         mounts (tuple): A list of Mount objects
+        cache (ArchiveCache): If given, reuse a previously built archive
+            when neither the mounts nor the build arguments have changed.
+            Cached archives keep the METADATA of the original build.
+        layer_cache (LayerCache): If given, read-only local mounts are packed
+            into separately cached layers, and only mounts whose contents
+            changed are re-packed.
+        staging_workers (int): Number of mounts to stage concurrently.
+            The native writer stages each mount into a temporary tar and
+            appends them to the archive in order, except with dedupe,
+            where mounts are staged one at a time.
+        staging_times (list): If given, a (mount, seconds) tuple is appended
+            for every mount with the time it took to stage.
+        compression (str): One of 'none', 'gzip', 'pigz', 'zstd' or 'xz'.
+            Defaults to pigz if it is installed and gzip otherwise.
+            The matching decompressor must be installed on the machine
+            that runs the archive.
+        compression_level (int): Compression level. Defaults to 9 for
+            gzip and pigz, 3 for zstd and 6 for xz.
+        compression_threads (int): Number of compression threads for pigz,
+            zstd and xz. 0 uses all cores, which is the default for zstd.
+        writer (str): 'native' streams mounts straight from their sources
+            into the archive. 'makeself' stages them into a temporary
+            directory first and compiles it with makeself.sh.
+        timings (dict): If given, the seconds spent in each build step
+            are recorded here. The native writer compresses files as they
+            are staged; that time is recorded as 'staging_compress' and
+            not included in 'staging'.
+        report (BuildReport or str): If given, a report of the bytes, files
+            and time each mount contributes is recorded in this BuildReport,
+            or written as JSON to this filename.
+        dedupe (bool): If True, files with identical contents (e.g. from
+            overlapping mounts) are stored once in the archive and
+            extracted as hardlinks to each other. Not applied to mounts
+            appended as tarballs with direct_extract.
+        direct_extract (bool): If True, read-only local mounts are appended
+            to the archive as separate tarballs, which are extracted inside
+            the container straight from the archive file to their mount
+            points, rather than extracted with the payload and then moved.
+            The archive file must stay in place while it runs.
 
     Returns:
         str: Name of archive file.
     """
-    # create a temporary work directory
-    try:
-        work_dir = tempfile.mkdtemp()
-        archive_dir = os.path.join(work_dir, 'archive')
-        os.makedirs(archive_dir)
+    if writer not in ('native', 'makeself'):
+        raise ValueError('Unknown archive writer: %s' % writer)
+    if dedupe and direct_extract and any(isinstance(mnt, mount.MountLocal) and mnt.read_only for mnt in mounts):
+        warnings.warn('dedupe does not apply to read-only local mounts with direct_extract, '
+                      'which are appended to the archive as separate tarballs')
+    compression = compression or DEFAULT_COMPRESSION
+    makeself_args = compression_args(compression, compression_level, compression_threads)
+    if timings is None:
+        timings = {}
+    report_file = None
+    if isinstance(report, str):
+        report_file, report = report, BuildReport()
+    if report is not None:
+        report.archive = archive_filename
+        report.compression = compression
+        report.writer = writer
+        report.timings = timings
+    if cache is not None:
+        cache_key = archive_cache.archive_digest(
+            mounts,
+            docker_image=docker_image,
+            is_docker_interactive=is_docker_interactive,
+            payload_script=payload_script,
+            use_nvidia_docker=use_nvidia_docker,
+            verbose=verbose,
+            makeself_args=makeself_args,
+            dedupe=dedupe,
+            direct_extract=direct_extract,
+        )
+        cached_archive = cache.get(cache_key)
+        if cached_archive is not None:
+            if verbose:
+                print('Using cached archive %s' % cached_archive)
+            utils.link_or_copy(cached_archive, archive_filename)
+            if report is not None:
+                report.cached = True
+                report.archive_bytes = os.path.getsize(archive_filename)
+                if report_file is not None:
+                    report.write(report_file)
+            return archive_filename
 
-        deps_dir = os.path.join(archive_dir, 'deps')
-        os.makedirs(deps_dir)
-        for mnt in mounts:
-            mnt.dar_build_archive(deps_dir)
-
-        write_run_script(archive_dir, mounts,
+    times = []
+    segments = archive_stage.Segments() if direct_extract else None
+    if direct_extract:
+        makeself_args += ' --export-conf'
+    def stage_archive(stage):
+        stage.segments = segments
+        write_run_script(stage, mounts,
             payload_script=payload_script, verbose=verbose)
-        write_docker_hook(archive_dir, docker_image, mounts, verbose=verbose,
-                          use_nvidia_docker=use_nvidia_docker, interactive=is_docker_interactive)
-        write_metadata(archive_dir)
+        write_docker_hook(stage, docker_image, mounts, verbose=verbose,
+                          use_nvidia_docker=use_nvidia_docker, interactive=is_docker_interactive,
+                          bundle=direct_extract)
+        write_metadata(stage)
+        start = time.time()
+        write_start = stage.write_seconds() if isinstance(stage, archive_stage.TarStage) else 0.0
+        times.extend(stage_mounts(mounts, stage.substage('deps'), layer_cache=layer_cache,
+                                  workers=staging_workers, report=report))
+        if isinstance(stage, archive_stage.TarStage):
+            timings['staging_compress'] = stage.write_seconds() - write_start
+            timings['staging'] = time.time() - start - timings['staging_compress']
+        else:
+            timings['staging'] = time.time() - start
 
-        # create the self-extracting archive
-        compile_archive(archive_dir, archive_filename, verbose=verbose)
-    finally:
-        shutil.rmtree(work_dir)
+    if writer == 'native':
+        level, threads = resolve_compression(compression, compression_level, compression_threads)
+        sizes = {}
+        dar_writer.write_archive(archive_filename, stage_archive, compression=compression,
+                                 level=level, threads=threads, timings=timings, sizes=sizes,
+                                 dedupe=dedupe, export_conf=direct_extract)
+        uncompressed_bytes = sizes['uncompressed']
+        deduplicated_bytes = sizes['deduplicated']
+    else:
+        # create a temporary work directory
+        try:
+            work_dir = tempfile.mkdtemp()
+            archive_dir = os.path.join(work_dir, 'archive')
+            os.makedirs(archive_dir)
+            stage_archive(archive_stage.DirectoryStage(archive_dir))
+            deduplicated_bytes = 0
+            if dedupe:
+                start = time.time()
+                deduplicated_bytes = archive_stage.dedupe_directory(archive_dir).saved_bytes
+                timings['dedupe'] = time.time() - start
+            uncompressed_bytes = sum(os.path.getsize(os.path.join(dirname, fname))
+                                     for dirname, _, files in os.walk(archive_dir)
+                                     for fname in files) - deduplicated_bytes
+
+            # create the self-extracting archive
+            start = time.time()
+            compile_archive(archive_dir, archive_filename, verbose=verbose,
+                            makeself_args=makeself_args)
+            timings['makeself'] = time.time() - start
+        finally:
+            shutil.rmtree(work_dir)
+    if segments is not None:
+        start = time.time()
+        segments.write(archive_filename)
+        timings['segments'] = time.time() - start
+    if report is not None:
+        report.archive_bytes = os.path.getsize(archive_filename)
+        report.uncompressed_bytes = uncompressed_bytes
+        report.deduplicated_bytes = deduplicated_bytes
+        if report_file is not None:
+            report.write(report_file)
+    if verbose:
+        for mnt, seconds in times:
+            print('Staged %s in %.2fs' % (mnt, seconds))
+        for step in sorted(timings):
+            print('%s took %.2fs' % (step, timings[step]))
+    if staging_times is not None:
+        staging_times.extend(times)
+    if cache is not None:
+        cache.put(cache_key, archive_filename)
     return archive_filename
 
+def stage_mounts(mounts, deps_dir, layer_cache=None, workers=1, report=None):
+    """
+    Copy the contents of each mount into the archive dependency directory.
+
+    Args:
+        mounts (tuple): A list of Mount objects
+        deps_dir (str, DirectoryStage or TarStage): Archive dependency
+            directory, or a stage rooted at it
+        layer_cache (LayerCache): Optional cache for packed mount layers
+        workers (int): Maximum number of mounts staged at once. Mounts
+            staged concurrently into a TarStage are written to temporary
+            tars first, and appended to it in order. Mounts are staged
+            into a deduplicating TarStage one at a time.
+        report (BuildReport): If given, the files staged for each mount
+            are recorded in it.
+
+    Returns:
+        list: A (mount, seconds) tuple for every mount, in order.
+
+    Raises:
+        ValueError: If two mounts would be staged to the same directory,
+            e.g. the same MountLocal added twice.
+    """
+    names = {}
+    for mnt in mounts:
+        if (type(mnt), mnt.name) in names:
+            raise ValueError('Mounts %s and %s would be staged to the same directory' % (
+                names[type(mnt), mnt.name].mount_point, mnt.mount_point))
+        names[type(mnt), mnt.name] = mnt
+    deps_stage = _as_stage(deps_dir)
+    if isinstance(deps_stage, archive_stage.DirectoryStage):
+        utils.makedirs(deps_stage.root)
+    mount_stats = [None] * len(mounts)
+    if report is not None:
+        mount_stats = [report.mount_stats(mnt) for mnt in mounts]
+
+    def stage(mnt, stats, target=deps_stage):
+        start = time.time()
+        kwargs = {} if layer_cache is None else {'layer_cache': layer_cache}
+        if stats is None:
+            mnt.dar_stage(target, **kwargs)
+        else:
+            mnt.dar_stage(RecordingStage(target, stats), **kwargs)
+            stats.seconds = time.time() - start
+        return mnt, time.time() - start
+
+    def stage_to_tar(mnt, stats):
+        tmp = tempfile.TemporaryFile()
+        try:
+            with tarfile.open(fileobj=tmp, mode='w', dereference=True) as tar:
+                result = stage(mnt, stats, target=deps_stage.detached(tar))
+            tmp.seek(0)
+        except BaseException:
+            tmp.close()
+            raise
+        return result, tmp
+
+    if workers > 1 and len(mounts) > 1 and isinstance(deps_stage, archive_stage.TarStage):
+        if deps_stage.index is not None:
+            # a file may only be hardlinked to one added before it
+            warnings.warn('staging_workers is ignored when deduplicating files into a native archive')
+            workers = 1
+        else:
+            results = []
+            with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                for result, tmp in executor.map(stage_to_tar, mounts, mount_stats):
+                    with tmp:
+                        deps_stage.add_tar(tmp)
+                    results.append(result)
+            return results
+    if workers <= 1 or len(mounts) <= 1:
+        return [stage(mnt, stats) for mnt, stats in zip(mounts, mount_stats)]
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(stage, mounts, mount_stats))
+
+def _as_stage(arch_dir):
+    if isinstance(arch_dir, str):
+        return archive_stage.DirectoryStage(arch_dir)
+    return arch_dir
+
 def write_metadata(arch_dir):
-    with open(os.path.join(arch_dir, 'METADATA'), 'w') as f:
-        f.write('doodad_version=%s\n' % doodad.__version__)
-        f.write('unix_timestamp=%d\n' % time.time())
-        f.write('uuid=%s\n' % uuid.uuid4())
+    metadata = 'doodad_version=%s\n' % doodad.__version__
+    metadata += 'unix_timestamp=%d\n' % time.time()
+    metadata += 'uuid=%s\n' % uuid.uuid4()
+    _as_stage(arch_dir).write_file('METADATA', metadata)
 
-def write_docker_hook(arch_dir, image_name, mounts, verbose=False, use_nvidia_docker=False, interactive=False):
-    docker_hook_file = os.path.join(arch_dir, 'docker.sh')
+def write_docker_hook(arch_dir, image_name, mounts, verbose=False, use_nvidia_docker=False, interactive=False,
+                      bundle=False):
     builder = cmd_builder.CommandBuilder()
     builder.append('#!/bin/bash')
     #if verbose:
     #    builder.echo('All script arguments:')
     #    builder.echo('$@')
-    mnt_cmd = ''.join([' -v %s:%s' % (mnt.sync_dir, mnt.mount_point)
-        for mnt in mounts if mnt.writeable])
+    mnt_cmd = _writeable_mount_args(mounts)
     # mount the script into the docker image
     mnt_cmd += ' -v $(pwd):/'+DAR_PAYLOAD_MOUNT
+    if bundle:
+        # mount the archive file itself, to extract segments from
+        builder.append('DAR_BUNDLE="$MS_BUNDLE"')
+        builder.append('case "$DAR_BUNDLE" in /*) ;; *) DAR_BUNDLE="$USER_PWD/$DAR_BUNDLE";; esac')
+        mnt_cmd += ' -v "$DAR_BUNDLE":%s:ro' % archive_stage.BUNDLE_PATH
     docker_cmd = ('docker run {gpu_opt} {mount_cmds} {interactive_opt} {img} /bin/bash -c "cd /{dar_payload};./run.sh $*"'.format(
         gpu_opt='--gpus all' if use_nvidia_docker else '',
         img=image_name,
@@ -101,12 +343,85 @@ def write_docker_hook(arch_dir, image_name, mounts, verbose=False, use_nvidia_do
         builder.echo('Docker command:' + docker_cmd)
     builder.append(docker_cmd)
 
-    with open(docker_hook_file, 'w') as f:
-        f.write(builder.dump_script())
-    os.chmod(docker_hook_file, 0o777)
+    _as_stage(arch_dir).write_file('docker.sh', builder.dump_script(), mode=0o777)
+
+def build_bind_script(script_dir,
+                      docker_image='ubuntu:18.04',
+                      is_docker_interactive=False,
+                      payload_script='',
+                      mounts=(),
+                      use_nvidia_docker=False,
+                      verbose=False):
+    """
+    Write a script which runs payload_script in a docker container on this
+    host, with read-only mounts bind-mounted from their local directories
+    instead of packed into an archive.
+
+    Bind-mounted directories are visible as they are on the host (mount
+    filters do not apply) and cannot be written to from the container.
+
+    Args:
+        script_dir (str): Directory to write the scripts to. It must exist
+            for as long as the script runs.
+        docker_image (str): Name of docker image
+        is_docker_interactive (bool): Run the container with a terminal
+            attached to stdin (docker run -it)
+        payload_script (str): A command or sequence of shell commands to be
+            executed inside the container on when the script is run.
+        mounts (tuple): A list of Mount objects
+        use_nvidia_docker (bool): Give the container access to all GPUs
+        verbose (bool): Print the docker command when the script runs
+
+    Returns:
+        str: Name of the script to run, or None if one of the read-only
+            mounts cannot be bind-mounted and an archive has to be built.
+    """
+    binds = bind_mounts(mounts)
+    if binds is None:
+        return None
+    write_run_script(script_dir, mounts, payload_script=payload_script, verbose=verbose,
+                     extract=False)
+    builder = cmd_builder.CommandBuilder()
+    builder.append('#!/bin/bash')
+    mnt_cmd = _writeable_mount_args(mounts)
+    mnt_cmd += ''.join(' -v %s:%s:ro' % bind for bind in binds)
+    mnt_cmd += ' -v %s:/%s:ro' % (os.path.abspath(script_dir), BIND_SCRIPT_MOUNT)
+    docker_cmd = 'docker run {gpu_opt} {mount_cmds} -w /{workdir} {interactive_opt} {img} /bin/bash /{script}/run.sh $*'.format(
+        gpu_opt='--gpus all' if use_nvidia_docker else '',
+        img=docker_image,
+        mount_cmds=mnt_cmd,
+        workdir=DAR_PAYLOAD_MOUNT,
+        script=BIND_SCRIPT_MOUNT,
+        interactive_opt='-it' if is_docker_interactive else '-t',
+    )
+    if verbose:
+        builder.echo('Docker command:' + docker_cmd)
+    builder.append(docker_cmd)
+    script = os.path.join(script_dir, 'docker.sh')
+    _as_stage(script_dir).write_file('docker.sh', builder.dump_script(), mode=0o777)
+    return script
+
+def bind_mounts(mounts):
+    """
+    Returns:
+        list: (host path, container path) to bind-mount for every read-only
+            mount, or None if any of them cannot be bind-mounted.
+    """
+    binds = []
+    for mnt in mounts:
+        if mnt.writeable:
+            continue
+        bind = mnt.docker_bind_mount('/' + DAR_PAYLOAD_MOUNT)
+        if bind is None:
+            return None
+        binds.append(bind)
+    return binds
 
-def write_run_script(arch_dir, mounts, payload_script, verbose=False):
-    runfile = os.path.join(arch_dir, 'run.sh')
+def _writeable_mount_args(mounts):
+    return ''.join([' -v %s:%s' % (mnt.sync_dir, mnt.mount_point)
+        for mnt in mounts if mnt.writeable])
+
+def write_run_script(arch_dir, mounts, payload_script, verbose=False, extract=True):
     builder = cmd_builder.CommandBuilder()
     builder.append('#!/bin/bash')
     if verbose:
@@ -116,35 +431,86 @@ def write_run_script(arch_dir, mounts, payload_script, verbose=False):
         builder.append('cat', './METADATA')
 
     for mount in mounts:
-        if verbose:
-            builder.append('echo', 'Mounting %s' % mount)
-        builder.append(mount.dar_extract_command())
+        if extract:
+            if verbose:
+                builder.append('echo', 'Mounting %s' % mount)
+            builder.append(mount.dar_extract_command())
         if mount.pythonpath:
             builder.append('export PYTHONPATH=$PYTHONPATH:%s' % mount.mount_point)
     if verbose:
         builder.append('echo', BEGIN_HEADER)
     builder.append(payload_script + ' $*')
 
-    with open(runfile, 'w') as f:
-        f.write(builder.dump_script())
+    _as_stage(arch_dir).write_file('run.sh', builder.dump_script(), mode=0o777)
+
+def resolve_compression(compression, level=None, threads=None):
+    """
+    Fill in the default level and thread count of a compression backend.
+
+    Args:
+        compression (str): One of the keys of COMPRESSION_BACKENDS
+        level (int): Compression level, or None for the backend default
+        threads (int): Number of compression threads, or None for the
+            backend default
 
-    os.chmod(runfile, 0o777)
+    Returns:
+        (int, int): Compression level and thread count, either may be None
+    """
+    if compression not in COMPRESSION_BACKENDS:
+        raise ValueError('Unknown compression %r. Must be one of %s' %
+                         (compression, ', '.join(sorted(COMPRESSION_BACKENDS))))
+    _, binary, default_level, default_threads = COMPRESSION_BACKENDS[compression]
+    if binary is not None and which(binary) is None:
+        raise ValueError('Compression %r requires %s to be installed' % (compression, binary))
+    if default_level is None:
+        level = None
+    elif level is None:
+        level = default_level
+    if compression not in ('pigz', 'zstd', 'xz'):
+        threads = None
+    elif threads is None:
+        threads = default_threads
+    return level, threads
 
-def compile_archive(archive_dir, output_file, verbose=False):
+def compression_args(compression, level=None, threads=None):
+    """
+    Build the makeself command line flags for a compression backend.
+
+    Args:
+        compression (str): One of the keys of COMPRESSION_BACKENDS
+        level (int): Compression level, or None for the backend default
+        threads (int): Number of compression threads, or None for the
+            backend default
+
+    Returns:
+        str: makeself arguments
+    """
+    level, threads = resolve_compression(compression, level, threads)
+    args = [COMPRESSION_BACKENDS[compression][0]]
+    if level is not None:
+        args.append('--complevel %d' % level)
+    if threads is not None:
+        args.append('--threads %d' % threads)
+    return ' '.join(args)
+
+def compile_archive(archive_dir, output_file, verbose=False, makeself_args=None):
     compile_cmd = "{mkspath} {mksargs} --nocrc --nomd5 --header {mkhpath} {archive_dir} {output_file} {name} {run_script}"
-    compile_cmd = compile_cmd.format(
-        mkspath=MAKESELF_PATH,
-        mksargs=MAKESELF_ARGS,
-        mkhpath=MAKESELF_HEADER_PATH,
-        name='DAR',
-        archive_dir=archive_dir,
-        output_file=output_file,
-        run_script='./docker.sh'
-    )
-    pipe = subprocess.PIPE
-    p = subprocess.Popen(compile_cmd, shell=True, stdout=pipe, stderr=pipe)
-    p.communicate()
-    os.chmod(output_file, 0o777)
+    # written under a temporary name, as output_file may be hardlinked
+    # to a cached archive
+    with utils.replacing(output_file) as tmp_file:
+        compile_cmd = compile_cmd.format(
+            mkspath=MAKESELF_PATH,
+            mksargs=compression_args(DEFAULT_COMPRESSION) if makeself_args is None else makeself_args,
+            mkhpath=MAKESELF_HEADER_PATH,
+            name='DAR',
+            archive_dir=archive_dir,
+            output_file=tmp_file,
+            run_script='./docker.sh'
+        )
+        pipe = subprocess.PIPE
+        p = subprocess.Popen(compile_cmd, shell=True, stdout=pipe, stderr=pipe)
+        p.communicate()
+        os.chmod(tmp_file, 0o777)
 
 def run_archive(filename, cli_args='', encoding='utf-8', shell_interpreter='sh', timeout=None, get_output=True):
     if '/' not in filename:
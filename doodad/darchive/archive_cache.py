@@ -0,0 +1,184 @@
+"""
+On-disk cache for built Doodad Archives.
+
+Archives are stored under a digest of everything that goes into them
+(mount contents, payload script, docker image, build flags and the doodad
+version), so launching unchanged code again reuses the existing .dar file
+instead of copying and compressing every mount from scratch.
+
+Example:
+
+cache = archive_cache.ArchiveCache()
+launch_api.run_command('echo hello', mounts=mounts, archive_cache=cache)
+"""
+import os
+import hashlib
+import shutil
+import tempfile
+import threading
+
+import doodad
+from doodad import utils
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.doodad', 'cache')
+DEFAULT_MAX_SIZE = 5 * 1024 ** 3  # bytes
+
+
+class FileCache(object):
+    """
+    A size-bounded, least-recently-used cache of files keyed by digest.
+
+    Recency is tracked with file modification times, which are refreshed
+    on every hit, so the cache survives across processes.
+
+    Args:
+        cache_dir (str): Directory to store cached files in
+        max_size (int): Maximum total size of the cache in bytes. The least
+            recently used entries are evicted once this is exceeded.
+        suffix (str): File extension given to cache entries
+    """
+    def __init__(self, cache_dir, max_size=DEFAULT_MAX_SIZE, suffix=''):
+        self.cache_dir = os.path.realpath(os.path.expanduser(cache_dir))
+        self.max_size = max_size
+        self.suffix = suffix
+        self._lock = threading.Lock()
+        utils.makedirs(self.cache_dir)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + self.suffix)
+
+    def get(self, key):
+        """
+        Look up a cache entry.
+
+        Returns:
+            str: Path to the cached file, or None on a miss.
+        """
+        path = self.path(key)
+        try:
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def put(self, key, filename, move=False):
+        """
+        Copy a file into the cache, evicting old entries if needed.
+
+        Args:
+            key (str): Cache key
+            filename (str): File to add
+            move (bool): If True, move filename into the cache instead of
+                copying it. Use this for files built only to be cached.
+
+        Returns:
+            str: Path to the cached file.
+        """
+        path = self.path(key)
+        if move and os.path.dirname(os.path.realpath(filename)) == self.cache_dir:
+            os.replace(filename, path)
+        else:
+            # Copy under a temporary name first so readers never see partial files
+            tmp_path = self.temp_file()
+            try:
+                shutil.copyfile(filename, tmp_path)
+                shutil.copymode(filename, tmp_path)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+            if move:
+                os.remove(filename)
+        self.evict()
+        return path
+
+    def temp_file(self):
+        """
+        Create an empty temporary file inside the cache directory, which
+        can later be added with put(key, filename, move=True).
+        Temporary files are never returned by get().
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        os.close(fd)
+        return tmp_path
+
+    def entries(self):
+        """
+        Returns:
+            list: (mtime, size, path) for every entry, oldest first.
+        """
+        entries = []
+        for fname in os.listdir(self.cache_dir):
+            if not fname.endswith(self.suffix) or fname.endswith('.tmp'):
+                continue
+            path = os.path.join(self.cache_dir, fname)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        with self._lock:
+            entries = self.entries()
+            total = sum(size for _, size, _ in entries)
+            # Always keep the most recent entry, even if it alone is too big
+            for _, size, path in entries[:-1]:
+                if total <= self.max_size:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+
+    def clear(self):
+        for _, _, path in self.entries():
+            os.remove(path)
+
+
+class ArchiveCache(FileCache):
+    """
+    A FileCache for built .dar archives.
+
+    Args:
+        cache_dir (str): Directory to store archives in.
+            Default ~/.doodad/cache/archives
+        max_size (int): Maximum total size of cached archives in bytes.
+    """
+    def __init__(self, cache_dir=None, max_size=DEFAULT_MAX_SIZE):
+        if cache_dir is None:
+            cache_dir = os.path.join(DEFAULT_CACHE_DIR, 'archives')
+        super(ArchiveCache, self).__init__(cache_dir, max_size=max_size, suffix='.dar')
+
+
+def archive_digest(mounts=(), **build_args):
+    """
+    Compute the cache key of an archive.
+
+    Args:
+        mounts (tuple): A list of Mount objects
+        **build_args: Remaining arguments to build_archive, i.e.
+            payload_script, docker_image and use_nvidia_docker.
+
+    Returns:
+        str: A hex digest
+    """
+    hasher = hashlib.sha256()
+    _update(hasher, 'doodad_version=%s' % doodad.__version__)
+    for key in sorted(build_args):
+        _update(hasher, '%s=%r' % (key, build_args[key]))
+    for mnt in mounts:
+        _update(hasher, mnt.dar_fingerprint())
+    return hasher.hexdigest()
+
+
+def _update(hasher, value):
+    value = value.encode('utf-8')
+    # Length-prefix each field so that adjacent fields cannot collide
+    hasher.update(('%d:' % len(value)).encode('utf-8'))
+    hasher.update(value)
@@ -0,0 +1,309 @@
+"""
+Destinations that mounts write their archive contents into.
+
+A stage exposes a small, filesystem-like interface (makedirs, add_file and
+write_file) addressed by paths relative to the archive's deps directory.
+DirectoryStage materializes the files on disk for makeself, while TarStage
+streams them straight into a tar archive without a staging directory.
+
+Mounts may also add segments: compressed tarballs which are appended to
+the end of the archive and extracted inside the container straight from
+the archive file, instead of being extracted with the rest of the payload
+and moved into place.
+
+Files which are staged several times (e.g. by overlapping mounts) can be
+deduplicated with a ContentIndex, so they are stored once and hardlinked
+everywhere else.
+"""
+import io
+import os
+import shutil
+import tarfile
+import threading
+import time
+
+from doodad import utils
+
+# Where the archive file itself is visible inside the container
+BUNDLE_PATH = '/dar_bundle'
+
+
+class Segments(object):
+    """
+    Tarballs appended after an archive's payload.
+
+    The archive ends with a line of space separated name=offset:size
+    entries, which segment_extract_command uses to locate a segment.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._segments = []
+
+    def __len__(self):
+        return len(self._segments)
+
+    def add(self, name, source, callback=None):
+        """
+        Args:
+            name (str): Segment name, without whitespace or '='
+            source (str or callable): A .tar.gz file, or a function which
+                writes one to the file object it is given
+            callback (callable): Called with the size of the segment in
+                bytes once it has been written
+        """
+        with self._lock:
+            self._segments.append((name, source, callback))
+
+    def write(self, archive_filename):
+        """ Append all segments and their index to an archive """
+        entries = []
+        with open(archive_filename, 'ab') as f:
+            for name, source, callback in self._segments:
+                offset = f.tell()
+                if callable(source):
+                    source(f)
+                else:
+                    with open(source, 'rb') as src:
+                        shutil.copyfileobj(src, f)
+                size = f.tell() - offset
+                entries.append('%s=%d:%d' % (name, offset, size))
+                if callback is not None:
+                    callback(size)
+            f.write(('\n%s\n' % ' '.join(entries)).encode('utf-8'))
+
+
+def segment_extract_command(name, target_dir, bundle=BUNDLE_PATH):
+    """ Shell commands (for bash) extracting a segment of the archive bundle into target_dir """
+    return ('for entry in $(tail -n 1 {bundle}); do case "$entry" in {name}=*) segment=${{entry#*=}};; esac; done\n'
+            'tail -c +$((${{segment%:*}} + 1)) {bundle} | head -c ${{segment#*:}} | tar -xzf - -C {target}\n').format(
+                bundle=bundle, name=name, target=target_dir)
+
+
+class ContentIndex(object):
+    """
+    Finds files whose contents were already staged.
+
+    Files are compared by inode first, then by size, and only hashed
+    when another staged file has the same size.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inodes = {}
+        self._sizes = {}
+        self._digests = {}
+        self.saved_bytes = 0
+
+    def _digest(self, filename):
+        digest = self._digests.get(filename)
+        if digest is None:
+            digest = self._digests[filename] = utils.hash_file(filename)
+        return digest
+
+    def find(self, filename, arcname):
+        """
+        Look up a file, registering it under arcname if its contents are new.
+
+        Returns:
+            str: The arcname of an identical, previously staged file, or None
+        """
+        stat = os.stat(filename)
+        inode = (stat.st_dev, stat.st_ino)
+        with self._lock:
+            original = self._inodes.get(inode)
+            if original is None and stat.st_size > 0:
+                candidates = self._sizes.setdefault(stat.st_size, [])
+                if candidates:
+                    digest = self._digest(filename)
+                    for candidate, candidate_arcname in candidates:
+                        if self._digest(candidate) == digest:
+                            original = candidate_arcname
+                            break
+                if original is None:
+                    candidates.append((filename, arcname))
+            if original is None:
+                self._inodes[inode] = arcname
+                return None
+            self.saved_bytes += stat.st_size
+            return original
+
+
+class DirectoryStage(object):
+    """
+    Stage files into a directory on disk.
+
+    Args:
+        root (str): Directory that paths are relative to
+        segments (Segments): If given, mounts may add segments to it
+    """
+    def __init__(self, root, segments=None):
+        self.root = root
+        self.segments = segments
+
+    def path(self, arcname):
+        return os.path.join(self.root, arcname)
+
+    def substage(self, dirname):
+        """ A stage whose paths are relative to dirname """
+        return DirectoryStage(self.path(dirname), segments=self.segments)
+
+    def add_segment(self, name, source):
+        self.segments.add(name, source)
+
+    def makedirs(self, arcname):
+        utils.makedirs(self.path(arcname))
+
+    def add_file(self, filename, arcname, link=False):
+        """
+        Add an existing file.
+
+        Args:
+            filename (str): Source file
+            arcname (str): Destination path
+            link (bool): If True, the file may be staged as a reflink or
+                hardlink of the source instead of a copy.
+        """
+        dst = self.path(arcname)
+        utils.makedirs(os.path.dirname(dst))
+        if link:
+            utils.clone_file(filename, dst)
+        else:
+            shutil.copy2(filename, dst)
+
+    def write_file(self, arcname, contents, mode=0o644):
+        """
+        Create a file with the given contents.
+
+        Args:
+            arcname (str): Destination path
+            contents (str): File contents
+            mode (int): Permission bits
+        """
+        dst = self.path(arcname)
+        utils.makedirs(os.path.dirname(dst))
+        if os.path.lexists(dst):
+            # Never write through a staged file, it may be hardlinked to its source
+            os.remove(dst)
+        with open(dst, 'w') as f:
+            f.write(contents)
+        os.chmod(dst, mode)
+
+
+def dedupe_directory(root, index=None):
+    """
+    Replace files in a staged directory with hardlinks to the first
+    file with identical contents, so that tar stores them only once.
+
+    Returns:
+        ContentIndex: The index used, which records the bytes saved
+    """
+    index = ContentIndex() if index is None else index
+    for dirname, dirs, files in os.walk(root):
+        dirs.sort()
+        for fname in sorted(files):
+            path = os.path.join(dirname, fname)
+            if os.path.islink(path):
+                continue
+            original = index.find(path, os.path.relpath(path, root))
+            if original is not None:
+                # Never write through a staged file, it may be hardlinked to its source
+                os.remove(path)
+                utils.link_or_copy(os.path.join(root, original), path)
+    return index
+
+
+class TarStage(object):
+    """
+    Stream files into an open tarfile.
+
+    Args:
+        tar (tarfile.TarFile): An archive opened for writing
+        prefix (str): Prefix prepended to every path in the archive
+        index (ContentIndex): If given, files with the same contents as a
+            previously added file are stored as hardlinks to it.
+        segments (Segments): If given, mounts may add segments to it
+        output: If given, the writer the tar is written to, with a
+            `seconds` attribute counting the time spent writing (and so
+            compressing) the archive.
+    """
+    def __init__(self, tar, prefix='deps', index=None, segments=None, output=None):
+        self.tar = tar
+        self.prefix = prefix
+        self.index = index
+        self.segments = segments
+        self.output = output
+        self._dirs = set()
+
+    def write_seconds(self):
+        """ Seconds spent writing to the output so far """
+        return 0.0 if self.output is None else self.output.seconds
+
+    def arcname(self, arcname):
+        return os.path.normpath(os.path.join(self.prefix, arcname))
+
+    def substage(self, dirname):
+        """ A stage whose paths are relative to dirname """
+        stage = TarStage(self.tar, prefix=self.arcname(dirname), index=self.index,
+                         segments=self.segments, output=self.output)
+        stage._dirs = self._dirs
+        return stage
+
+    def detached(self, tar):
+        """
+        A stage with the same paths which writes into another tar, e.g. to
+        stage concurrently into a temporary tar which is later added with
+        add_tar. Files are not deduplicated.
+        """
+        return TarStage(tar, prefix=self.prefix, segments=self.segments)
+
+    def add_tar(self, fileobj):
+        """
+        Add every member of an uncompressed tar, such as one written by
+        a detached stage. Directories which were already added are skipped.
+        """
+        with tarfile.open(fileobj=fileobj, mode='r') as tar:
+            for info in tar:
+                if info.isdir():
+                    if info.name in self._dirs:
+                        continue
+                    self._dirs.add(info.name)
+                self.tar.addfile(info, tar.extractfile(info) if info.isreg() else None)
+
+    def add_segment(self, name, source):
+        self.segments.add(name, source)
+
+    def makedirs(self, arcname):
+        self._makedirs(self.arcname(arcname))
+
+    def _makedirs(self, name):
+        if name in ('', '.') or name in self._dirs:
+            return
+        self._makedirs(os.path.dirname(name))
+        info = tarfile.TarInfo(name)
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+        info.mtime = time.time()
+        self.tar.addfile(info)
+        self._dirs.add(name)
+
+    def add_file(self, filename, arcname, link=False):
+        name = self.arcname(arcname)
+        self._makedirs(os.path.dirname(name))
+        original = None if self.index is None else self.index.find(filename, name)
+        if original is not None:
+            info = self.tar.gettarinfo(filename, arcname=name)
+            info.type = tarfile.LNKTYPE
+            info.linkname = original
+            info.size = 0
+            self.tar.addfile(info)
+        else:
+            self.tar.add(filename, arcname=name, recursive=False)
+
+    def write_file(self, arcname, contents, mode=0o644):
+        name = self.arcname(arcname)
+        self._makedirs(os.path.dirname(name))
+        data = contents.encode('utf-8')
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mode = mode
+        info.mtime = time.time()
+        self.tar.addfile(info, io.BytesIO(data))
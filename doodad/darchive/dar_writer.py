@@ -0,0 +1,258 @@
+"""
+Native writer for self-extracting Doodad Archives.
+
+This produces the same self-extracting format as makeself (and uses the
+same makeself-header.sh), but streams the payload through tarfile and the
+compressor straight into the output file, without a staging directory or
+a makeself subprocess.
+
+The makeself header is a shell here-document. It is rendered in Python
+with the size fields padded to a fixed width, so the header can be written
+before the payload and patched in place once its size is known.
+"""
+import os
+import re
+import sys
+import gzip
+import time
+import tarfile
+import contextlib
+import subprocess
+
+from doodad import utils
+from doodad.darchive import archive_stage
+
+THIS_FILE_DIR = os.path.dirname(__file__)
+MAKESELF_VERSION = '2.4.0'
+MAKESELF_HEADER_PATH = os.path.join(THIS_FILE_DIR, 'makeself-header.sh')
+SIZE_FIELD_WIDTH = 20
+
+# compression -> (compress command, decompress command used by the header)
+COMPRESSORS = {
+    'none': (None, 'cat'),
+    'gzip': (None, 'gzip -cd'),
+    'pigz': ('pigz -{level}', 'gzip -cd'),
+    'zstd': ('zstd -c -{level}', 'zstd -cd'),
+    'xz': ('xz -c{level}', 'xz -d'),
+}
+
+_HEREDOC_START = re.compile(r'^cat << EOF\s+>>?\s+"\$archname"$')
+_NAME = re.compile(r'\{([A-Za-z_][A-Za-z0-9_]*)\}|([A-Za-z_][A-Za-z0-9_]*)')
+_SKIP_EXPR = '`expr $SKIP + 1`'
+
+
+def render_header(variables, header_path=MAKESELF_HEADER_PATH):
+    """
+    Render a makeself header script.
+
+    Args:
+        variables (dict): Values of the shell variables referenced by the
+            header, i.e. those makeself.sh sets before sourcing it.
+            Variables which are not given expand to an empty string,
+            as they would in the shell.
+        header_path (str): Header template
+
+    Returns:
+        str: The header
+    """
+    with open(header_path) as f:
+        lines = f.read().splitlines(True)
+    output = []
+    i = 0
+    while i < len(lines):
+        line = lines[i].rstrip('\n')
+        i += 1
+        if _HEREDOC_START.match(line):
+            body = []
+            while lines[i].rstrip('\n') != 'EOF':
+                body.append(lines[i])
+                i += 1
+            i += 1
+            output.append(_expand(''.join(body), variables))
+        elif line == 'eval "$LSM_CMD"':
+            output.append('No LSM.\n')
+        elif line.strip():
+            raise ValueError('Unsupported makeself header line: %s' % line)
+    return ''.join(output)
+
+
+def _expand(text, variables):
+    """ Expand a here-document body the way sh would. """
+    output = []
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c == '\\' and i + 1 < len(text) and text[i+1] in '\\$`\n':
+            if text[i+1] != '\n':
+                output.append(text[i+1])
+            i += 2
+        elif c == '$':
+            match = _NAME.match(text, i+1)
+            if match:
+                output.append(str(variables.get(match.group(1) or match.group(2), '')))
+                i = match.end()
+            else:
+                output.append(c)
+                i += 1
+        elif c == '`':
+            if not text.startswith(_SKIP_EXPR, i):
+                raise ValueError('Unsupported command substitution in makeself header')
+            output.append(str(int(variables['SKIP']) + 1))
+            i += len(_SKIP_EXPR)
+        else:
+            output.append(c)
+            i += 1
+    return ''.join(output)
+
+
+def header_variables(compression, label='DAR', script='./docker.sh', archdirname='archive',
+                     export_conf=False):
+    """
+    The variables makeself.sh would set for
+    `makeself.sh --nocrc --nomd5 --<compression> archdirname output label script`
+    (with --export-conf if export_conf is set)
+    """
+    return {
+        'MS_VERSION': MAKESELF_VERSION,
+        'MS_COMMAND': 'doodad.darchive.dar_writer',
+        'KEEP_UMASK': 'n',
+        'CRCsum': '0' * 10,
+        'MD5sum': '0' * 32,
+        'SHAsum': '0' * 64,
+        'LABEL': label,
+        'SCRIPT': script,
+        'archdirname': archdirname,
+        'KEEP': 'n',
+        'NOOVERWRITE': 'n',
+        'EXPORT_CONF': 'y' if export_conf else 'n',
+        'PROGRESS': 'n',
+        'NOX11': 'n',
+        'COPY': 'none',
+        'NEED_ROOT': 'n',
+        'NOWAIT': 'n',
+        'ENCRYPT': 'n',
+        'COMPRESS': compression,
+        'GUNZIP_CMD': COMPRESSORS[compression][1],
+        'DATE': time.strftime('%a %b %d %H:%M:%S %Z %Y'),
+        'OSTYPE': sys.platform,
+    }
+
+
+def _sized_header(variables, payload_size, uncompressed_size):
+    variables = dict(variables)
+    variables['filesizes'] = str(payload_size).ljust(SIZE_FIELD_WIDTH)
+    variables['USIZE'] = str(uncompressed_size // 1024 + 1).ljust(SIZE_FIELD_WIDTH)
+    variables['SKIP'] = 0
+    variables['SKIP'] = render_header(variables).count('\n')
+    return render_header(variables).encode('utf-8')
+
+
+class _CountingWriter(object):
+    """ Counts the bytes written through it, and the time spent writing them. """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.count = 0
+        self.seconds = 0.0
+
+    def write(self, data):
+        start = time.time()
+        self.count += len(data)
+        result = self.fileobj.write(data)
+        self.seconds += time.time() - start
+        return result
+
+
+@contextlib.contextmanager
+def _compressor(output_file, compression, level=9, threads=None):
+    """ Yield a writable stream that appends compressed data to output_file. """
+    compress_cmd = COMPRESSORS[compression][0]
+    with open(output_file, 'ab') as out:
+        if compression == 'none':
+            yield out
+        elif compression == 'gzip':
+            with gzip.GzipFile(fileobj=out, mode='wb', compresslevel=level, mtime=0) as stream:
+                yield stream
+        else:
+            cmd = compress_cmd.format(level=level).split()
+            if compression == 'zstd' and level > 19:
+                cmd.append('--ultra')
+            if threads is not None:
+                cmd.extend(['-p', str(threads)] if compression == 'pigz' else ['-T%d' % threads])
+            p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=out)
+            try:
+                yield p.stdin
+            finally:
+                p.stdin.close()
+                if p.wait() != 0:
+                    raise subprocess.CalledProcessError(p.returncode, cmd)
+
+
+def write_archive(output_file, stage_fn, compression='gzip', level=9, threads=None,
+                  label='DAR', script='./docker.sh', timings=None, sizes=None,
+                  dedupe=False, export_conf=False):
+    """
+    Write a self-extracting archive.
+
+    Args:
+        output_file (str): Archive file to create
+        stage_fn (callable): Called with a TarStage rooted at the top of the
+            archive, and should add every file the archive contains.
+        compression (str): One of the keys of COMPRESSORS
+        level (int): Compression level
+        threads (int): Number of compression threads for pigz, zstd and xz
+        label (str): Archive label
+        script (str): Script run after extraction, relative to the archive
+        timings (dict): If given, the seconds spent writing the payload
+            ('payload'), in the compressor ('compress') and writing the
+            header ('header') are recorded here. Files are compressed as
+            they are staged, so 'payload' includes 'compress'.
+        sizes (dict): If given, the size of the uncompressed ('uncompressed')
+            and compressed ('compressed') payload in bytes are recorded here,
+            along with the bytes saved by deduplication ('deduplicated').
+        dedupe (bool): If True, files with the same contents as a previously
+            added file are stored as hardlinks to it.
+        export_conf (bool): If True, the path of the archive is exported
+            to the script as $MS_BUNDLE.
+
+    Returns:
+        str: Name of archive file.
+    """
+    if compression not in COMPRESSORS:
+        raise ValueError('Unknown compression %r' % compression)
+    variables = header_variables(compression, label=label, script=script,
+                                 export_conf=export_conf)
+    # written under a temporary name, as output_file may be hardlinked
+    # to a cached archive
+    with utils.replacing(output_file) as tmp_file:
+        start = time.time()
+        header = _sized_header(variables, 0, 0)
+        with open(tmp_file, 'wb') as f:
+            f.write(header)
+        header_time = time.time() - start
+
+        start = time.time()
+        with _compressor(tmp_file, compression, level=level, threads=threads) as stream:
+            counter = _CountingWriter(stream)
+            with tarfile.open(fileobj=counter, mode='w|', dereference=True) as tar:
+                index = archive_stage.ContentIndex() if dedupe else None
+                stage_fn(archive_stage.TarStage(tar, prefix='.', index=index, output=counter))
+            flush_start = time.time()
+        compress_time = counter.seconds + time.time() - flush_start
+        payload_size = os.path.getsize(tmp_file) - len(header)
+        payload_time = time.time() - start
+
+        start = time.time()
+        sized_header = _sized_header(variables, payload_size, counter.count)
+        assert len(sized_header) == len(header)
+        with open(tmp_file, 'r+b') as f:
+            f.write(sized_header)
+        os.chmod(tmp_file, 0o777)
+    if sizes is not None:
+        sizes['uncompressed'] = counter.count
+        sizes['compressed'] = payload_size
+        sizes['deduplicated'] = 0 if index is None else index.saved_bytes
+    if timings is not None:
+        timings['payload'] = payload_time
+        timings['compress'] = compress_time
+        timings['header'] = header_time + time.time() - start
+    return output_file
@@ -0,0 +1,113 @@
+"""
+Incremental, per-mount archive layers.
+
+Instead of copying a MountLocal into the archive staging directory on
+every build, each read-only MountLocal can be packed into its own
+tarball (a "layer"). Layers are cached on disk under a digest of the
+mount's manifest (path, size, mode, mtime and optionally md5 of every
+file), so only mounts that actually changed are re-packed.
+
+Layers added to the archive payload are stored uncompressed, since the
+archive compresses its payload anyway. Only layers appended as segments,
+which are not compressed again, are gzipped.
+
+Example:
+
+layer_cache = layers.LayerCache()
+archive_builder_docker.build_archive(mounts=mounts, layer_cache=layer_cache)
+"""
+import os
+import hashlib
+import tarfile
+
+from doodad.darchive import archive_cache
+
+LAYER_COMPRESS_LEVEL = 6
+
+
+def manifest_digest(manifest, local_dir=None):
+    """
+    Args:
+        manifest (list): A manifest, as returned by MountLocal.manifest()
+        local_dir (str): If given, the digest also identifies the directory
+            the manifest was taken of
+
+    Returns:
+        str: A hex digest identifying the manifest
+    """
+    hasher = hashlib.sha256()
+    if local_dir is not None:
+        hasher.update(('%s\n' % os.path.realpath(local_dir)).encode('utf-8', 'surrogateescape'))
+    for entry in manifest:
+        hasher.update(('%s\0%d\0%o\0%d\0%s\n' % entry).encode('utf-8', 'surrogateescape'))
+    return hasher.hexdigest()
+
+
+def pack_layer(mnt, filename, compress=False, compresslevel=LAYER_COMPRESS_LEVEL):
+    """
+    Write the contents of a MountLocal into a tarball, gzipped if
+    compress is set.
+
+    Paths inside the tarball are relative to the mount's local_dir, so it
+    can be extracted with `tar -xf layer.tar -C mount_point`.
+    """
+    with open(filename, 'wb') as f:
+        write_layer(mnt, f, compress=compress, compresslevel=compresslevel)
+    return filename
+
+
+def write_layer(mnt, fileobj, compress=True, compresslevel=LAYER_COMPRESS_LEVEL):
+    """
+    Like pack_layer, but write the tarball to an open file object.
+    Gzipped by default, as the tarball is usually a segment.
+    """
+    kwargs = {'mode': 'w:gz', 'compresslevel': compresslevel} if compress else {'mode': 'w'}
+    with tarfile.open(fileobj=fileobj, dereference=True, **kwargs) as tar:
+        for path, relpath in mnt.walk_files(include_dirs=True):
+            tar.add(path, arcname=relpath, recursive=False)
+
+
+class LayerCache(archive_cache.FileCache):
+    """
+    A FileCache of packed mount layers.
+
+    Args:
+        cache_dir (str): Directory to store layers in.
+            Default ~/.doodad/cache/layers
+        max_size (int): Maximum total size of cached layers in bytes.
+    """
+    def __init__(self, cache_dir=None, max_size=archive_cache.DEFAULT_MAX_SIZE):
+        if cache_dir is None:
+            cache_dir = os.path.join(archive_cache.DEFAULT_CACHE_DIR, 'layers')
+        # keys carry the .tar or .tar.gz extension of each layer
+        super(LayerCache, self).__init__(cache_dir, max_size=max_size)
+
+    def get_layer(self, mnt, compress=False):
+        """
+        Return the layer for a mount, packing it only if its manifest
+        is not already cached.
+
+        Layers are shared between directories with the same manifest only
+        if the mount hashes file contents: sizes and mtimes alone can match
+        for directories with different contents (e.g. copies made with
+        cp -p), so otherwise the key includes local_dir.
+
+        Args:
+            mnt (MountLocal): A read-only local mount
+            compress (bool): Return a gzipped layer
+
+        Returns:
+            str: Path to the layer tarball
+        """
+        local_dir = None if mnt.hash_contents else mnt.local_dir
+        key = manifest_digest(mnt.manifest(), local_dir=local_dir) + ('.tar.gz' if compress else '.tar')
+        layer = self.get(key)
+        if layer is None:
+            tmp_layer = self.temp_file()
+            try:
+                pack_layer(mnt, tmp_layer, compress=compress)
+            except BaseException:
+                os.remove(tmp_layer)
+                raise
+            layer = self.put(key, tmp_layer, move=True)
+        return layer
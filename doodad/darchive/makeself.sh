@@ -106,10 +106,12 @@ MS_Usage()
     echo "    --bzip2            : Compress using bzip2 instead of gzip"
     echo "    --pbzip2           : Compress using pbzip2 instead of gzip"
     echo "    --xz               : Compress using xz instead of gzip"
+    echo "    --zstd             : Compress using zstd instead of gzip"
     echo "    --lzo              : Compress using lzop instead of gzip"
     echo "    --lz4              : Compress using lz4 instead of gzip"
     echo "    --compress         : Compress using the UNIX 'compress' command"
     echo "    --complevel lvl    : Compression level for gzip pigz xz lzo lz4 bzip2 and pbzip2 (default 9)"
+    echo "    --threads thds     : Number of threads used by pigz, xz and zstd (0 for all cores)"
     echo "    --base64           : Instead of compressing, encode the data using base64"
     echo "    --gpg-encrypt      : Instead of compressing, encrypt the data using GPG"
     echo "    --gpg-asymmetric-encrypt-sign"
@@ -172,6 +174,7 @@ PASSWD=""
 PASSWD_SRC=""
 OPENSSL_NO_MD=n
 COMPRESS_LEVEL=9
+THREADS=
 KEEP=n
 CURRENT=n
 NOX11=n
@@ -224,6 +227,10 @@ do
 	COMPRESS=xz
 	shift
 	;;
+    --zstd)
+	COMPRESS=zstd
+	shift
+	;;
     --lzo)
 	COMPRESS=lzo
 	shift
@@ -276,6 +283,10 @@ do
 	COMPRESS_LEVEL="$2"
 	if ! shift 2; then MS_Help; exit 1; fi
 	;;
+    --threads)
+	THREADS="$2"
+	if ! shift 2; then MS_Help; exit 1; fi
+	;;
     --notemp)
 	KEEP=y
 	shift
@@ -466,6 +477,9 @@ gzip)
     ;;
 pigz) 
     GZIP_CMD="pigz -$COMPRESS_LEVEL"
+    if test -n "$THREADS"; then
+        GZIP_CMD="$GZIP_CMD -p $THREADS"
+    fi
     GUNZIP_CMD="gzip -cd"
     ;;
 pbzip2)
@@ -478,8 +492,21 @@ bzip2)
     ;;
 xz)
     GZIP_CMD="xz -c$COMPRESS_LEVEL"
+    if test -n "$THREADS"; then
+        GZIP_CMD="$GZIP_CMD -T$THREADS"
+    fi
     GUNZIP_CMD="xz -d"
     ;;
+zstd)
+    GZIP_CMD="zstd -c -$COMPRESS_LEVEL"
+    if test "$COMPRESS_LEVEL" -gt 19; then
+        GZIP_CMD="$GZIP_CMD --ultra"
+    fi
+    if test -n "$THREADS"; then
+        GZIP_CMD="$GZIP_CMD -T$THREADS"
+    fi
+    GUNZIP_CMD="zstd -cd"
+    ;;
 lzo)
     GZIP_CMD="lzop -c$COMPRESS_LEVEL"
     GUNZIP_CMD="lzop -d"
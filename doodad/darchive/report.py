@@ -0,0 +1,200 @@
+"""
+Size and timing reports for archive builds.
+
+Pass a BuildReport (or a filename to write one to) to build_archive to see
+where the bytes and seconds of a build go:
+
+report = BuildReport()
+archive_builder_docker.build_archive(mounts=mounts, report=report)
+print(report.format())
+
+Saved reports can be pretty-printed with
+    python scripts/print_build_report.py report.json
+"""
+import os
+import json
+import heapq
+import argparse
+
+DEFAULT_TOP_N = 10
+
+
+class MountStats(object):
+    """
+    Bytes and files staged for a single mount.
+
+    Args:
+        mount (str): Mount description
+        top_n (int): Number of largest files to keep track of
+    """
+    def __init__(self, mount, top_n=DEFAULT_TOP_N):
+        self.mount = mount
+        self.top_n = top_n
+        self.files = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self._largest = []
+
+    def add(self, arcname, size):
+        self.files += 1
+        self.bytes += size
+        if len(self._largest) < self.top_n:
+            heapq.heappush(self._largest, (size, arcname))
+        elif size > self._largest[0][0]:
+            heapq.heapreplace(self._largest, (size, arcname))
+
+    def largest_files(self):
+        return sorted(self._largest, reverse=True)
+
+    def to_dict(self):
+        return {
+            'mount': self.mount,
+            'files': self.files,
+            'bytes': self.bytes,
+            'seconds': self.seconds,
+        }
+
+
+class RecordingStage(object):
+    """
+    Wraps an archive stage, recording every file added to it in a MountStats.
+    """
+    def __init__(self, stage, stats):
+        self.stage = stage
+        self.stats = stats
+
+    @property
+    def segments(self):
+        return self.stage.segments
+
+    def substage(self, dirname):
+        return RecordingStage(self.stage.substage(dirname), self.stats)
+
+    def add_segment(self, name, source):
+        self.segments.add(name, source,
+                          callback=lambda size: self.stats.add('%s.tar.gz' % name, size))
+
+    def makedirs(self, arcname):
+        self.stage.makedirs(arcname)
+
+    def add_file(self, filename, arcname, link=False):
+        self.stats.add(arcname, os.path.getsize(filename))
+        self.stage.add_file(filename, arcname, link=link)
+
+    def write_file(self, arcname, contents, mode=0o644):
+        self.stats.add(arcname, len(contents.encode('utf-8')))
+        self.stage.write_file(arcname, contents, mode=mode)
+
+
+class BuildReport(object):
+    """
+    A structured report of a single archive build.
+
+    Args:
+        top_n (int): Number of largest files to list
+    """
+    def __init__(self, top_n=DEFAULT_TOP_N):
+        self.top_n = top_n
+        self.mounts = []
+        self.timings = {}
+        self.archive = None
+        self.archive_bytes = 0
+        self.uncompressed_bytes = 0
+        self.deduplicated_bytes = 0
+        self.compression = None
+        self.writer = None
+        self.cached = False
+
+    def mount_stats(self, mnt):
+        stats = MountStats(str(mnt), top_n=self.top_n)
+        self.mounts.append(stats)
+        return stats
+
+    def largest_files(self):
+        """
+        Returns:
+            list: (size, mount, path) of the largest staged files, largest first
+        """
+        files = [(size, stats.mount, arcname) for stats in self.mounts
+                 for size, arcname in stats.largest_files()]
+        return sorted(files, reverse=True)[:self.top_n]
+
+    @property
+    def compression_ratio(self):
+        if not self.archive_bytes:
+            return None
+        return float(self.uncompressed_bytes) / self.archive_bytes
+
+    def to_dict(self):
+        return {
+            'archive': self.archive,
+            'archive_bytes': self.archive_bytes,
+            'uncompressed_bytes': self.uncompressed_bytes,
+            'deduplicated_bytes': self.deduplicated_bytes,
+            'compression_ratio': self.compression_ratio,
+            'compression': self.compression,
+            'writer': self.writer,
+            'cached': self.cached,
+            'timings': self.timings,
+            'mounts': [stats.to_dict() for stats in self.mounts],
+            'largest_files': [{'bytes': size, 'mount': mount, 'path': path}
+                              for size, mount, path in self.largest_files()],
+        }
+
+    def write(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+
+    def format(self):
+        return format_report(self.to_dict())
+
+
+def format_size(num_bytes):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(num_bytes) < 1024 or unit == 'GB':
+            break
+        num_bytes /= 1024.0
+    return '%.1f %s' % (num_bytes, unit) if unit != 'B' else '%d B' % num_bytes
+
+
+def format_report(report):
+    """
+    Pretty-print a report, as returned by BuildReport.to_dict()
+
+    Returns:
+        str
+    """
+    lines = ['Archive: %s%s' % (report['archive'], ' (cached)' if report['cached'] else '')]
+    lines.append('Writer: %s, compression: %s' % (report['writer'], report['compression']))
+    ratio = report['compression_ratio']
+    lines.append('Size: %s compressed, %s uncompressed, ratio %s' % (
+        format_size(report['archive_bytes']), format_size(report['uncompressed_bytes']),
+        '-' if ratio is None else '%.2f' % ratio))
+    if report.get('deduplicated_bytes'):
+        lines.append('Deduplicated: %s' % format_size(report['deduplicated_bytes']))
+    if report['timings']:
+        lines.append('')
+        lines.append('Timings:')
+        for step, seconds in sorted(report['timings'].items(), key=lambda item: -item[1]):
+            lines.append('  %-12s %8.2fs' % (step, seconds))
+    if report['mounts']:
+        lines.append('')
+        lines.append('Mounts:')
+        lines.append('  %10s %8s %8s  %s' % ('size', 'files', 'time', 'mount'))
+        for stats in sorted(report['mounts'], key=lambda stats: -stats['bytes']):
+            lines.append('  %10s %8d %7.2fs  %s' % (format_size(stats['bytes']), stats['files'],
+                                                   stats['seconds'], stats['mount']))
+    if report['largest_files']:
+        lines.append('')
+        lines.append('Largest files:')
+        for entry in report['largest_files']:
+            lines.append('  %10s  %s  (%s)' % (format_size(entry['bytes']), entry['path'], entry['mount']))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pretty-print an archive build report.')
+    parser.add_argument('report', type=str, help='Report JSON file written by build_archive')
+    args = parser.parse_args(argv)
+    with open(args.report) as f:
+        print(format_report(json.load(f)))
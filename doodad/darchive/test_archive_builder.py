@@ -3,9 +3,10 @@ import tempfile
 import os
 import os.path as path
 import shutil
+import subprocess
 
 from doodad import mount
-from doodad.darchive import archive_builder_docker
+from doodad.darchive import archive_builder_docker, archive_stage, layers
 from doodad.utils import TESTING_DIR, TESTING_OUTPUT_DIR
 
 
@@ -135,5 +136,154 @@ class TestDockerArchiveBuilder(unittest.TestCase):
         output = output.strip()
         self.assertEqual(output, 'hi --help')
 
+class TestStageMounts(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_parallel_staging(self):
+        mnts = []
+        for i in range(4):
+            local_dir = path.join(self.work_dir, 'code%d' % i)
+            os.makedirs(local_dir)
+            with open(path.join(local_dir, 'file.txt'), 'w') as f:
+                f.write(str(i))
+            mnts.append(mount.MountLocal(local_dir=local_dir, mount_point='./code%d' % i))
+        deps_dir = path.join(self.work_dir, 'deps')
+        os.makedirs(deps_dir)
+        times = archive_builder_docker.stage_mounts(mnts, deps_dir, workers=3)
+        self.assertEqual([mnt for mnt, _ in times], mnts)
+        for i, mnt in enumerate(mnts):
+            with open(path.join(deps_dir, 'local', mnt.name, 'file.txt')) as f:
+                self.assertEqual(f.read(), str(i))
+
+
+class TestCompression(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.local_dir = path.join(self.work_dir, 'code')
+        os.makedirs(self.local_dir)
+        with open(path.join(self.local_dir, 'file.txt'), 'w') as f:
+            f.write('hello' * 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_backends(self):
+        for compression in sorted(archive_builder_docker.COMPRESSION_BACKENDS):
+            binary = archive_builder_docker.COMPRESSION_BACKENDS[compression][1]
+            if binary is not None and archive_builder_docker.which(binary) is None:
+                continue
+            archive = path.join(self.work_dir, compression + '.dar')
+            archive_builder_docker.build_archive(archive_filename=archive,
+                                                 payload_script='echo hi',
+                                                 mounts=[mount.MountLocal(local_dir=self.local_dir,
+                                                                          mount_point='./code')],
+                                                 compression=compression,
+                                                 compression_level=1,
+                                                 compression_threads=2)
+            target = path.join(self.work_dir, compression)
+            subprocess.check_call(['sh', archive, '--quiet', '--noexec', '--target', target])
+            mnt_dir = os.listdir(path.join(target, 'deps', 'local'))[0]
+            with open(path.join(target, 'deps', 'local', mnt_dir, 'file.txt')) as f:
+                self.assertEqual(f.read(), 'hello' * 1000)
+
+    def test_compression_args(self):
+        self.assertEqual(archive_builder_docker.compression_args('none', level=5), '--nocomp')
+        self.assertEqual(archive_builder_docker.compression_args('gzip'), '--gzip --complevel 9')
+        with self.assertRaises(ValueError):
+            archive_builder_docker.compression_args('lzma')
+
+
+class TestExtract(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.local_dir = path.join(self.work_dir, 'code')
+        os.makedirs(path.join(self.local_dir, 'pkg'))
+        for fname in ['a.py', '.hidden', 'pkg/b.py']:
+            with open(path.join(self.local_dir, fname), 'w') as f:
+                f.write(fname)
+        self.mount = mount.MountLocal(local_dir=self.local_dir, mount_point='./mnt/code')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def _build_and_extract(self, **kwargs):
+        archive = path.join(self.work_dir, 'test.dar')
+        archive_builder_docker.build_archive(archive_filename=archive,
+                                             payload_script='echo hi',
+                                             mounts=[self.mount],
+                                             **kwargs)
+        target = path.join(self.work_dir, 'extracted')
+        subprocess.check_call(['sh', archive, '--quiet', '--noexec', '--target', target])
+        with open(path.join(target, 'deps', 'local', self.mount.name, 'extract.sh')) as f:
+            extract_script = f.read()
+        return archive, target, extract_script
+
+    def _assert_mounted(self, target):
+        mount_dir = path.join(target, 'mnt', 'code')
+        self.assertEqual(set(os.listdir(mount_dir)), {'a.py', '.hidden', 'pkg'})
+        with open(path.join(mount_dir, 'pkg', 'b.py')) as f:
+            self.assertEqual(f.read(), 'pkg/b.py')
+
+    def test_move(self):
+        archive, target, extract_script = self._build_and_extract()
+        subprocess.check_call(['bash', '-c', extract_script], cwd=target)
+        self._assert_mounted(target)
+
+    def test_direct_extract(self):
+        for kwargs in [{}, {'writer': 'makeself'},
+                       {'layer_cache': layers.LayerCache(path.join(self.work_dir, 'cache'))}]:
+            archive, target, extract_script = self._build_and_extract(direct_extract=True, **kwargs)
+            self.assertEqual(os.listdir(path.join(target, 'deps', 'local', self.mount.name)), ['extract.sh'])
+            with open(path.join(target, 'docker.sh')) as f:
+                self.assertIn(archive_stage.BUNDLE_PATH + ':ro', f.read())
+            extract_script = extract_script.replace(archive_stage.BUNDLE_PATH, archive)
+            subprocess.check_call(['bash', '-c', extract_script], cwd=target)
+            self._assert_mounted(target)
+            shutil.rmtree(target)
+
+
+class TestBindScript(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.local_dir = path.join(self.work_dir, 'code')
+        os.makedirs(self.local_dir)
+        # a stand-in for docker which prints its arguments
+        bin_dir = path.join(self.work_dir, 'bin')
+        os.makedirs(bin_dir)
+        with open(path.join(bin_dir, 'docker'), 'w') as f:
+            f.write('#!/bin/sh\necho "$@"\n')
+        os.chmod(path.join(bin_dir, 'docker'), 0o755)
+        self.env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ['PATH'])
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_bind_mounts(self):
+        mounts = [mount.MountLocal(local_dir=self.local_dir, mount_point='./code', pythonpath=True),
+                  mount.MountLocal(local_dir=path.join(self.work_dir, 'out'), mount_point='/out', output=True)]
+        script_dir = path.join(self.work_dir, 'script')
+        os.makedirs(script_dir)
+        script = archive_builder_docker.build_bind_script(script_dir, payload_script='echo hi',
+                                                          mounts=mounts)
+        output = subprocess.check_output(['sh', script, 'arg'], env=self.env).decode('utf-8').split()
+        self.assertIn('%s:/dar_payload/code:ro' % self.local_dir, output)
+        self.assertIn('%s:/out' % path.join(self.work_dir, 'out'), output)
+        self.assertIn('%s:/dar_script:ro' % script_dir, output)
+        self.assertEqual(output[-3:], ['/bin/bash', '/dar_script/run.sh', 'arg'])
+        with open(path.join(script_dir, 'run.sh')) as f:
+            run_script = f.read()
+        self.assertNotIn('extract.sh', run_script)
+        self.assertIn('export PYTHONPATH=$PYTHONPATH:./code', run_script)
+
+    def test_not_bindable(self):
+        mounts = [mount.MountLocal(local_dir=self.local_dir, mount_point='./code'),
+                  mount.MountGit(git_url='https://github.com/a/b.git', mount_point='./b')]
+        self.assertIsNone(archive_builder_docker.build_bind_script(self.work_dir, mounts=mounts))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,117 @@
+import unittest
+import tempfile
+import os
+import os.path as path
+import shutil
+
+from doodad import mount
+from doodad.darchive import archive_builder_docker, archive_cache
+
+
+class TestFileCache(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.cache = archive_cache.FileCache(path.join(self.work_dir, 'cache'),
+                                             max_size=20, suffix='.dar')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def _make_file(self, name, size):
+        fname = path.join(self.work_dir, name)
+        with open(fname, 'w') as f:
+            f.write('x' * size)
+        return fname
+
+    def test_put_get(self):
+        self.assertIsNone(self.cache.get('abc'))
+        self.cache.put('abc', self._make_file('a', 5))
+        with open(self.cache.get('abc')) as f:
+            self.assertEqual(f.read(), 'xxxxx')
+
+    def test_lru_eviction(self):
+        self.cache.put('a', self._make_file('a', 8))
+        self.cache.put('b', self._make_file('b', 8))
+        # touch 'a' so that 'b' becomes least recently used
+        os.utime(self.cache.path('b'), (0, 0))
+        self.cache.get('a')
+        self.cache.put('c', self._make_file('c', 8))
+        self.assertIsNotNone(self.cache.get('a'))
+        self.assertIsNone(self.cache.get('b'))
+        self.assertIsNotNone(self.cache.get('c'))
+        self.assertLessEqual(self.cache.size(), 20)
+
+
+class TestArchiveDigest(unittest.TestCase):
+    def setUp(self):
+        self.local_dir = tempfile.mkdtemp()
+        with open(path.join(self.local_dir, 'a.py'), 'w') as f:
+            f.write('print(1)')
+
+    def tearDown(self):
+        shutil.rmtree(self.local_dir)
+
+    def _digest(self, **kwargs):
+        mnts = [mount.MountLocal(local_dir=self.local_dir, mount_point='./code')]
+        return archive_cache.archive_digest(mnts, docker_image='python:3', **kwargs)
+
+    def test_stable(self):
+        self.assertEqual(self._digest(), self._digest())
+
+    def test_build_args(self):
+        self.assertNotEqual(self._digest(), self._digest(use_nvidia_docker=True))
+
+    def test_mount_contents(self):
+        digest = self._digest()
+        with open(path.join(self.local_dir, 'a.py'), 'w') as f:
+            f.write('print(12)')
+        self.assertNotEqual(digest, self._digest())
+
+    def test_ignored_files(self):
+        digest = self._digest()
+        with open(path.join(self.local_dir, 'a.pyc'), 'w') as f:
+            f.write('junk')
+        self.assertEqual(digest, self._digest())
+
+    def test_build_archive_hit(self):
+        cache = archive_cache.ArchiveCache(path.join(self.local_dir, '.cache'))
+        mnts = [mount.MountLocal(local_dir=self.local_dir, mount_point='./code',
+                                 filter_dir=('.cache',))]
+        contents = []
+        for _ in range(2):
+            with archive_builder_docker.temp_archive_file() as archive_file:
+                archive_builder_docker.build_archive(archive_filename=archive_file,
+                                                     payload_script='echo hello',
+                                                     mounts=mnts,
+                                                     cache=cache)
+                with open(archive_file, 'rb') as f:
+                    contents.append(f.read())
+        # METADATA contains a fresh uuid, so equal bytes mean the cache was used
+        self.assertEqual(contents[0], contents[1])
+        self.assertEqual(len(cache.entries()), 1)
+
+    def test_build_archive_hit_then_miss(self):
+        cache = archive_cache.ArchiveCache(path.join(self.local_dir, '.cache'))
+        mnts = [mount.MountLocal(local_dir=self.local_dir, mount_point='./code',
+                                 filter_dir=('.cache',))]
+        out_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, out_dir)
+        for writer in ['native', 'makeself']:
+            cache.clear()
+            def build(filename, payload_script):
+                archive_builder_docker.build_archive(archive_filename=path.join(out_dir, filename),
+                                                     payload_script=payload_script,
+                                                     mounts=mnts, cache=cache, writer=writer)
+                with open(path.join(out_dir, filename), 'rb') as f:
+                    return f.read()
+            first = build('out1.dar', 'echo hello')
+            # a hit, which may hardlink out.dar to the cache entry
+            self.assertEqual(build('out.dar', 'echo hello'), first)
+            # a miss building to the same path must not overwrite the entry
+            self.assertNotEqual(build('out.dar', 'echo goodbye'), first)
+            self.assertEqual(build('out2.dar', 'echo hello'), first)
+            self.assertEqual(len(cache.entries()), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,209 @@
+import unittest
+import tempfile
+import os
+import os.path as path
+import re
+import shutil
+import subprocess
+
+from doodad import mount
+from doodad.darchive import archive_builder_docker, archive_stage, dar_writer
+
+
+class TestRenderHeader(unittest.TestCase):
+    def test_matches_makeself(self):
+        with archive_builder_docker.temp_archive_file() as archive_file:
+            archive_builder_docker.build_archive(archive_filename=archive_file,
+                                                 payload_script='echo hi',
+                                                 compression='gzip',
+                                                 writer='makeself')
+            with open(archive_file, 'rb') as f:
+                archive = f.read().decode('latin-1')
+        skip = int(re.search(r'head -n (\d+)', archive).group(1))
+        expected = ''.join(archive.splitlines(True)[:skip])
+
+        variables = dar_writer.header_variables('gzip')
+        variables.update(
+            SKIP=skip,
+            filesizes=re.search(r'filesizes="(\d+)"', expected).group(1),
+            USIZE=re.search(r'Uncompressed size: (\d+) KB', expected).group(1),
+            DATE=re.search(r'Date of packaging: (.*)', expected).group(1),
+        )
+        # the build command and platform legitimately differ
+        strip = lambda header: re.sub(r'Built with .*?\n\tif test x"\$script"', '', header, flags=re.S)
+        self.assertEqual(strip(dar_writer.render_header(variables)), strip(expected))
+
+
+class TestWriteArchive(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.local_dir = path.join(self.work_dir, 'code')
+        os.makedirs(path.join(self.local_dir, 'pkg'))
+        for fname in ['a.py', 'pkg/b.py', 'c.pyc']:
+            with open(path.join(self.local_dir, fname), 'w') as f:
+                f.write(fname)
+        self.mounts = [mount.MountLocal(local_dir=self.local_dir, mount_point='./code')]
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def _extract(self, archive, name):
+        target = path.join(self.work_dir, name)
+        subprocess.check_call(['sh', archive, '--quiet', '--noexec', '--target', target])
+        contents = set()
+        for dirname, dirs, files in os.walk(target):
+            for fname in dirs + files:
+                contents.add(path.relpath(path.join(dirname, fname), target))
+        return target, contents
+
+    def test_same_contents_as_makeself(self):
+        contents = {}
+        for writer in ['native', 'makeself']:
+            archive = path.join(self.work_dir, writer + '.dar')
+            archive_builder_docker.build_archive(archive_filename=archive,
+                                                 payload_script='echo hi',
+                                                 mounts=self.mounts,
+                                                 writer=writer)
+            _, contents[writer] = self._extract(archive, writer)
+        self.assertEqual(contents['native'], contents['makeself'])
+
+    def test_run_script(self):
+        archive = path.join(self.work_dir, 'test.dar')
+        timings = {}
+        archive_builder_docker.build_archive(archive_filename=archive,
+                                             payload_script='cat ./code/pkg/b.py',
+                                             mounts=self.mounts,
+                                             timings=timings)
+        self.assertEqual(set(timings), {'staging', 'staging_compress', 'payload', 'compress', 'header'})
+        target, _ = self._extract(archive, 'extracted')
+        output = subprocess.check_output(['bash', './run.sh'], cwd=target)
+        self.assertEqual(output.decode('utf-8'), 'pkg/b.py')
+
+    def test_parallel_staging(self):
+        other_dir = path.join(self.work_dir, 'data')
+        os.makedirs(path.join(other_dir, 'sub'))
+        with open(path.join(other_dir, 'sub', 'd.txt'), 'w') as f:
+            f.write('d')
+        mounts = self.mounts + [mount.MountLocal(local_dir=other_dir, mount_point='./data')]
+        contents = {}
+        for workers in [1, 2]:
+            archive = path.join(self.work_dir, '%d.dar' % workers)
+            staging_times = []
+            archive_builder_docker.build_archive(archive_filename=archive,
+                                                 payload_script='echo hi',
+                                                 mounts=mounts,
+                                                 staging_workers=workers,
+                                                 staging_times=staging_times)
+            self.assertEqual([mnt for mnt, _ in staging_times], mounts)
+            _, contents[workers] = self._extract(archive, str(workers))
+        self.assertIn(path.join('deps', 'local', mounts[1].name, 'sub', 'd.txt'), contents[2])
+        self.assertEqual(contents[1], contents[2])
+
+    def test_compression(self):
+        for compression in ['none', 'gzip', 'xz', 'zstd']:
+            if compression in ('xz', 'zstd') and archive_builder_docker.which(compression) is None:
+                continue
+            archive = path.join(self.work_dir, compression + '.dar')
+            archive_builder_docker.build_archive(archive_filename=archive,
+                                                 payload_script='echo hi',
+                                                 mounts=self.mounts,
+                                                 compression=compression)
+            _, contents = self._extract(archive, compression)
+            self.assertIn('run.sh', contents)
+            self.assertIn(path.join('deps', 'local', self.mounts[0].name, 'pkg', 'b.py'), contents)
+
+
+class TestDedupe(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        data = os.urandom(200000)
+        for dirname in ['repo/pkg', 'assets']:
+            os.makedirs(path.join(self.work_dir, dirname))
+        for fname in ['repo/pkg/model.bin', 'assets/model.bin']:
+            with open(path.join(self.work_dir, fname), 'wb') as f:
+                f.write(data)
+        with open(path.join(self.work_dir, 'repo', 'pkg', 'other.bin'), 'wb') as f:
+            f.write(os.urandom(200000))
+        # overlapping mounts, and an identical copy of a file in a third
+        self.mounts = [
+            mount.MountLocal(local_dir=path.join(self.work_dir, 'repo'), mount_point='./repo'),
+            mount.MountLocal(local_dir=path.join(self.work_dir, 'repo', 'pkg'), mount_point='./pkg'),
+            mount.MountLocal(local_dir=path.join(self.work_dir, 'assets'), mount_point='./assets'),
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_content_index(self):
+        index = archive_stage.ContentIndex()
+        model = path.join(self.work_dir, 'repo', 'pkg', 'model.bin')
+        self.assertIsNone(index.find(model, 'a'))
+        self.assertIsNone(index.find(path.join(self.work_dir, 'repo', 'pkg', 'other.bin'), 'b'))
+        self.assertEqual(index.find(model, 'c'), 'a')
+        self.assertEqual(index.find(path.join(self.work_dir, 'assets', 'model.bin'), 'd'), 'a')
+        self.assertEqual(index.saved_bytes, 400000)
+
+    def test_dedupe(self):
+        for writer in ['native', 'makeself']:
+            sizes = {}
+            for dedupe in [False, True]:
+                archive = path.join(self.work_dir, '%s_%s.dar' % (writer, dedupe))
+                archive_builder_docker.build_archive(archive_filename=archive,
+                                                     payload_script='echo hi',
+                                                     mounts=self.mounts,
+                                                     compression='gzip',
+                                                     writer=writer,
+                                                     staging_workers=3,
+                                                     dedupe=dedupe)
+                sizes[dedupe] = os.path.getsize(archive)
+            # two distinct 200KB files of random data
+            self.assertLess(sizes[True], 450000)
+            self.assertGreater(sizes[False], sizes[True])
+
+            target = path.join(self.work_dir, writer)
+            subprocess.check_call(['sh', archive, '--quiet', '--noexec', '--target', target])
+            models = [path.join(target, 'deps', 'local', mnt.name, fname)
+                      for mnt, fname in zip(self.mounts, ['pkg/model.bin', 'model.bin', 'model.bin'])]
+            with open(path.join(self.work_dir, 'assets', 'model.bin'), 'rb') as f:
+                data = f.read()
+            for model in models:
+                with open(model, 'rb') as f:
+                    self.assertEqual(f.read(), data)
+
+    def test_same_directory_twice(self):
+        assets = path.join(self.work_dir, 'assets')
+        mounts = [mount.MountLocal(local_dir=assets, mount_point='./assets'),
+                  mount.MountLocal(local_dir=assets, mount_point='./more/assets')]
+        self.assertNotEqual(mounts[0].name, mounts[1].name)
+        for writer in ['native', 'makeself']:
+            archive = path.join(self.work_dir, writer + '.dar')
+            archive_builder_docker.build_archive(archive_filename=archive,
+                                                 payload_script='echo hi',
+                                                 mounts=mounts,
+                                                 compression='gzip',
+                                                 writer=writer,
+                                                 dedupe=True)
+            # a single copy of 200KB of random data
+            self.assertLess(os.path.getsize(archive), 250000)
+            target = path.join(self.work_dir, writer)
+            subprocess.check_call(['sh', archive, '--quiet', '--noexec', '--target', target])
+            for mnt in mounts:
+                subprocess.check_call(['bash', path.join('deps', 'local', mnt.name, 'extract.sh')], cwd=target)
+            for mount_point in ['assets', 'more/assets']:
+                self.assertEqual(os.listdir(path.join(target, mount_point)), ['model.bin'])
+        with self.assertRaises(ValueError):
+            archive_builder_docker.build_archive(archive_filename=path.join(self.work_dir, 'twice.dar'),
+                                                 payload_script='echo hi',
+                                                 mounts=[mounts[0], mounts[0]])
+
+    def test_direct_extract_warns(self):
+        with self.assertWarns(UserWarning):
+            archive_builder_docker.build_archive(archive_filename=path.join(self.work_dir, 'direct.dar'),
+                                                 payload_script='echo hi',
+                                                 mounts=self.mounts,
+                                                 dedupe=True,
+                                                 direct_extract=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
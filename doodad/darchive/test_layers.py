@@ -0,0 +1,95 @@
+import unittest
+import tempfile
+import os
+import os.path as path
+import shutil
+import subprocess
+import tarfile
+
+from doodad import mount
+from doodad.darchive import archive_builder_docker, layers
+
+
+class TestLayers(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.local_dir = path.join(self.work_dir, 'code')
+        os.makedirs(path.join(self.local_dir, 'pkg'))
+        os.makedirs(path.join(self.local_dir, 'empty'))
+        for fname in ['a.py', '.hidden', 'pkg/b.py', 'c.pyc']:
+            with open(path.join(self.local_dir, fname), 'w') as f:
+                f.write(fname)
+        self.mount = mount.MountLocal(local_dir=self.local_dir, mount_point='./code')
+        self.cache = layers.LayerCache(path.join(self.work_dir, 'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_manifest_digest(self):
+        digest = layers.manifest_digest(self.mount.manifest())
+        self.assertEqual(digest, layers.manifest_digest(self.mount.manifest()))
+        with open(path.join(self.local_dir, 'pkg', 'b.py'), 'w') as f:
+            f.write('changed!')
+        self.assertNotEqual(digest, layers.manifest_digest(self.mount.manifest()))
+
+    def test_hash_contents(self):
+        hashed = mount.MountLocal(local_dir=self.local_dir, hash_contents=True)
+        fname = path.join(self.local_dir, 'a.py')
+        stat = os.stat(fname)
+        digest = layers.manifest_digest(self.mount.manifest())
+        hashed_digest = layers.manifest_digest(hashed.manifest())
+        # same size and mtime, different contents
+        with open(fname, 'w') as f:
+            f.write('b.py')
+        os.utime(fname, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self.assertEqual(digest, layers.manifest_digest(self.mount.manifest()))
+        self.assertNotEqual(hashed_digest, layers.manifest_digest(hashed.manifest()))
+
+    def test_pack_layer(self):
+        expected = {'a.py', '.hidden', 'pkg', 'pkg/b.py', 'empty'}
+        # uncompressed, as the archive compresses it
+        with tarfile.open(self.cache.get_layer(self.mount), 'r:') as tar:
+            self.assertEqual(set(tar.getnames()), expected)
+        with tarfile.open(self.cache.get_layer(self.mount, compress=True), 'r:gz') as tar:
+            self.assertEqual(set(tar.getnames()), expected)
+        self.assertEqual(len(self.cache.entries()), 2)
+
+    def test_layer_key(self):
+        copy_dir = path.join(self.work_dir, 'copy')
+        # copytree keeps mtimes, so the manifests match
+        shutil.copytree(self.local_dir, copy_dir)
+        copy = mount.MountLocal(local_dir=copy_dir, mount_point='./code')
+        self.assertEqual(self.mount.manifest(), copy.manifest())
+        self.assertNotEqual(self.cache.get_layer(self.mount), self.cache.get_layer(copy))
+        # with hashed contents, identical directories share a layer
+        hashed = mount.MountLocal(local_dir=self.local_dir, hash_contents=True)
+        hashed_copy = mount.MountLocal(local_dir=copy_dir, hash_contents=True)
+        self.assertEqual(self.cache.get_layer(hashed), self.cache.get_layer(hashed_copy))
+
+    def test_layer_reused(self):
+        layer = self.cache.get_layer(self.mount)
+        inode = os.stat(layer).st_ino
+        self.assertEqual(layer, self.cache.get_layer(self.mount))
+        self.assertEqual(inode, os.stat(layer).st_ino)
+        self.assertEqual(len(self.cache.entries()), 1)
+        with open(path.join(self.local_dir, 'new.py'), 'w') as f:
+            f.write('new')
+        self.assertNotEqual(layer, self.cache.get_layer(self.mount))
+        self.assertEqual(len(self.cache.entries()), 2)
+
+    def test_build_archive(self):
+        archive = path.join(self.work_dir, 'test.dar')
+        archive_builder_docker.build_archive(archive_filename=archive,
+                                             payload_script='echo hi',
+                                             mounts=[self.mount],
+                                             layer_cache=self.cache)
+        target = path.join(self.work_dir, 'extracted')
+        subprocess.check_call(['sh', archive, '--quiet', '--noexec', '--target', target])
+        dep_dir = path.join(target, 'deps', 'local', self.mount.name)
+        self.assertEqual(set(os.listdir(dep_dir)), {'layer.tar', 'extract.sh'})
+        with open(path.join(dep_dir, 'extract.sh')) as f:
+            self.assertIn('tar -xf', f.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
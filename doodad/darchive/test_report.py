@@ -0,0 +1,59 @@
+import unittest
+import tempfile
+import os
+import os.path as path
+import json
+import shutil
+
+from doodad import mount
+from doodad.darchive import archive_builder_docker, report
+
+
+class TestBuildReport(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.mounts = []
+        for i, size in enumerate([1000, 100000]):
+            local_dir = path.join(self.work_dir, 'code%d' % i)
+            os.makedirs(local_dir)
+            for j in range(3):
+                with open(path.join(local_dir, 'file%d.txt' % j), 'w') as f:
+                    f.write('x' * size * (j + 1))
+            self.mounts.append(mount.MountLocal(local_dir=local_dir, mount_point='./code%d' % i))
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def _build(self, build_report, **kwargs):
+        archive_builder_docker.build_archive(archive_filename=path.join(self.work_dir, 'test.dar'),
+                                             payload_script='echo hi',
+                                             mounts=self.mounts,
+                                             report=build_report,
+                                             **kwargs)
+
+    def test_report(self):
+        for writer in ['native', 'makeself']:
+            build_report = report.BuildReport(top_n=2)
+            self._build(build_report, writer=writer)
+            # three files and an extract script per mount
+            self.assertEqual([stats.files for stats in build_report.mounts], [4, 4])
+            self.assertEqual(build_report.mounts[1].bytes - build_report.mounts[0].bytes, 6 * 99000)
+            self.assertEqual([(size, name) for size, _, name in build_report.largest_files()],
+                             [(300000, path.join('local', self.mounts[1].name, 'file2.txt')),
+                              (200000, path.join('local', self.mounts[1].name, 'file1.txt'))])
+            self.assertGreater(build_report.compression_ratio, 1)
+            self.assertIn('staging', build_report.timings)
+            self.assertIn('makeself' if writer == 'makeself' else 'compress', build_report.timings)
+
+    def test_write_report(self):
+        report_file = path.join(self.work_dir, 'report.json')
+        self._build(report_file)
+        with open(report_file) as f:
+            data = json.load(f)
+        self.assertEqual(len(data['mounts']), 2)
+        self.assertEqual(data['archive_bytes'], os.path.getsize(path.join(self.work_dir, 'test.dar')))
+        self.assertIn('Largest files:', report.format_report(data))
+
+
+if __name__ == '__main__':
+    unittest.main()
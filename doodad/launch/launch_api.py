@@ -9,6 +9,8 @@ result = launch_api.run_command(
 )
 """
 import os
+import shutil
+import tempfile
 
 from doodad.darchive import archive_builder_docker as archive_builder
 from doodad import mount
@@ -22,7 +24,14 @@ def run_command(
         mounts=tuple(),
         return_output=False,
         verbose=False,
-        docker_image='ubuntu:18.04'
+        docker_image='ubuntu:18.04',
+        is_docker_interactive=False,
+        archive_cache=None,
+        layer_cache=None,
+        staging_workers=1,
+        compression=None,
+        dedupe=False,
+        direct_extract=False,
     ):
     """
     Runs a shell command using doodad via a specified launch mode.
@@ -34,18 +43,58 @@ def run_command(
         mounts (tuple): A list/tuple of Mount objects
         return_output (bool): If True, returns stdout as a string.
             Do not use if the output will be large.
+        verbose (bool): Print the commands run
+        docker_image (str): Name of docker image
+        is_docker_interactive (bool): Run the container with a terminal
+            attached to stdin (docker run -it)
+        archive_cache (ArchiveCache): Reuse previously built archives
+            if the mounts and command have not changed.
+        layer_cache (LayerCache): Pack read-only local mounts into
+            separately cached layers.
+        staging_workers (int): Number of mounts to stage concurrently
+            when building the archive.
+        compression (str): Archive compression, one of 'none', 'gzip',
+            'pigz', 'zstd' or 'xz'. Defaults to pigz if installed, else gzip.
+        dedupe (bool): Store files with identical contents in the archive once.
+        direct_extract (bool): Extract read-only local mounts inside the
+            container straight from the archive file to their mount points.
     
     Returns:
         A string output if return_output is True,
         else None
     """
+    if isinstance(mode, launch_mode.LocalMode) and mode.bind_mounts:
+        script_dir = tempfile.mkdtemp()
+        try:
+            script = archive_builder.build_bind_script(script_dir,
+                                                       payload_script=command,
+                                                       docker_image=docker_image,
+                                                       is_docker_interactive=is_docker_interactive,
+                                                       use_nvidia_docker=mode.use_gpu,
+                                                       mounts=mounts,
+                                                       verbose=verbose)
+            if script is not None:
+                cmd = script
+                if cli_args:
+                    cmd = script + ' ' + cli_args
+                return mode.run_script(cmd, return_output=return_output, verbose=verbose)
+        finally:
+            shutil.rmtree(script_dir)
+
     with archive_builder.temp_archive_file() as archive_file:
         archive = archive_builder.build_archive(archive_filename=archive_file,
                                                 payload_script=command,
                                                 verbose=False, 
                                                 docker_image=docker_image,
+                                                is_docker_interactive=is_docker_interactive,
                                                 use_nvidia_docker=mode.use_gpu,
-                                                mounts=mounts)
+                                                mounts=mounts,
+                                                cache=archive_cache,
+                                                layer_cache=layer_cache,
+                                                staging_workers=staging_workers,
+                                                compression=compression,
+                                                dedupe=dedupe,
+                                                direct_extract=direct_extract)
         cmd = archive
         if cli_args:
             cmd = archive + ' -- ' + cli_args
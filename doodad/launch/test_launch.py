@@ -1,7 +1,10 @@
 import unittest
+import os
 import os.path as path
+import shutil
 import tempfile
 import contextlib
+from unittest import mock
 
 from doodad import mode, mount
 from doodad.launch import launch_api
@@ -99,5 +102,37 @@ class TestLaunchAPI(unittest.TestCase):
         self.assertEqual(result.strip(), 'hello123')
 
 
+class TestBindMounts(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.local_dir = path.join(self.work_dir, 'code')
+        os.makedirs(self.local_dir)
+        # a stand-in for docker which prints its arguments
+        bin_dir = path.join(self.work_dir, 'bin')
+        os.makedirs(bin_dir)
+        with open(path.join(bin_dir, 'docker'), 'w') as f:
+            f.write('#!/bin/sh\necho "$@"\n')
+        os.chmod(path.join(bin_dir, 'docker'), 0o755)
+        self.path = bin_dir + os.pathsep + os.environ['PATH']
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def run_command(self, **kwargs):
+        with mock.patch.dict(os.environ, PATH=self.path):
+            return launch_api.run_command(
+                'echo hello123',
+                mode=mode.LocalMode(bind_mounts=True),
+                mounts=[mount.MountLocal(local_dir=self.local_dir, mount_point='./code')],
+                return_output=True,
+                **kwargs)
+
+    def test_interactive(self):
+        self.assertIn('-t', self.run_command().split())
+        output = self.run_command(is_docker_interactive=True, verbose=True)
+        self.assertIn('-it', output.split())
+        self.assertIn('Docker command:', output)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -6,9 +6,14 @@ import six
 import base64
 import pprint
 import shlex
+import threading
+import contextlib
+import collections
+from concurrent import futures
 
 from doodad.utils import shell
 from doodad.utils import safe_import
+from doodad.utils import retry
 from doodad.apis.ec2.autoconfig import Autoconfig
 from doodad.credentials.ec2 import AWSCredentials
 
@@ -18,7 +23,7 @@ googleapiclient = safe_import.try_import('googleapiclient')
 googleapiclient.discovery = safe_import.try_import('googleapiclient.discovery')
 boto3 = safe_import.try_import('boto3')
 botocore = safe_import.try_import('botocore')
-from doodad.apis import gcp_util, aws_util, azure_util
+from doodad.apis import gcp_util, aws_util, azure_util, upload_util
 
 
 def _remove_duplicates(lst):
@@ -72,9 +77,16 @@ class LaunchMode(object):
 class LocalMode(LaunchMode):
     """
     A LocalMode executes commands locally using the host computer's shell interpreter.
+
+    Args:
+        bind_mounts (bool): If True, launch_api.run_command bind-mounts
+            read-only local mounts into the container rather than building
+            an archive. Mount filters do not apply to bind-mounted
+            directories, and they are read-only inside the container.
     """
-    def __init__(self, **kwargs):
+    def __init__(self, bind_mounts=False, **kwargs):
         super(LocalMode, self).__init__(**kwargs)
+        self.bind_mounts = bind_mounts
 
     def __str__(self):
         return 'LocalMode'
@@ -109,6 +121,7 @@ class EC2Mode(LaunchMode):
                  iam_instance_profile_name='doodad',
                  swap_size=4096,
                  tag_exp_name='doodad_experiment',
+                 s3_transfer_config=None,
                  **kwargs):
         super(EC2Mode, self).__init__(**kwargs)
         self.credentials = ec2_credentials
@@ -130,6 +143,8 @@ class EC2Mode(LaunchMode):
         self.security_group_ids = security_group_ids
         self.swap_size = swap_size
         self.sync_interval = 15
+        self._batch = None
+        self.s3_transfer_config = s3_transfer_config
 
     def dedent(self, s):
         lines = [l.strip() for l in s.split('\n')]
@@ -139,6 +154,10 @@ class EC2Mode(LaunchMode):
         if return_output:
             raise ValueError("Cannot return output for AWS scripts.")
 
+        cmd_split = shlex.split(script_name)
+        script_name = cmd_split[0]
+        script_args = ' '.join(cmd_split[1:])
+
         default_config = dict(
             image_id=self.image_id,
             instance_type=self.instance_type,
@@ -157,7 +176,6 @@ class EC2Mode(LaunchMode):
         stdout_log_s3_path = os.path.join(s3_base_dir, 'stdout_$EC2_INSTANCE_ID.log')
 
         sio = six.StringIO()
-        sio.write("#!/bin/bash\n")
         sio.write("truncate -s 0 /tmp/user_data.log\n")
         sio.write("{\n")
         sio.write("echo hello!\n")
@@ -189,12 +207,13 @@ class EC2Mode(LaunchMode):
         """)
 
         # 1) Upload script and download it to remote
-        script_split = os.path.split(script_name)[-1]
-        aws_util.s3_upload(script_name, self.s3_bucket, os.path.join('doodad/mount', script_split), dry=dry)
-        script_s3_filename = 's3://{bucket_name}/doodad/mount/{script_name}'.format(
-            bucket_name=self.s3_bucket,
-            script_name=script_split
-        )
+        script_s3_filename = upload_util.upload_once(
+            ('s3', self.s3_bucket), script_name,
+            lambda remote_filename: aws_util.s3_upload(script_name, self.s3_bucket,
+                                                       os.path.join('doodad/mount', remote_filename), dry=dry,
+                                                       credentials=self.credentials,
+                                                       config=self.s3_transfer_config),
+            dry=dry)
         sio.write('aws s3 cp --region {region} {script_s3_filename} /tmp/remote_script.sh\n'.format(
             region=self.region,
             script_s3_filename=script_s3_filename
@@ -273,7 +292,7 @@ class EC2Mode(LaunchMode):
             sio.write("echo 'Testing nvidia-smi inside docker'\n")
             sio.write("nvidia-docker run --rm {docker_image} nvidia-smi\n".format(docker_image=self.docker_image))
 
-        docker_cmd = '%s /tmp/remote_script.sh' % self.shell_interpreter
+        docker_cmd = '%s /tmp/remote_script.sh $DOODAD_SCRIPT_ARGS' % self.shell_interpreter
         sio.write(docker_cmd+'\n')
 
         # Sync all output mounts to s3 after running the user script
@@ -297,29 +316,16 @@ class EC2Mode(LaunchMode):
             """.format(aws_region=self.region))
         sio.write("} >> /tmp/user_data.log 2>&1\n")
 
-        full_script = self.dedent(sio.getvalue())
-        ec2 = boto3.client(
-            "ec2",
-            region_name=self.region,
-            aws_access_key_id=self.credentials.aws_key,
-            aws_secret_access_key=self.credentials.aws_secret_key,
-        )
+        # the script arguments are set at the top of the user data
+        # (see user_data), so jobs which only differ in their arguments
+        # can share a launch specification
+        script_body = self.dedent(sio.getvalue())
+        if self._batch is not None:
+            self._batch.add(script_body, script_args, aws_config)
+            return
 
-        user_data = full_script
-        instance_args = dict(
-            ImageId=aws_config["image_id"],
-            KeyName=aws_config["key_name"],
-            UserData=user_data,
-            InstanceType=aws_config["instance_type"],
-            EbsOptimized=False,
-            SecurityGroups=aws_config["security_groups"],
-            SecurityGroupIds=aws_config["security_group_ids"],
-            NetworkInterfaces=aws_config["network_interfaces"],
-            IamInstanceProfile=dict(
-                Name=aws_config["iam_instance_profile_name"],
-            ),
-            #**config.AWS_EXTRA_CONFIGS,
-        )
+        user_data = self.user_data(script_body, [script_args])
+        instance_args = self.launch_specification(aws_config, user_data)
 
         if verbose:
             print("************************************************************")
@@ -331,29 +337,196 @@ class EC2Mode(LaunchMode):
             InstanceCount=1,
             LaunchSpecification=instance_args,
             SpotPrice=str(aws_config["spot_price"]),
+            TagSpecifications=[self._tag_specification('spot-instances-request')],
             # ClientToken=params_list[0]["exp_name"],
         )
 
         if verbose:
             pprint.pprint(spot_args)
         if not dry:
-            response = ec2.request_spot_instances(**spot_args)
+            ec2 = aws_util.ec2_client(self.region, credentials=self.credentials)
+            response = aws_util.retry_throttled(lambda: ec2.request_spot_instances(**spot_args))
             print('Launched EC2 job - Server response:')
             pprint.pprint(response)
             print('*****'*5)
-            spot_request_id = response['SpotInstanceRequests'][
-                0]['SpotInstanceRequestId']
-            for _ in range(10):
+
+    @contextlib.contextmanager
+    def batch_launch(self, batch_size=None, dry=False):
+        """
+        Collect the jobs launched by run_script within this context, and
+        launch them together on exit.
+
+        Jobs which only differ in their script arguments share a launch
+        specification, and up to batch_size of them are launched by a single
+        multi-instance spot request (run_instances with MinCount=1). Each
+        instance picks its job's arguments by its ami-launch-index, and jobs
+        left out of a partially filled request are requested again.
+
+        Args:
+            batch_size (int): Maximum number of instances per request.
+                Defaults to EC2LaunchBatch.MAX_BATCH_SIZE. Requests are also
+                split to keep the user data under the 16KB EC2 limit.
+            dry (bool): If True, the requests are validated by EC2
+                (DryRun=True) but no instances are launched.
+
+        Yields:
+            EC2LaunchBatch
+        """
+        batch = EC2LaunchBatch(self, batch_size=batch_size, dry=dry)
+        self._batch = batch
+        try:
+            yield batch
+        finally:
+            self._batch = None
+        batch.submit()
+
+    def user_data(self, script_body, script_args):
+        """
+        The user data for instances running script_body, with the i-th
+        instance launched by a request running with script_args[i].
+        """
+        sio = six.StringIO()
+        sio.write("#!/bin/bash\n")
+        if len(script_args) == 1:
+            sio.write('DOODAD_SCRIPT_ARGS=%s\n' % shlex.quote(script_args[0]))
+        else:
+            sio.write('EC2_LAUNCH_INDEX="`wget -q -O - http://169.254.169.254/latest/meta-data/ami-launch-index`"\n')
+            sio.write('case "$EC2_LAUNCH_INDEX" in\n')
+            for i, args in enumerate(script_args):
+                sio.write('%d) DOODAD_SCRIPT_ARGS=%s;;\n' % (i, shlex.quote(args)))
+            sio.write('esac\n')
+        sio.write(script_body)
+        return sio.getvalue()
+
+    def launch_specification(self, aws_config, user_data):
+        return dict(
+            ImageId=aws_config["image_id"],
+            KeyName=aws_config["key_name"],
+            UserData=user_data,
+            InstanceType=aws_config["instance_type"],
+            EbsOptimized=False,
+            SecurityGroups=aws_config["security_groups"],
+            SecurityGroupIds=aws_config["security_group_ids"],
+            NetworkInterfaces=aws_config["network_interfaces"],
+            IamInstanceProfile=dict(
+                Name=aws_config["iam_instance_profile_name"],
+            ),
+            #**config.AWS_EXTRA_CONFIGS,
+        )
+
+    def _tag_specification(self, resource_type):
+        return {
+            'ResourceType': resource_type,
+            'Tags': [{'Key': 'Name', 'Value': self.tag_exp_name}],
+        }
+
+
+class EC2LaunchBatch(object):
+    """
+    Jobs collected by EC2Mode.batch_launch, to be launched together.
+
+    After submit(), reservations lists the run_instances responses,
+    instances lists (job script arguments, instance description) for every
+    launched job, and errors lists (job script arguments, exception) for
+    every job which could not be launched.
+
+    Spot requests ask for MinCount=1, so they are filled as far as capacity
+    allows. Each launched instance is mapped back to its job by its
+    AmiLaunchIndex, and the jobs left out are requested again until a
+    request fails.
+    """
+    MAX_BATCH_SIZE = 100
+    # EC2 limits user data to 16KB before base64 encoding
+    MAX_USER_DATA_SIZE = 16384
+
+    def __init__(self, mode, batch_size=None, dry=False):
+        self.mode = mode
+        self.batch_size = batch_size or self.MAX_BATCH_SIZE
+        self.dry = dry
+        self.groups = collections.OrderedDict()
+        self.reservations = []
+        self.instances = []
+        self.errors = []
+        self._lock = threading.Lock()
+
+    def __deepcopy__(self, memo):
+        # copies of the mode (e.g. one per job of a concurrent sweep)
+        # add to the same batch
+        return self
+
+    def __len__(self):
+        return sum(len(args) for _, args in self.groups.values())
+
+    def add(self, script_body, script_args, aws_config):
+        key = (script_body, json.dumps(aws_config, sort_keys=True))
+        with self._lock:
+            self.groups.setdefault(key, (aws_config, []))[1].append(script_args)
+
+    def requests(self):
+        """
+        Yields:
+            (dict, list): Keyword arguments to run_instances, and the script
+                arguments of the job each instance runs
+        """
+        for script_body, aws_config, chunk in self._chunks():
+            yield self._request(script_body, aws_config, chunk), chunk
+
+    def _chunks(self):
+        for (script_body, _), (aws_config, all_args) in self.groups.items():
+            chunk = []
+            for args in all_args:
+                if chunk and (len(chunk) >= self.batch_size or len(self.mode.user_data(
+                        script_body, chunk + [args]).encode()) > self.MAX_USER_DATA_SIZE):
+                    yield script_body, aws_config, chunk
+                    chunk = []
+                chunk.append(args)
+            if chunk:
+                yield script_body, aws_config, chunk
+
+    def _request(self, script_body, aws_config, script_args):
+        spec = self.mode.launch_specification(aws_config, self.mode.user_data(script_body, script_args))
+        request = {key: value for key, value in spec.items() if value not in (None, [])}
+        spot_options = {'SpotInstanceType': 'one-time'}
+        if aws_config['spot_price']:
+            spot_options['MaxPrice'] = str(aws_config['spot_price'])
+        request.update(
+            DryRun=self.dry,
+            MinCount=1,
+            MaxCount=len(script_args),
+            InstanceMarketOptions={'MarketType': 'spot', 'SpotOptions': spot_options},
+            TagSpecifications=[self.mode._tag_specification('instance'),
+                               self.mode._tag_specification('spot-instances-request')],
+        )
+        return request
+
+    def submit(self):
+        """ Launch every collected job """
+        if not self.groups:
+            return
+        ec2 = aws_util.ec2_client(self.mode.region, credentials=self.mode.credentials)
+        for script_body, aws_config, script_args in self._chunks():
+            # every successful request launches at least one instance, so
+            # this ends after at most len(script_args) requests
+            while script_args:
+                request = self._request(script_body, aws_config, script_args)
                 try:
-                    ec2.create_tags(
-                        Resources=[spot_request_id],
-                        Tags=[
-                            {'Key': 'Name', 'Value': self.tag_exp_name}
-                        ],
-                    )
+                    response = aws_util.retry_throttled(lambda: ec2.run_instances(**request))
+                except botocore.exceptions.ClientError as e:
+                    if not (self.dry and e.response['Error']['Code'] == 'DryRunOperation'):
+                        self.errors.extend((args, e) for args in script_args)
                     break
-                except botocore.exceptions.ClientError:
-                    continue
+                self.reservations.append(response)
+                launched = set()
+                for instance in response['Instances']:
+                    index = instance['AmiLaunchIndex']
+                    launched.add(index)
+                    self.instances.append((script_args[index], instance))
+                script_args = [args for i, args in enumerate(script_args) if i not in launched]
+        if not self.dry:
+            print('Launched %d of %d EC2 jobs in %d requests' % (
+                len(self) - len(self.errors), len(self), len(self.reservations)))
+        for args, e in self.errors:
+            print('Failed to launch job with arguments %s: %s' % (args, e))
 
 
 class EC2Autoconfig(EC2Mode):
@@ -438,13 +611,18 @@ class GCPMode(LaunchMode):
         self.instance_type = instance_type
         self.gcp_label = gcp_label
         self.data_sync_interval = data_sync_interval
-        self.compute = googleapiclient.discovery.build('compute', 'v1')
+        self._source_disk_image = None
+        self._batch = None
 
         if self.use_gpu:
             self.num_gpu = num_gpu
             self.gpu_model = gpu_model
             self.gpu_type = gcp_util.get_gpu_type(self.gcp_project, self.zone, self.gpu_model)
 
+    @property
+    def compute(self):
+        return gcp_util.compute_client()
+
     def __str__(self):
         return 'GCP-%s-%s' % (self.gcp_project, self.instance_type)
 
@@ -462,7 +640,11 @@ class GCPMode(LaunchMode):
             script_args = ' '.join(cmd_split[1:])
         else:
             script_args = ''
-        remote_script = gcp_util.upload_file_to_gcp_storage(self.gcp_bucket, script_fname, dry=dry)
+        remote_script = upload_util.upload_once(
+            ('gcp', self.gcp_bucket), script_fname,
+            lambda remote_filename: gcp_util.upload_file_to_gcp_storage(
+                self.gcp_bucket, script_fname, remote_filename=remote_filename, dry=dry),
+            dry=dry)
 
         exp_name = "{}-{}".format(self.gcp_label, gcp_util.make_timekey())
         exp_prefix = self.gcp_label
@@ -486,22 +668,65 @@ class GCPMode(LaunchMode):
         }
         # instance name must match regex '(?:[a-z](?:[-a-z0-9]{0,61}[a-z0-9])?)'">
         unique_name= "doodad" + str(uuid.uuid4()).replace("-", "")
+        if self._batch is not None:
+            self._batch.add(self.instance_config(metadata, unique_name, exp_name, exp_prefix))
+            return metadata
         instance_info = self.create_instance(metadata, unique_name, exp_name, exp_prefix, dry=dry)
         if verbose:
             print('Launched instance %s' % unique_name)
             print(instance_info)
         return metadata
 
+    @contextlib.contextmanager
+    def batch_launch(self, batch_size=None, dry=False):
+        """
+        Collect the instances launched by run_script within this context,
+        and create them together on exit: the image is looked up once, and
+        up to batch_size instances are inserted per batched HTTP request.
+
+        Example usage:
+
+        with gcp_mode.batch_launch() as batch:
+            hyper_sweep.run_sweep_doodad(target, params, run_mode=gcp_mode, mounts=mounts)
+        print(batch.errors)
+
+        Args:
+            batch_size (int): Instances per batched request.
+                Defaults to GCPLaunchBatch.MAX_BATCH_SIZE.
+            dry (bool): If True, the instances are collected but not created
+
+        Yields:
+            GCPLaunchBatch
+        """
+        batch = GCPLaunchBatch(self, batch_size=batch_size, dry=dry)
+        self._batch = batch
+        try:
+            yield batch
+        finally:
+            self._batch = None
+        batch.submit()
+
+    def source_disk_image(self):
+        """ The selfLink of gcp_image, looked up once """
+        if self._source_disk_image is None:
+            self._source_disk_image = self.compute.images().get(
+                project=self.gce_image_project,
+                image=self.gce_image,
+            ).execute()['selfLink']
+        return self._source_disk_image
+
     def create_instance(self, metadata, name, exp_name="", exp_prefix="", dry=False):
-        compute_images = self.compute.images().get(
-            project=self.gce_image_project,
-            image=self.gce_image,
-        )
+        source_disk_image = None if dry else self.source_disk_image()
+        config = self.instance_config(metadata, name, exp_name, exp_prefix, source_disk_image)
         if not dry:
-            image_response = compute_images.execute()
-        else:
-            image_response = {'selfLink': None}
-        source_disk_image = image_response['selfLink']
+            return self.compute.instances().insert(
+                project=self.gcp_project,
+                zone=self.zone,
+                body=config
+            ).execute()
+
+    def instance_config(self, metadata, name, exp_name="", exp_prefix="", source_disk_image=None):
+        """ The body of an instances().insert request """
         if self.zone == 'auto':
             raise NotImplementedError('auto zone finder')
         zone = self.zone
@@ -548,13 +773,65 @@ class GCPMode(LaunchMode):
                       "acceleratorType": self.gpu_type,
                       "acceleratorCount": self.num_gpu,
             }]
-        compute_instances = self.compute.instances().insert(
-            project=self.gcp_project,
-            zone=zone,
-            body=config
-        )
-        if not dry:
-            return compute_instances.execute()
+        return config
+
+
+class GCPLaunchBatch(object):
+    """
+    Instances collected by GCPMode.batch_launch, to be created together.
+
+    After submit(), responses maps instance names to the insert operation
+    and errors maps instance names to the exception raised creating them.
+    """
+    # the compute API accepts at most 1000 calls per batch
+    MAX_BATCH_SIZE = 500
+
+    def __init__(self, mode, batch_size=None, dry=False):
+        self.mode = mode
+        self.batch_size = batch_size or self.MAX_BATCH_SIZE
+        self.dry = dry
+        self.configs = []
+        self.responses = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def __deepcopy__(self, memo):
+        # copies of the mode (e.g. one per job of a concurrent sweep)
+        # add to the same batch
+        return self
+
+    def __len__(self):
+        return len(self.configs)
+
+    def add(self, config):
+        with self._lock:
+            self.configs.append(config)
+
+    def _callback(self, request_id, response, exception):
+        if exception is not None:
+            self.errors[request_id] = exception
+        else:
+            self.responses[request_id] = response
+
+    def submit(self):
+        """ Create every collected instance """
+        if self.dry or not self.configs:
+            return
+        source_disk_image = self.mode.source_disk_image()
+        compute = self.mode.compute
+        for i in range(0, len(self.configs), self.batch_size):
+            batch = compute.new_batch_http_request(callback=self._callback)
+            for config in self.configs[i:i+self.batch_size]:
+                config['disks'][0]['initializeParams']['sourceImage'] = source_disk_image
+                batch.add(compute.instances().insert(
+                    project=self.mode.gcp_project,
+                    zone=self.mode.zone,
+                    body=config
+                ), request_id=config['name'])
+            batch.execute()
+        print('Created %d of %d instances' % (len(self.responses), len(self.configs)))
+        for name, exception in sorted(self.errors.items()):
+            print('Failed to create %s: %s' % (name, exception))
 
 
 class AzureMode(LaunchMode):
@@ -580,7 +857,18 @@ class AzureMode(LaunchMode):
             num_vcpu (int): Specifies the number of vCPU for GPU instance
             promo_price (bool): Use promo price if available
             spot_price (float): Maximal price for preemptible instance. Specify -1 for the no limit price for the spot instance.
+            shared_network (bool): Attach VMs to a long-lived vnet shared by all jobs in a region (kept in the
+                resource group '{azure_resource_group}-network-{region}') instead of creating a vnet per job.
+                Each job still gets its own resource group with its VM, NIC and public IP, which is deleted with the job.
+            parallel_regions (int): Number of regions to try at once. The first region where the VM is created
+                wins; launches in the other regions are cancelled and their resource groups deleted.
+            skip_unavailable_regions (bool): Skip regions where instance_type is not offered to the subscription
+                (looked up once per process).
             **kwargs:
+
+    Regions where a launch of instance_type succeeded are remembered for the
+    lifetime of the process and tried first by later launches, and regions
+    where it failed are tried last.
     """
     US_REGIONS = ['eastus2', 'southcentralus', 'eastus', 'westus2', 'centralus', 'northcentralus',
                   'westus', 'westcentralus']
@@ -590,6 +878,8 @@ class AzureMode(LaunchMode):
                       'australiasoutheast', 'australiaeast', 'australiacentral',
                       'westindia', 'southindia', 'centralindia', 'southafricanorth', 'uaenorth'
                       ]
+    # seconds to wait for a new VM's identity to become assignable
+    ROLE_ASSIGNMENT_TIMEOUT = 600
 
     def __init__(self,
                  azure_subscription_id,
@@ -612,6 +902,9 @@ class AzureMode(LaunchMode):
                  tags=None,
                  retry_regions=None,
                  overwrite_logs=False,
+                 shared_network=False,
+                 parallel_regions=1,
+                 skip_unavailable_regions=False,
                  **kwargs):
         super(AzureMode, self).__init__(**kwargs)
         self.subscription_id = azure_subscription_id
@@ -630,6 +923,9 @@ class AzureMode(LaunchMode):
         self.spot_max_price = spot_price
         self._retry_regions = retry_regions
         self.overwrite_logs = overwrite_logs
+        self.shared_network = shared_network
+        self.parallel_regions = parallel_regions
+        self.skip_unavailable_regions = skip_unavailable_regions
         self.gpu_model = gpu_model
         if tags is None:
             from os import environ, getcwd
@@ -679,10 +975,14 @@ class AzureMode(LaunchMode):
             script_args = ' '.join(cmd_split[1:])
         else:
             script_args = ''
-        remote_script = azure_util.upload_file_to_azure_storage(filename=script_fname,
+        remote_script = upload_util.upload_once(
+            ('azure', self.connection_str, self.azure_container), script_fname,
+            lambda remote_filename: azure_util.upload_file_to_azure_storage(filename=script_fname,
                 container_name=self.azure_container,
                 connection_str=self.connection_str,
-                dry=dry)
+                remote_filename=remote_filename,
+                dry=dry),
+            dry=dry)
 
         with open(azure_util.AZURE_STARTUP_SCRIPT_PATH) as f:
             start_script = f.read()
@@ -698,15 +998,18 @@ class AzureMode(LaunchMode):
         else:
             regions_to_try += self._retry_regions
         regions_to_try = _remove_duplicates(regions_to_try)
+        if self.skip_unavailable_regions and not dry:
+            from azure.mgmt.compute import ComputeManagementClient
+            unavailable = azure_util.unavailable_regions(self._management_client(ComputeManagementClient),
+                                                         self.subscription_id, self.instance_type)
+            regions_to_try = [region for region in regions_to_try if region not in unavailable]
+        regions_to_try = azure_util.region_ranking.order(self.instance_type, regions_to_try)
         # use_data_science_image = self.use_gpu and (self.gpu_model == 'nvidia-tesla-v100' or self.gpu_model == 'nvidia-tesla-t4')
         use_data_science_image = False  # keep manual installation of image until we switch to a more affordable disk type
         install_nvidia_extension = self.use_gpu and not use_data_science_image
 
-        first_try = True
-        for region in regions_to_try:
-            if not first_try:
-                print("Retrying on region {}".format(region))
-            metadata = {
+        def make_metadata(region):
+            return {
                 'shell_interpreter': self.shell_interpreter,
                 'azure_container_path': self.log_path,
                 'remote_script_path': remote_script,
@@ -720,8 +1023,23 @@ class AzureMode(LaunchMode):
                 'use_data_science_image': use_data_science_image,  # processed in create_instance, json.dumps not needed
                 'install_nvidia_extension': json.dumps(install_nvidia_extension)
             }
-            success, instance_info = self.create_instance(metadata, verbose=verbose)
-            first_try = False
+
+        success = False
+        metadata = None
+        parallel_regions = max(1, self.parallel_regions)
+        for i in range(0, len(regions_to_try), parallel_regions):
+            regions = regions_to_try[i:i + parallel_regions]
+            if i > 0:
+                print("Retrying on region(s) {}".format(', '.join(regions)))
+            if len(regions) == 1:
+                metadata = make_metadata(regions[0])
+                timings = {}
+                success, instance_info = self.create_instance(metadata, verbose=verbose, timings=timings)
+                metadata['launch_timings'] = timings
+                azure_util.region_ranking.record(self.instance_type, regions[0], success)
+            else:
+                success, metadata = self._race_regions([make_metadata(region) for region in regions],
+                                                       verbose=verbose)
             if success:
                 print("Instance launched successfully")
                 break
@@ -733,8 +1051,90 @@ class AzureMode(LaunchMode):
                       ' preemptible=False')
         return metadata
 
-    def create_instance(self, metadata, verbose=False):
-        from azure.common.credentials import ServicePrincipalCredentials
+    def _race_regions(self, metadatas, verbose=False):
+        """
+        Launch the same job in several regions at once and keep the first
+        VM which is created. The other launches are cancelled, and any of
+        them which completed anyway are deleted. A launch which raises
+        counts as a failure in its region.
+
+        Args:
+            metadatas (list): Launch metadata for each region, see run_script
+
+        Returns:
+            (bool, dict): Whether a VM was created, and the metadata of the
+                winning region (or of the last region if none won)
+        """
+        cancel = threading.Event()
+        winner = None
+        executor = futures.ThreadPoolExecutor(len(metadatas))
+        launches = {}
+        for metadata in metadatas:
+            metadata['launch_timings'] = {}
+            launches[executor.submit(self.create_instance, metadata, verbose=verbose,
+                                     timings=metadata['launch_timings'], cancel=cancel)] = metadata
+        try:
+            for launch in futures.as_completed(launches):
+                metadata = launches[launch]
+                try:
+                    success, instance_info = launch.result()
+                except Exception as e:
+                    # keep draining the other launches, so that a duplicate
+                    # VM is always deleted
+                    print('Error when creating VM in {}: {!r}'.format(metadata['region'], e))
+                    success, instance_info = False, e
+                if isinstance(instance_info, _LaunchCancelled):
+                    continue
+                azure_util.region_ranking.record(self.instance_type, metadata['region'], success)
+                if not success:
+                    continue
+                if winner is None:
+                    winner = metadata
+                    cancel.set()
+                else:
+                    # lost the race after the point where it could be cancelled
+                    print('Deleting the duplicate VM in {}'.format(metadata['region']))
+                    try:
+                        self._delete_resource_group(instance_info)
+                    except Exception as e:
+                        print('Failed to delete resource group {}: {!r}'.format(instance_info, e))
+        finally:
+            cancel.set()
+            executor.shutdown(wait=True)
+        if winner is None:
+            return False, metadatas[-1]
+        return True, winner
+
+    def _delete_resource_group(self, resource_group_id):
+        from azure.mgmt.resource import ResourceManagementClient
+        resource_group_client = self._management_client(ResourceManagementClient)
+        resource_group_client.resource_groups.delete(resource_group_id.rsplit('/', 1)[-1])
+
+    def _management_client(self, client_cls):
+        return azure_util.management_client(client_cls,
+                                            client_id=self.azure_client_id,
+                                            secret=self.azure_authentication_key,
+                                            tenant=self.azure_tenant_id,
+                                            subscription_id=self.subscription_id)
+
+    def create_instance(self, metadata, verbose=False, timings=None, cancel=None):
+        """
+        Create a VM, and the resource group and network resources it needs.
+
+        Args:
+            metadata (dict): Launch metadata, see run_script
+            verbose (bool): Verbose mode
+            timings (dict): If given, the seconds spent provisioning each
+                resource are recorded here. Steps which are provisioned
+                concurrently overlap.
+            cancel (threading.Event): If given and set before the VM is
+                requested, the launch is abandoned and its resource group
+                deleted.
+
+        Returns:
+            (bool, str): Whether the VM was created, and the id of its
+                resource group (or the error if it was not)
+        """
         from azure.mgmt.resource import ResourceManagementClient
         from azure.mgmt.compute import ComputeManagementClient
         from azure.mgmt.network import NetworkManagementClient
@@ -747,40 +1147,32 @@ class AzureMode(LaunchMode):
             print("This guard will be removed as soon as the issue is fixed.")
             exit(1)
 
+        if timings is None:
+            timings = {}
+
+        def check_cancelled():
+            if cancel is not None and cancel.is_set():
+                raise _LaunchCancelled('Launch in {} cancelled'.format(region))
+
         azure_resource_group = self.azure_resource_group_base+uuid.uuid4().hex[:6]
         region = metadata['region']
         instance_type_str = 'a spot instance' if self.preemptible else 'an instance'
         print('Creating {} of type {} in {}'.format(instance_type_str, self.instance_type, region))
 
-        credentials = ServicePrincipalCredentials(
-            client_id=self.azure_client_id,
-            secret=self.azure_authentication_key,
-            tenant=self.azure_tenant_id,
-        )
-        resource_group_client = ResourceManagementClient(
-            credentials,
-            self.subscription_id
-        )
-        network_client = NetworkManagementClient(
-            credentials,
-            self.subscription_id
-        )
-        compute_client = ComputeManagementClient(
-            credentials,
-            self.subscription_id
-        )
-        authorization_client = AuthorizationManagementClient(
-            credentials,
-            self.subscription_id,
-        )
+        resource_group_client = self._management_client(ResourceManagementClient)
+        network_client = self._management_client(NetworkManagementClient)
+        compute_client = self._management_client(ComputeManagementClient)
+        authorization_client = self._management_client(AuthorizationManagementClient)
         resource_group_params = {
             'location': region,
             'tags': self.tags,
         }
+        start = time.time()
         resource_group = resource_group_client.resource_groups.create_or_update(
             azure_resource_group,
             resource_group_params
         )
+        timings['resource_group'] = time.time() - start
         vm_name = 'doodad-vm'
         print('VM name:', vm_name)
         print('resource group id:', resource_group.id)
@@ -790,34 +1182,42 @@ class AzureMode(LaunchMode):
             'public_ip_allocation_method': 'Dynamic'
         }
         try:
-            poller = network_client.public_ip_addresses.create_or_update(
+            check_cancelled()
+            # the public IP and the vnet (with its subnet) do not depend on
+            # each other, so they are provisioned concurrently
+            start = time.time()
+            ip_poller = network_client.public_ip_addresses.create_or_update(
                 azure_resource_group,
                 'myIPAddress',
                 public_ip_addess_params
             )
-            publicIPAddress = poller.result()
-
-            vnet_params = {
-                'location': region,
-                'address_space': {
-                    'address_prefixes': ['10.0.0.0/16']
+            if self.shared_network:
+                subnet_info = azure_util.shared_subnet(
+                    resource_group_client, network_client, self.subscription_id,
+                    azure_util.shared_network_resource_group(self.azure_resource_group_base, region),
+                    region,
+                    tags={k: v for k, v in self.tags.items() if k != 'log_path'},
+                )
+            else:
+                vnet_params = {
+                    'location': region,
+                    'address_space': {
+                        'address_prefixes': ['10.0.0.0/16']
+                    },
+                    'subnets': [{
+                        'name': 'mySubnet',
+                        'address_prefix': '10.0.0.0/24'
+                    }]
                 }
-            }
-            network_client.virtual_networks.create_or_update(
-                azure_resource_group,
-                'myVNet',
-                vnet_params
-            )
-            subnet_params = {
-                'address_prefix': '10.0.0.0/24'
-            }
-            poller = network_client.subnets.create_or_update(
-                azure_resource_group,
-                'myVNet',
-                'mySubnet',
-                subnet_params
-            )
-            subnet_info = poller.result()
+                vnet_poller = network_client.virtual_networks.create_or_update(
+                    azure_resource_group,
+                    'myVNet',
+                    vnet_params
+                )
+                subnet_info = vnet_poller.result().subnets[0]
+            timings['vnet'] = time.time() - start
+            publicIPAddress = ip_poller.result()
+            timings['public_ip'] = time.time() - start
             nic_params = {
                 'location': region,
                 'ip_configurations': [{
@@ -828,12 +1228,15 @@ class AzureMode(LaunchMode):
                     }
                 }]
             }
+            check_cancelled()
+            start = time.time()
             poller = network_client.network_interfaces.create_or_update(
                 azure_resource_group,
                 'myNic',
                 nic_params
             )
             nic = poller.result()
+            timings['nic'] = time.time() - start
 
             startup_script_str = metadata['startup_script']
             # TODO: how do we use this shutdown script?
@@ -906,16 +1309,18 @@ class AzureMode(LaunchMode):
                     }
                 }
                 vm_parameters.update(spot_args)
+            check_cancelled()
+            start = time.time()
             vm_poller = compute_client.virtual_machines.create_or_update(
                 resource_group_name=azure_resource_group,
                 vm_name=vm_name,
                 parameters=vm_parameters,
             )
-            vm_result = vm_poller.result()
 
             # We need to ensure that the VM has permissions to delete its own
             # resource group. We'll assign the built-in "Contributor" role and limit
             # its scope to this resource group.
+            # The role is looked up while the VM is being provisioned.
             role_name = 'Contributor'
             roles = list(authorization_client.role_definitions.list(
                 resource_group.id,
@@ -924,24 +1329,34 @@ class AzureMode(LaunchMode):
             assert len(roles) == 1
             contributor_role = roles[0]
 
-            # Add RG scope to the MSI tokenid
-            tokens_left = [vm_result.identity.principal_id]
-            while tokens_left:
-                try:
-                    for i, msi_identity in enumerate(tokens_left):
-                        authorization_client.role_assignments.create(
-                            resource_group.id,
-                            uuid.uuid4(),  # Role assignment random name
-                            {
-                                'role_definition_id': contributor_role.id,
-                                'principal_id': msi_identity
-                            }
-                        )
-                        del tokens_left[i]
-                except AzureCloudError as e:
-                    if verbose:
-                        print('Waiting for the principal ID {}.'.format(msi_identity))
-                    time.sleep(5)
+            vm_result = vm_poller.result()
+            timings['vm'] = time.time() - start
+
+            # Add RG scope to the MSI tokenid. The principal takes a while
+            # to propagate after the VM is created; any other error is
+            # raised straight away.
+            start = time.time()
+            msi_identity = vm_result.identity.principal_id
+            def on_retry(e, delay):
+                if verbose:
+                    print('Waiting for the principal ID {}.'.format(msi_identity))
+            retry.retry(
+                lambda: authorization_client.role_assignments.create(
+                    resource_group.id,
+                    uuid.uuid4(),  # Role assignment random name
+                    {
+                        'role_definition_id': contributor_role.id,
+                        'principal_id': msi_identity
+                    }
+                ),
+                exceptions=(AzureCloudError,),
+                retry_if=azure_util.is_principal_not_found,
+                timeout=self.ROLE_ASSIGNMENT_TIMEOUT,
+                on_retry=on_retry,
+                initial_delay=1,
+                max_delay=10,
+            )
+            timings['role_assignment'] = time.time() - start
         except (Exception, KeyboardInterrupt) as e:
             if 'resource_group' in locals():
                 if verbose:
@@ -949,6 +1364,10 @@ class AzureMode(LaunchMode):
                 resource_group_client.resource_groups.delete(
                     azure_resource_group
                 )
+            if isinstance(e, _LaunchCancelled):
+                if verbose:
+                    print(e)
+                return False, e
             if isinstance(e, AzureCloudError):
                 print("Error when creating VM. Error message:")
                 print(e.message + '\n')
@@ -958,6 +1377,10 @@ class AzureMode(LaunchMode):
         return success, resource_group.id
 
 
+class _LaunchCancelled(Exception):
+    pass
+
+
 def b64e(s):
     return base64.b64encode(s.encode()).decode()
 
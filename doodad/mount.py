@@ -8,12 +8,15 @@ to the launched process)
 """
 import os
 import shutil
+import posixpath
 import tarfile
 import tempfile
 from contextlib import contextmanager
 
 from doodad.apis import aws_util
 from doodad import utils
+from doodad.utils import ignore
+from doodad.darchive import archive_stage, layers
 
 
 class Mount(object):
@@ -31,12 +34,51 @@ class Mount(object):
         self._name = None
         self.local_dir = None
 
-    def dar_build_archive(self, deps_dir):
+    def dar_build_archive(self, deps_dir, layer_cache=None):
+        """
+        Copy the contents of this mount into an archive's deps directory.
+        """
+        self.dar_stage(archive_stage.DirectoryStage(deps_dir), layer_cache=layer_cache)
+
+    def dar_stage(self, stage, layer_cache=None):
+        """
+        Write the contents of this mount into an archive stage.
+
+        Args:
+            stage (DirectoryStage or TarStage): Destination, addressed
+                relative to the archive's deps directory. If the stage
+                has segments, read-only contents may be added as a
+                segment to extract directly from the archive instead.
+            layer_cache (LayerCache): Optional cache for packed mount layers
+        """
         raise NotImplementedError()
 
     def dar_extract_command(self):
         raise NotImplementedError()
 
+    def docker_bind_mount(self, workdir):
+        """
+        Where to bind-mount this mount's contents from when the container
+        runs on the same host, instead of shipping them in an archive.
+
+        Args:
+            workdir (str): Directory relative mount points are relative to
+                inside the container
+
+        Returns:
+            (str, str): Host path and absolute path inside the container,
+                or None if this mount cannot be bind-mounted.
+        """
+        return None
+
+    def dar_fingerprint(self):
+        """
+        A string which changes whenever the archived contents of this mount would.
+        Used to key cached archives.
+        """
+        return '%s:%s:%s:%s:%s' % (type(self).__name__, self.name, self.mount_point,
+                                   self.pythonpath, self.read_only)
+
     @property
     def writeable(self):
         return not self.read_only
@@ -56,14 +98,20 @@ class MountLocal(Mount):
                 filter_ext=('.pyc', '.log', '.git', '.mp4'),
                 filter_dir=('data', '.git'),
                 delete_before_mount=True,
+                hash_contents=False,
+                staging='link',
+                include=None,
+                exclude=(),
+                ignore_files=(),
+                max_file_size=None,
                 **kwargs):
         """
 
         :param local_dir:
         :param mount_point:
         :param cleanup:
-        :param filter_ext:
-        :param filter_dir:
+        :param filter_ext: Ignore files and directories with these suffixes.
+        :param filter_dir: Ignore files and directories with these names.
         :param delete_before_mount: If True, then if you mount to an existing
         directory, then the contents of that directory will be deleted before
         mounting. In other words, the behavior is
@@ -82,17 +130,49 @@ class MountLocal(Mount):
         ```
         So, existing files in `mount_point/` will not change unless they are
         overwritten by corresponding files in `local_dir/`.
+        :param hash_contents: If True, the manifest used to detect changes to
+        this mount (for cached archives and layers) includes an md5 of every
+        file rather than relying on sizes and modification times alone.
+        :param staging: How files are staged into the archive build directory.
+        'link' clones files with reflinks or hardlinks where the filesystem
+        allows it and only copies across devices. 'copy' always copies.
+        :param include: If given, a list of gitignore-style patterns. Only
+        files matching a pattern (or inside a matching directory) are archived.
+        :param exclude: A list of gitignore-style patterns to leave out of
+        the archive, e.g. ['node_modules/', 'wandb/', '*.ckpt'].
+        Patterns starting with ! re-include paths.
+        :param ignore_files: Names of ignore files to honour, e.g.
+        ('.gitignore', '.dockerignore'). A .dockerignore is read from
+        local_dir only and its patterns are relative to local_dir, while
+        .gitignore files (or any other name) apply to the directory they
+        are found in and below.
+        :param max_file_size: If given, files larger than this many bytes
+        are left out of the archive.
 
         :param kwargs:
         """
         super(MountLocal, self).__init__(mount_point=mount_point, **kwargs)
         self.local_dir = os.path.realpath(os.path.expanduser(local_dir))
-        self._name = self.local_dir.replace('/', '_')
+        # the mount point is part of the name, so that a directory mounted
+        # at several mount points is staged once for each of them
+        name = self.local_dir if mount_point is None else '%s@%s' % (self.local_dir, mount_point)
+        self._name = name.replace('/', '_')
         self.sync_dir = self.local_dir
         self.cleanup = cleanup
         self.filter_ext = filter_ext
         self.filter_dir = filter_dir
+        self.exclude = ignore.IgnoreRules(
+            ['*' + ignore.escape(ext) for ext in filter_ext] +
+            [ignore.escape(name) for name in filter_dir] +
+            list(exclude))
+        self.include = None if include is None else ignore.IgnoreRules(include)
+        self.ignore_files = tuple(ignore_files)
+        self.max_file_size = max_file_size
         self.delete_before_mount = delete_before_mount
+        self.hash_contents = hash_contents
+        if staging not in ('link', 'copy'):
+            raise ValueError('Unknown staging strategy: %s' % staging)
+        self.staging = staging
         if mount_point is None:
             self.mount_point = self.local_dir
         else:
@@ -104,42 +184,151 @@ class MountLocal(Mount):
                 raise ValueError('Output local directories must be absolute')
 
     def ignore_patterns(self, dirname, contents):
-        to_ignore = []
-        for content in contents:
-            if any([content.endswith(ext) for ext in self.filter_ext]):
-                to_ignore.append(content)
-            elif any([content == _dirname for _dirname in self.filter_dir]):
-                to_ignore.append(content)
-        return to_ignore
-
-    def dar_build_archive(self, deps_dir):
-        utils.makedirs(os.path.join(deps_dir, 'local'))
-        dep_dir = os.path.join(deps_dir, 'local', self.name)
-        extract_file = os.path.join(dep_dir, 'extract.sh')
+        """
+        Returns the entries of dirname which should not be archived.
+        Can be used as the ignore argument of shutil.copytree.
+        """
+        reldir = os.path.relpath(dirname, self.local_dir)
+        if reldir == '.' or reldir.startswith('..'):
+            reldir = ''
+        rules = self._ignore_rules(dirname, reldir)
+        return [content for content in contents
+                if self._is_ignored(rules, os.path.join(dirname, content),
+                                    ignore.to_posix(os.path.join(reldir, content)),
+                                    os.path.isdir(os.path.join(dirname, content)))]
+
+    def _ignore_rules(self, dirname, reldir, parent_rules=()):
+        """ Rules which apply inside reldir, given the rules of its parent """
+        rules = list(parent_rules)
+        for fname in self.ignore_files:
+            if fname == '.dockerignore' and reldir:
+                continue
+            ignore_file = os.path.join(dirname, fname)
+            if os.path.isfile(ignore_file):
+                rules.append(ignore.IgnoreRules.from_file(
+                    ignore_file, base=ignore.to_posix(reldir),
+                    anchored=fname == '.dockerignore'))
+        return rules
+
+    def _is_ignored(self, rules, path, relpath, is_dir):
+        if ignore.is_ignored(rules + [self.exclude], relpath, is_dir=is_dir):
+            return True
+        if is_dir:
+            return False
+        if self.include is not None and not self.include.match_any_parent(relpath):
+            return True
+        if self.max_file_size is not None and os.path.getsize(path) > self.max_file_size:
+            return True
+        return False
+
+    def walk_files(self, include_dirs=False):
+        """
+        Iterate over the files which would be copied into an archive,
+        applying the same filters as dar_build_archive.
+
+        Args:
+            include_dirs (bool): If True, also yield (non-ignored) directories.
+
+        Yields:
+            (str, str): Absolute path and path relative to local_dir
+        """
+        dir_rules = {self.local_dir: []}
+        for dirname, dirs, files in os.walk(self.local_dir, followlinks=True):
+            reldir = os.path.relpath(dirname, self.local_dir)
+            reldir = '' if reldir == '.' else reldir
+            rules = dir_rules.pop(dirname)
+            if self.ignore_files:
+                rules = self._ignore_rules(dirname, reldir, rules)
+            dirs[:] = sorted(d for d in dirs if not self._is_ignored(
+                rules, None, ignore.to_posix(os.path.join(reldir, d)), True))
+            names = sorted(f for f in files if not self._is_ignored(
+                rules, os.path.join(dirname, f), ignore.to_posix(os.path.join(reldir, f)), False))
+            for d in dirs:
+                dir_rules[os.path.join(dirname, d)] = rules
+            if include_dirs:
+                names = sorted(names + dirs)
+            for fname in names:
+                path = os.path.join(dirname, fname)
+                yield path, os.path.relpath(path, self.local_dir)
+
+    def manifest(self):
+        """
+        List the files to be archived along with their size, mode
+        and mtime (and md5 if hash_contents is set).
+
+        Returns:
+            list: A sorted list of (relpath, size, mode, mtime_ns, md5) tuples
+        """
+        manifest = []
+        for path, relpath in self.walk_files():
+            stat = os.stat(path)
+            md5 = utils.hash_file(path) if self.hash_contents else ''
+            manifest.append((relpath, stat.st_size, stat.st_mode, stat.st_mtime_ns, md5))
+        return manifest
+
+    def dar_fingerprint(self):
+        fingerprint = [super(MountLocal, self).dar_fingerprint(),
+                       repr((self.local_dir, self.delete_before_mount))]
+        if self.read_only:
+            fingerprint.extend('%s:%d:%o:%d:%s' % entry for entry in self.manifest())
+        return '\n'.join(fingerprint)
+
+    def dar_stage(self, stage, layer_cache=None):
+        dep_dir = os.path.join('local', self.name)
         mount_dir = os.path.dirname(self.mount_point)
+        use_layer = self.read_only and layer_cache is not None
+        use_segment = self.read_only and stage.segments is not None
 
+        stage.makedirs(dep_dir)
+        if use_segment:
+            if use_layer:
+                stage.add_segment(self.name, layer_cache.get_layer(self, compress=True))
+            else:
+                stage.add_segment(self.name, lambda fileobj: layers.write_layer(self, fileobj))
+        elif use_layer:
+            stage.add_file(layer_cache.get_layer(self), os.path.join(dep_dir, 'layer.tar'), link=True)
+        elif self.read_only:
+            for path, relpath in self.walk_files(include_dirs=True):
+                if os.path.isdir(path):
+                    stage.makedirs(os.path.join(dep_dir, relpath))
+                else:
+                    stage.add_file(path, os.path.join(dep_dir, relpath),
+                                   link=self.staging == 'link')
+
+        extract = []
         if self.read_only:
-            shutil.copytree(self.local_dir, dep_dir, ignore=self.ignore_patterns)
-        else:
-            os.makedirs(dep_dir)
-        with open(extract_file, 'w') as f:
-            if self.read_only:
-                f.write('mkdir -p %s\n' % mount_dir)
-                if self.delete_before_mount:
-                    f.write('rm -rf  {mount}\n'.format(mount=self.mount_point))
-                    f.write('mkdir -p %s\n' % self.mount_point)
-                f.write('mv ./deps/local/{name}/* {mount}/\n'.format(name=self.name, mount=self.mount_point))
+            extract.append('mkdir -p %s\n' % mount_dir)
+            if self.delete_before_mount:
+                extract.append('rm -rf  {mount}\n'.format(mount=self.mount_point))
+            extract.append('mkdir -p %s\n' % self.mount_point)
+            if use_segment:
+                extract.append(archive_stage.segment_extract_command(self.name, self.mount_point))
+            elif use_layer:
+                extract.append('tar -xf ./deps/local/{name}/layer.tar -C {mount}\n'.format(name=self.name, mount=self.mount_point))
             else:
-                f.write('mkdir -p %s\n' % mount_dir)
-            if self.pythonpath:
-                f.write('export PYTHONPATH=$PYTHONPATH:{mount_dir}\n'.format(mount_dir=mount_dir))
-        os.chmod(extract_file, 0o777)
+                # find rather than a glob, so that dotfiles are moved too
+                extract.append('find ./deps/local/{name} -mindepth 1 -maxdepth 1 ! -name extract.sh -exec mv {{}} {mount}/ \\;\n'.format(name=self.name, mount=self.mount_point))
+        else:
+            extract.append('mkdir -p %s\n' % mount_dir)
+        if self.pythonpath:
+            extract.append('export PYTHONPATH=$PYTHONPATH:{mount_dir}\n'.format(mount_dir=mount_dir))
+        stage.write_file(os.path.join(dep_dir, 'extract.sh'), ''.join(extract), mode=0o777)
 
     def dar_extract_command(self):
         return './deps/local/{name}/extract.sh'.format(
             name=self.name,
         )
 
+    def docker_bind_mount(self, workdir):
+        """
+        Read-only local directories can be bind-mounted as they are.
+        Note that a bind mount exposes the whole of local_dir: the filters
+        only apply when the directory is archived.
+        """
+        if not self.read_only or self.mount_point.startswith('~') or '$' in self.mount_point:
+            return None
+        return self.local_dir, posixpath.normpath(posixpath.join(workdir, self.mount_point))
+
     def __str__(self):
         return 'MountLocal@%s'%self.local_dir
 
@@ -160,35 +349,41 @@ class MountGit(Mount):
         self.branch = branch
         self._name = self.repo_name
 
-    def dar_build_archive(self, deps_dir):
-        dep_dir = os.path.join(deps_dir, 'git', self.name)
-        os.makedirs(dep_dir)
-
-        extract_file = os.path.join(dep_dir, 'extract.sh')
-        with open(extract_file, 'w') as f:
-            mount_point = os.path.dirname(self.mount_point)
-            f.write('mkdir -p %s\n' % mount_point)
-            f.write('pushd %s > /dev/null\n' % mount_point)
-            if self.ssh_identity:
-                shutil.copy(self.ssh_identity, dep_dir)
-                id_file = os.path.split(self.ssh_identity)[1]
-                id_file = os.path.join('/dar_payload/deps/git/{name}'.format(name=self.name), id_file)
-                f.write("GIT_SSH_COMMAND='ssh -o StrictHostKeyChecking=no -i {id}' git clone --quiet {repo_url}\n".format(id=id_file, repo_url=self.git_url))
-            else:
-                f.write("git clone --quiet {repo_url}\n".format(repo_url=self.git_url))
-            if self.branch:
-                f.write('cd {repo_name}\n'.format(repo_name=self.repo_name))
-                f.write('git checkout --quiet {branch}\n'.format(branch=self.branch))
-            if self.pythonpath:
-                f.write('export PYTHONPATH=$PYTHONPATH:{repo_dir}\n'.format(repo_dir=os.path.join(mount_point, self.repo_name)))
-            f.write('popd > /dev/null\n')
-        os.chmod(extract_file, 0o777)
+    def dar_stage(self, stage, layer_cache=None):
+        dep_dir = os.path.join('git', self.name)
+        stage.makedirs(dep_dir)
+
+        extract = []
+        mount_point = os.path.dirname(self.mount_point)
+        extract.append('mkdir -p %s\n' % mount_point)
+        extract.append('pushd %s > /dev/null\n' % mount_point)
+        if self.ssh_identity:
+            id_file = os.path.split(self.ssh_identity)[1]
+            stage.add_file(self.ssh_identity, os.path.join(dep_dir, id_file))
+            id_file = os.path.join('/dar_payload/deps/git/{name}'.format(name=self.name), id_file)
+            extract.append("GIT_SSH_COMMAND='ssh -o StrictHostKeyChecking=no -i {id}' git clone --quiet {repo_url}\n".format(id=id_file, repo_url=self.git_url))
+        else:
+            extract.append("git clone --quiet {repo_url}\n".format(repo_url=self.git_url))
+        if self.branch:
+            extract.append('cd {repo_name}\n'.format(repo_name=self.repo_name))
+            extract.append('git checkout --quiet {branch}\n'.format(branch=self.branch))
+        if self.pythonpath:
+            extract.append('export PYTHONPATH=$PYTHONPATH:{repo_dir}\n'.format(repo_dir=os.path.join(mount_point, self.repo_name)))
+        extract.append('popd > /dev/null\n')
+        stage.write_file(os.path.join(dep_dir, 'extract.sh'), ''.join(extract), mode=0o777)
 
     def dar_extract_command(self):
         return './deps/git/{name}/extract.sh'.format(
             name=self.name,
         )
 
+    def dar_fingerprint(self):
+        fingerprint = super(MountGit, self).dar_fingerprint()
+        fingerprint += ':%s:%s' % (self.git_url, self.branch)
+        if self.ssh_identity:
+            fingerprint += ':' + utils.hash_file(self.ssh_identity)
+        return fingerprint
+
 
 class MountS3(Mount):
     def __init__(self,
@@ -205,7 +400,7 @@ class MountS3(Mount):
             self.sync_dir = os.path.join('/doodad', s3_path)
         self._name = self.sync_dir.replace('/', '_')
 
-    def dar_build_archive(self, deps_dir):
+    def dar_stage(self, stage, layer_cache=None):
         return
 
     def dar_extract_command(self):
@@ -233,7 +428,7 @@ class MountGCP(Mount):
             self.sync_dir = os.path.join('/doodad', gcp_path)
         self._name = self.sync_dir.replace('/', '_')
 
-    def dar_build_archive(self, deps_dir):
+    def dar_stage(self, stage, layer_cache=None):
         return
 
     def dar_extract_command(self):
@@ -257,7 +452,7 @@ class MountAzure(Mount):
             self.sync_dir = os.path.join('/doodad', azure_path)
         self._name = self.sync_dir.replace('/', '_')
 
-    def dar_build_archive(self, deps_dir):
+    def dar_stage(self, stage, layer_cache=None):
         return
 
     def dar_extract_command(self):
@@ -280,7 +475,7 @@ class MountRemote(Mount):
         self._name = local_dir
         self.sync_dir = local_dir
 
-    def dar_build_archive(self, deps_dir):
+    def dar_stage(self, stage, layer_cache=None):
         return
 
     def dar_extract_command(self):
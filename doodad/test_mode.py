@@ -2,8 +2,12 @@ import unittest
 import os.path as path
 import tempfile
 import contextlib
+import threading
+
+from botocore.stub import Stubber
 
 from doodad import mode
+from doodad.apis import aws_util, azure_util, upload_util
 from doodad.utils import TESTING_DIR
 from doodad.credentials import ssh, ec2
 
@@ -48,3 +52,276 @@ class TestEC2(unittest.TestCase):
         self.assertEqual(launcher.ami, 'ami-1111111111112west')
         self.assertEqual(launcher.aws_key_name, 'doodad-us-west-2')
 
+    def test_batch_launch(self):
+        upload_util.clear()
+        credentials = ec2.AWSCredentials(aws_key='123', aws_secret='abc')
+        launcher = mode.EC2Mode(
+            ec2_credentials=credentials,
+            s3_bucket='test.bucket',
+            s3_log_path='test_log_path',
+            ami_name='ami-1234',
+            spot_price=0.5,
+        )
+        ec2_client = aws_util.ec2_client(launcher.region, credentials=credentials)
+        s3_client = aws_util.s3_client(credentials=credentials)
+        with Stubber(ec2_client) as ec2_stub, Stubber(s3_client) as s3_stub:
+            s3_stub.add_response('put_object', {})
+            # the first request is only partially filled, so its first job
+            # is requested again
+            ec2_stub.add_response('run_instances', {'Instances': [{'InstanceId': 'i-1', 'AmiLaunchIndex': 1}]})
+            ec2_stub.add_response('run_instances', {'Instances': [{'InstanceId': 'i-0', 'AmiLaunchIndex': 0}]})
+            ec2_stub.add_response('run_instances', {'Instances': [{'InstanceId': 'i-2', 'AmiLaunchIndex': 0}]})
+            with tempfile.NamedTemporaryFile('w+') as tfile:
+                with launcher.batch_launch(batch_size=2) as batch:
+                    for i in range(3):
+                        launcher.run_script('%s -- --n %d' % (tfile.name, i))
+                    requests = list(batch.requests())
+            ec2_stub.assert_no_pending_responses()
+            s3_stub.assert_no_pending_responses()
+        self.assertEqual(len(batch), 3)
+        self.assertEqual([args for _, args in requests], [['-- --n 0', '-- --n 1'], ['-- --n 2']])
+        request = requests[0][0]
+        self.assertEqual((request['MinCount'], request['MaxCount']), (1, 2))
+        self.assertEqual(request['InstanceMarketOptions']['SpotOptions']['MaxPrice'], '0.5')
+        self.assertIn("1) DOODAD_SCRIPT_ARGS='-- --n 1';;", request['UserData'])
+        self.assertIn("DOODAD_SCRIPT_ARGS='-- --n 2'", requests[1][0]['UserData'])
+        self.assertEqual(len(batch.reservations), 3)
+        self.assertEqual([(args, instance['InstanceId']) for args, instance in batch.instances],
+                         [('-- --n 1', 'i-1'), ('-- --n 0', 'i-0'), ('-- --n 2', 'i-2')])
+        self.assertEqual(batch.errors, [])
+
+    def test_batch_launch_capacity_error(self):
+        upload_util.clear()
+        credentials = ec2.AWSCredentials(aws_key='123', aws_secret='abc')
+        launcher = mode.EC2Mode(
+            ec2_credentials=credentials,
+            s3_bucket='test.bucket',
+            s3_log_path='test_log_path',
+            ami_name='ami-1234',
+        )
+        ec2_client = aws_util.ec2_client(launcher.region, credentials=credentials)
+        s3_client = aws_util.s3_client(credentials=credentials)
+        with Stubber(ec2_client) as ec2_stub, Stubber(s3_client) as s3_stub:
+            s3_stub.add_response('put_object', {})
+            ec2_stub.add_response('run_instances', {'Instances': [{'InstanceId': 'i-0', 'AmiLaunchIndex': 0}]})
+            ec2_stub.add_client_error('run_instances', 'InsufficientInstanceCapacity')
+            with tempfile.NamedTemporaryFile('w+') as tfile:
+                with launcher.batch_launch() as batch:
+                    for i in range(3):
+                        launcher.run_script('%s -- --n %d' % (tfile.name, i))
+            ec2_stub.assert_no_pending_responses()
+        self.assertEqual([args for args, _ in batch.instances], ['-- --n 0'])
+        self.assertEqual([args for args, _ in batch.errors], ['-- --n 1', '-- --n 2'])
+
+
+class FakeRequest(object):
+    def __init__(self, compute, method, **kwargs):
+        self.compute = compute
+        self.method = method
+        self.kwargs = kwargs
+
+    def execute(self):
+        self.compute.executed.append(self.method)
+        return {'selfLink': 'images/test-image'}
+
+
+class FakeBatch(object):
+    def __init__(self, compute, callback):
+        self.compute = compute
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        self.compute.batches.append(len(self.requests))
+        for request_id, request in self.requests:
+            if request.kwargs['body']['name'] == self.compute.fail:
+                self.callback(request_id, None, RuntimeError('quota exceeded'))
+            else:
+                self.callback(request_id, {'name': request_id}, None)
+
+
+class FakeCompute(object):
+    """ A stand-in for the GCE compute API """
+    def __init__(self):
+        self.executed = []
+        self.batches = []
+        self.inserted = []
+        self.fail = None
+
+    def images(self):
+        return self
+
+    def instances(self):
+        return self
+
+    def get(self, **kwargs):
+        return FakeRequest(self, 'images.get', **kwargs)
+
+    def insert(self, **kwargs):
+        self.inserted.append(kwargs['body'])
+        return FakeRequest(self, 'instances.insert', **kwargs)
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(self, callback)
+
+
+class TestGCP(unittest.TestCase):
+    def test_batch_launch(self):
+        compute = FakeCompute()
+        class FakeGCPMode(mode.GCPMode):
+            pass
+        FakeGCPMode.compute = compute
+        launcher = FakeGCPMode(
+            gcp_project='testing',
+            gcp_bucket='testbucket',
+            gcp_log_path='test_path',
+            zone='us-east1-b',
+        )
+        with tempfile.NamedTemporaryFile('w+') as tfile:
+            with launcher.batch_launch(batch_size=2) as batch:
+                for i in range(3):
+                    # dry only skips uploading the script
+                    launcher.run_script('%s --n %d' % (tfile.name, i), dry=True)
+                compute.fail = batch.configs[1]['name']
+                self.assertEqual(compute.executed, [])
+        self.assertEqual(compute.executed, ['images.get'])
+        self.assertEqual(compute.batches, [2, 1])
+        script_args = [{item['key']: item['value'] for item in config['metadata']['items']}['script_args']
+                       for config in compute.inserted]
+        self.assertEqual(script_args, ['--n 0', '--n 1', '--n 2'])
+        for config in compute.inserted:
+            self.assertEqual(config['disks'][0]['initializeParams']['sourceImage'], 'images/test-image')
+        self.assertEqual(sorted(batch.responses), sorted([compute.inserted[0]['name'], compute.inserted[2]['name']]))
+        self.assertEqual(list(batch.errors), [compute.inserted[1]['name']])
+
+    def test_batch_launch_dry(self):
+        launcher = mode.GCPMode(
+            gcp_project='testing',
+            gcp_bucket='testbucket',
+            gcp_log_path='test_path',
+            zone='us-east1-b',
+        )
+        with tempfile.NamedTemporaryFile('w+') as tfile:
+            with launcher.batch_launch(dry=True) as batch:
+                launcher.run_script(tfile.name + ' --n 1', dry=True)
+        self.assertEqual(len(batch), 1)
+        self.assertEqual(batch.responses, {})
+
+
+class FakeAzureMode(mode.AzureMode):
+    """ Launches succeed in the regions in capacity, after a delay """
+    def __init__(self, capacity, delays=None, raises=(), **kwargs):
+        super(FakeAzureMode, self).__init__(
+            azure_subscription_id='sub',
+            azure_storage_container='container',
+            azure_storage_connection_str='AccountName=name;AccountKey=key',
+            azure_client_id='id',
+            azure_authentication_key='key',
+            azure_tenant_id='tenant',
+            log_path='test_path',
+            tags={'user': 'test'},
+            instance_type='Standard_Test',
+            **kwargs)
+        self.capacity = capacity
+        self.raises = raises
+        self.delays = delays or {}
+        self.launched = []
+        self.cancelled = []
+        self.deleted = []
+        self._lock = threading.Lock()
+
+    def create_instance(self, metadata, verbose=False, timings=None, cancel=None):
+        region = metadata['region']
+        with self._lock:
+            self.launched.append(region)
+        if region in self.delays:
+            self.delays[region].wait(5)
+        if cancel is not None and cancel.is_set():
+            with self._lock:
+                self.cancelled.append(region)
+            return False, mode._LaunchCancelled(region)
+        if region in self.raises:
+            raise RuntimeError('unexpected error in ' + region)
+        if region in self.capacity:
+            return True, '/subscriptions/sub/resourceGroups/doodad-' + region
+        return False, Exception('no capacity in ' + region)
+
+    def _delete_resource_group(self, resource_group_id):
+        self.deleted.append(resource_group_id)
+
+
+class TestAzure(unittest.TestCase):
+    def setUp(self):
+        azure_util.region_ranking.clear()
+
+    def run_job(self, launcher):
+        with tempfile.NamedTemporaryFile('w+') as tfile:
+            return launcher.run_script(tfile.name, dry=True)
+
+    def test_region_ranking(self):
+        launcher = FakeAzureMode(capacity=['westus'], region='eastus', retry_regions=['centralus', 'westus'])
+        self.assertEqual(self.run_job(launcher)['region'], 'westus')
+        self.assertEqual(launcher.launched, ['eastus', 'centralus', 'westus'])
+        # later jobs go straight to the region which worked
+        launcher.launched = []
+        self.assertEqual(self.run_job(launcher)['region'], 'westus')
+        self.assertEqual(launcher.launched, ['westus'])
+        self.assertEqual(azure_util.region_ranking.order('Standard_Test', ['eastus', 'northeurope', 'westus']),
+                         ['westus', 'northeurope', 'eastus'])
+
+    def test_parallel_regions(self):
+        # westus is created only after eastus2 lost the race to centralus
+        centralus_done = threading.Event()
+        launcher = FakeAzureMode(capacity=['centralus', 'westus'], region='eastus',
+                                 retry_regions=['centralus', 'westus', 'eastus2'],
+                                 delays={'westus': centralus_done, 'eastus2': centralus_done},
+                                 parallel_regions=3)
+        original_record = azure_util.region_ranking.record
+        def record(instance_type, region, success):
+            original_record(instance_type, region, success)
+            if region == 'centralus':
+                centralus_done.set()
+        azure_util.region_ranking.record = record
+        try:
+            metadata = self.run_job(launcher)
+        finally:
+            del azure_util.region_ranking.record
+        self.assertEqual(metadata['region'], 'centralus')
+        self.assertEqual(sorted(launcher.launched), ['centralus', 'eastus', 'westus'])
+        self.assertEqual(launcher.cancelled, ['westus'])
+        self.assertEqual(launcher.deleted, [])
+        self.assertEqual(azure_util.region_ranking.order('Standard_Test', ['eastus', 'westus', 'centralus']),
+                         ['centralus', 'westus', 'eastus'])
+
+    def test_parallel_regions_error(self):
+        # westus raises after centralus won, and eastus2 finishes its VM
+        # after that: the winner is kept and the duplicate deleted
+        centralus_done = threading.Event()
+        launcher = FakeAzureMode(capacity=['centralus', 'eastus2'], raises=['westus'], region='eastus',
+                                 retry_regions=['centralus', 'westus', 'eastus2'],
+                                 delays={'westus': centralus_done, 'eastus2': centralus_done},
+                                 parallel_regions=4)
+        original_create_instance = launcher.create_instance
+        def create_instance(metadata, verbose=False, timings=None, cancel=None):
+            if metadata['region'] == 'eastus2':
+                # past the point where it could be cancelled
+                cancel = None
+            return original_create_instance(metadata, verbose=verbose, timings=timings, cancel=cancel)
+        launcher.create_instance = create_instance
+        original_record = azure_util.region_ranking.record
+        def record(instance_type, region, success):
+            original_record(instance_type, region, success)
+            if region == 'centralus':
+                centralus_done.set()
+        azure_util.region_ranking.record = record
+        try:
+            metadata = self.run_job(launcher)
+        finally:
+            del azure_util.region_ranking.record
+        self.assertEqual(metadata['region'], 'centralus')
+        self.assertEqual(launcher.deleted, ['/subscriptions/sub/resourceGroups/doodad-eastus2'])
+        self.assertEqual(azure_util.region_ranking.order('Standard_Test', ['westus', 'centralus']),
+                         ['centralus', 'westus'])
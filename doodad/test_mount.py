@@ -29,3 +29,61 @@ class TestLocal(unittest.TestCase):
             shutil.rmtree(target_dir)
 
 
+
+    def test_link_staging(self):
+        work_dir = tempfile.mkdtemp()
+        try:
+            local_dir = path.join(work_dir, 'code')
+            deps_dir = path.join(work_dir, 'deps')
+            os.makedirs(local_dir)
+            os.makedirs(deps_dir)
+            # a file which collides with the generated extract script
+            for fname in ['a.txt', 'extract.sh']:
+                with open(path.join(local_dir, fname), 'w') as f:
+                    f.write(fname)
+            local_mount = mount.MountLocal(local_dir, mount_point='./code', staging='link')
+            local_mount.dar_build_archive(deps_dir)
+            dep_dir = path.join(deps_dir, 'local', local_mount.name)
+            with open(path.join(dep_dir, 'a.txt')) as f:
+                self.assertEqual(f.read(), 'a.txt')
+            with open(path.join(local_dir, 'extract.sh')) as f:
+                self.assertEqual(f.read(), 'extract.sh')
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_docker_bind_mount(self):
+        local_mount = mount.MountLocal('/tmp/code', mount_point='./mnt/code')
+        self.assertEqual(local_mount.docker_bind_mount('/dar_payload'), ('/tmp/code', '/dar_payload/mnt/code'))
+        local_mount = mount.MountLocal('/tmp/code', mount_point='/code')
+        self.assertEqual(local_mount.docker_bind_mount('/dar_payload'), ('/tmp/code', '/code'))
+        self.assertIsNone(mount.MountLocal('/tmp/code', mount_point='~/code').docker_bind_mount('/dar_payload'))
+        self.assertIsNone(mount.MountLocal('/tmp/out', mount_point='/out', output=True).docker_bind_mount('/dar_payload'))
+        self.assertIsNone(mount.MountGit('https://github.com/a/b.git', mount_point='./b').docker_bind_mount('/dar_payload'))
+
+    def _walk(self, local_dir, **kwargs):
+        local_mount = mount.MountLocal(local_dir, mount_point='./code', **kwargs)
+        return {relpath for _, relpath in local_mount.walk_files()}
+
+    def test_ignore_rules(self):
+        work_dir = tempfile.mkdtemp()
+        try:
+            files = {'a.py': 'a', 'big.bin': 'x' * 100, 'node_modules/m.js': 'm',
+                     'pkg/b.py': 'b', 'pkg/out.tmp': 'out', 'pkg/keep.tmp': 'keep',
+                     'pkg/.gitignore': '*.tmp\n!keep.tmp\n', '.gitignore': '/big.bin\n',
+                     '.dockerignore': 'node_modules\n'}
+            for fname, contents in files.items():
+                fname = path.join(work_dir, fname)
+                if not path.isdir(path.dirname(fname)):
+                    os.makedirs(path.dirname(fname))
+                with open(fname, 'w') as f:
+                    f.write(contents)
+            self.assertEqual(self._walk(work_dir), set(files))
+            self.assertEqual(self._walk(work_dir, exclude=['node_modules/', '*.tmp', '!keep.tmp']),
+                             set(files) - {'node_modules/m.js', 'pkg/out.tmp'})
+            self.assertEqual(self._walk(work_dir, ignore_files=('.gitignore', '.dockerignore')),
+                             set(files) - {'node_modules/m.js', 'pkg/out.tmp', 'big.bin'})
+            self.assertEqual(self._walk(work_dir, include=['*.py', 'node_modules/']),
+                             {'a.py', 'pkg/b.py', 'node_modules/m.js'})
+            self.assertEqual(self._walk(work_dir, max_file_size=50), set(files) - {'big.bin'})
+        finally:
+            shutil.rmtree(work_dir)
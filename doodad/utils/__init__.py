@@ -1,6 +1,13 @@
 import os
 import errno
+import contextlib
 import hashlib
+import shutil
+import tempfile
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 _UTILS_DIR = os.path.dirname(os.path.realpath(__file__))
 PKG_DIR = os.path.dirname(_UTILS_DIR)
@@ -11,6 +18,11 @@ SCRIPTS_DIR = os.path.join(REPO_DIR, 'scripts')
 
 HASH_BUF_SIZE = 65536
 
+# ioctl request number for cloning a file (Linux, see ioctl_ficlone(2))
+FICLONE = 0x40049409
+# (source device, destination device) pairs which do not support reflinks
+_NO_REFLINK_DEVICES = set()
+
 def hash_file(filename):
     hasher = hashlib.md5()
     with open(filename, 'rb') as f:
@@ -29,6 +41,96 @@ def makedirs(path):
         if e.errno != errno.EEXIST:
             raise
 
+def temp_name(filename):
+    """
+    Create an empty temporary file next to filename, which can later be
+    moved onto it with os.replace.
+    """
+    dirname, basename = os.path.split(os.path.abspath(filename))
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.%s.' % basename, suffix='.tmp')
+    os.close(fd)
+    return tmp_path
+
+
+@contextlib.contextmanager
+def replacing(filename):
+    """
+    Yield a temporary file name to write filename's new contents to. The
+    temporary file is moved onto filename once the block completes, so
+    files hardlinked to filename (e.g. cache entries) are never written
+    through, and filename is never left partially written.
+    """
+    tmp_path = temp_name(filename)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, filename)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def link_or_copy(src, dst):
+    """
+    Hardlink src to dst, falling back to a copy (e.g. across devices).
+
+    An existing dst is replaced rather than written through, since it may
+    itself be hardlinked to another file.
+    """
+    tmp_path = temp_name(dst)
+    try:
+        os.remove(tmp_path)
+        try:
+            os.link(src, tmp_path)
+        except OSError:
+            shutil.copy2(src, tmp_path)
+        os.replace(tmp_path, dst)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return dst
+
+
+def reflink(src, dst):
+    """
+    Clone src to dst with a copy-on-write reflink, if the filesystem
+    supports it (e.g. btrfs or XFS).
+
+    Returns:
+        bool: True if dst was created
+    """
+    if fcntl is None:
+        return False
+    devices = (os.stat(src).st_dev, os.stat(os.path.dirname(os.path.abspath(dst))).st_dev)
+    if devices in _NO_REFLINK_DEVICES:
+        return False
+    try:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except (IOError, OSError):
+        _NO_REFLINK_DEVICES.add(devices)
+        try:
+            os.remove(dst)
+        except OSError:
+            pass
+        return False
+    shutil.copystat(src, dst)
+    return True
+
+
+def clone_file(src, dst):
+    """
+    Make dst a copy of src as cheaply as possible: a reflink where supported,
+    otherwise a hardlink, and only copying the data across devices.
+
+    A hardlinked dst shares its contents with src, so it must be treated
+    as read-only. Can be used as a copy_function for shutil.copytree.
+    """
+    if not reflink(src, dst):
+        link_or_copy(src, dst)
+    return dst
+
 def which(program):
     """Compatible with pre-Python3.3.
 
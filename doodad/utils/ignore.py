@@ -0,0 +1,168 @@
+"""
+Gitignore-style path matching.
+
+Patterns follow .gitignore syntax:
+    - Blank lines and lines starting with # are skipped.
+    - A leading ! re-includes paths matched by an earlier pattern.
+    - A trailing / only matches directories.
+    - Patterns without a slash match a name at any depth. Patterns with
+      a slash are relative to the directory the rules belong to.
+    - * and ? do not match /, ** matches any number of directories.
+
+Consecutive patterns are compiled into a single regular expression, so
+matching a path costs one regex search per run of patterns with the same
+polarity rather than one per pattern.
+"""
+import os
+import re
+
+
+def escape(name):
+    """ Escape a literal file name so that it can be used as a pattern """
+    name = re.sub(r'([\\*?\[])', r'\\\1', name)
+    if name[:1] in ('!', '#'):
+        name = '\\' + name
+    return name
+
+
+def translate(pattern, anchored=False):
+    """
+    Translate a single gitignore pattern (without ! or a trailing /)
+    into a regular expression matching paths relative to its base.
+    """
+    if '/' in pattern:
+        anchored = True
+    pattern = pattern.lstrip('/')
+    regex = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith('**/', i) and (i == 0 or pattern[i-1] == '/'):
+            regex.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('**', i) and i + 2 == len(pattern) and (i == 0 or pattern[i-1] == '/'):
+            regex.append('.*')
+            i += 2
+        elif c == '*':
+            regex.append('[^/]*')
+            i += 1
+        elif c == '?':
+            regex.append('[^/]')
+            i += 1
+        elif c == '[':
+            end = pattern.find(']', i + 2)
+            if end < 0:
+                regex.append(re.escape(c))
+                i += 1
+                continue
+            body = pattern[i+1:end]
+            if body[0] == '!':
+                body = '^' + body[1:]
+            regex.append('[%s]' % body.replace('\\', '\\\\'))
+            i = end + 1
+        elif c == '\\' and i + 1 < len(pattern):
+            regex.append(re.escape(pattern[i+1]))
+            i += 2
+        else:
+            regex.append(re.escape(c))
+            i += 1
+    prefix = '' if anchored else '(?:.*/)?'
+    return prefix + ''.join(regex)
+
+
+class IgnoreRules(object):
+    """
+    A compiled list of gitignore-style patterns.
+
+    Args:
+        patterns (list): Patterns in gitignore syntax
+        base (str): Directory the patterns are relative to, as a
+            /-separated path relative to the root being matched
+        anchored (bool): If True, patterns are relative to base even when
+            they contain no slash, as in .dockerignore files
+    """
+    def __init__(self, patterns, base='', anchored=False):
+        self.base = base.strip('/')
+        self._runs = []
+        for pattern in patterns:
+            pattern = pattern.rstrip('\n')
+            if pattern.endswith(' ') and not pattern.endswith('\\ '):
+                pattern = pattern.rstrip(' ')
+            if not pattern or pattern.startswith('#'):
+                continue
+            negate = pattern.startswith('!')
+            if negate:
+                pattern = pattern[1:]
+            dir_only = pattern.endswith('/')
+            pattern = pattern.rstrip('/')
+            if not pattern:
+                continue
+            regex = translate(pattern, anchored=anchored)
+            if not self._runs or self._runs[-1][0] != negate:
+                self._runs.append((negate, [], []))
+            self._runs[-1][2].append(regex)
+            if not dir_only:
+                self._runs[-1][1].append(regex)
+        self._runs = [(negate, _compile(file_regexes), _compile(dir_regexes))
+                      for negate, file_regexes, dir_regexes in reversed(self._runs)]
+
+    @classmethod
+    def from_file(cls, filename, base='', anchored=False):
+        with open(filename) as f:
+            return cls(f.readlines(), base=base, anchored=anchored)
+
+    def __bool__(self):
+        return bool(self._runs)
+    __nonzero__ = __bool__
+
+    def match(self, path, is_dir=False):
+        """
+        Args:
+            path (str): A /-separated path relative to the root
+            is_dir (bool): Whether path is a directory
+
+        Returns:
+            True if the last matching pattern ignores path, False if it
+            re-includes it, and None if no pattern matches.
+        """
+        if self.base:
+            if not path.startswith(self.base + '/'):
+                return None
+            path = path[len(self.base)+1:]
+        for negate, file_regex, dir_regex in self._runs:
+            regex = dir_regex if is_dir else file_regex
+            if regex is not None and regex.match(path):
+                return not negate
+        return None
+
+    def match_any_parent(self, path, is_dir=False):
+        """ Like match(), but also matches if any parent directory of path matches """
+        result = self.match(path, is_dir=is_dir)
+        while result is None and '/' in path:
+            path = path.rsplit('/', 1)[0]
+            result = self.match(path, is_dir=True)
+        return result
+
+
+def _compile(regexes):
+    if not regexes:
+        return None
+    return re.compile('(?:%s)\\Z' % '|'.join(regexes), re.DOTALL)
+
+
+def is_ignored(rules, path, is_dir=False):
+    """
+    Apply a sequence of IgnoreRules in order, later rules taking precedence.
+
+    Returns:
+        bool: True if path is ignored
+    """
+    for rule in reversed(rules):
+        result = rule.match(path, is_dir=is_dir)
+        if result is not None:
+            return result
+    return False
+
+
+def to_posix(path):
+    return path.replace(os.sep, '/') if os.sep != '/' else path
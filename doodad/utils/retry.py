@@ -0,0 +1,63 @@
+"""
+Retrying with exponential backoff.
+
+Example usage:
+
+# retry for up to a minute, waiting 1s, 2s, 4s... between attempts
+result = retry.retry(lambda: client.create(...), exceptions=(CloudError,), timeout=60)
+"""
+import time
+import random
+
+
+def backoff_delays(initial_delay=1.0, max_delay=30.0, factor=2.0, jitter=0.1):
+    """
+    Yield an infinite sequence of delays which grow exponentially up to
+    max_delay, each randomly perturbed by up to +/- jitter of itself.
+    """
+    delay = initial_delay
+    while True:
+        yield delay * (1 + random.uniform(-jitter, jitter))
+        delay = min(delay * factor, max_delay)
+
+
+def retry(fn, exceptions=(Exception,), max_attempts=None, timeout=None, on_retry=None,
+          retry_if=None, sleep=time.sleep, **backoff_kwargs):
+    """
+    Call fn until it does not raise, sleeping with exponential backoff
+    between attempts.
+
+    Args:
+        fn (callable): Called without arguments
+        exceptions (tuple): Exception types which cause a retry. Any other
+            exception is raised immediately.
+        max_attempts (int): Give up after this many attempts
+        timeout (float): Give up once this many seconds have passed
+        on_retry (callable): Called with the exception and the delay
+            before each retry
+        retry_if (callable): If given, called with each exception of one of
+            the given types, and the exception is raised unless it returns True
+        sleep (callable): Used to sleep between attempts
+        **backoff_kwargs: Arguments to backoff_delays
+
+    Returns:
+        The return value of fn. When giving up, the last exception is raised.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    attempts = 0
+    for delay in backoff_delays(**backoff_kwargs):
+        attempts += 1
+        try:
+            return fn()
+        except exceptions as e:
+            if retry_if is not None and not retry_if(e):
+                raise
+            if max_attempts is not None and attempts >= max_attempts:
+                raise
+            if deadline is not None:
+                if time.time() >= deadline:
+                    raise
+                delay = min(delay, max(deadline - time.time(), 0))
+            if on_retry is not None:
+                on_retry(e, delay)
+            sleep(delay)
@@ -0,0 +1,67 @@
+import unittest
+
+from doodad.utils import ignore
+
+
+class TestIgnoreRules(unittest.TestCase):
+    def test_basename(self):
+        rules = ignore.IgnoreRules(['*.pyc', 'node_modules'])
+        self.assertTrue(rules.match('a.pyc'))
+        self.assertTrue(rules.match('pkg/sub/a.pyc'))
+        self.assertTrue(rules.match('web/node_modules', is_dir=True))
+        self.assertIsNone(rules.match('a.py'))
+        self.assertIsNone(rules.match('pkg.pyc/a.py'))
+
+    def test_anchored(self):
+        rules = ignore.IgnoreRules(['/data', 'logs/*.txt'])
+        self.assertTrue(rules.match('data', is_dir=True))
+        self.assertIsNone(rules.match('pkg/data', is_dir=True))
+        self.assertTrue(rules.match('logs/a.txt'))
+        self.assertIsNone(rules.match('logs/sub/a.txt'))
+        self.assertIsNone(rules.match('pkg/logs/a.txt'))
+
+    def test_dir_only(self):
+        rules = ignore.IgnoreRules(['wandb/'])
+        self.assertTrue(rules.match('wandb', is_dir=True))
+        self.assertIsNone(rules.match('wandb', is_dir=False))
+
+    def test_double_star(self):
+        rules = ignore.IgnoreRules(['**/checkpoints/*.ckpt', 'out/**'])
+        self.assertTrue(rules.match('checkpoints/a.ckpt'))
+        self.assertTrue(rules.match('exp/1/checkpoints/a.ckpt'))
+        self.assertTrue(rules.match('out/a/b'))
+        self.assertIsNone(rules.match('out', is_dir=True))
+
+    def test_negation(self):
+        rules = ignore.IgnoreRules(['*.log', '!keep.log', 'keep.log.bak'])
+        self.assertTrue(rules.match('a.log'))
+        self.assertFalse(rules.match('keep.log'))
+        self.assertTrue(rules.match('keep.log.bak'))
+
+    def test_base(self):
+        rules = ignore.IgnoreRules(['/build', '*.o'], base='pkg')
+        self.assertTrue(rules.match('pkg/build', is_dir=True))
+        self.assertTrue(rules.match('pkg/a/b.o'))
+        self.assertIsNone(rules.match('build', is_dir=True))
+        self.assertIsNone(rules.match('b.o'))
+
+    def test_anchored_rules(self):
+        rules = ignore.IgnoreRules(['tmp'], anchored=True)
+        self.assertTrue(rules.match('tmp'))
+        self.assertIsNone(rules.match('pkg/tmp'))
+
+    def test_escape(self):
+        rules = ignore.IgnoreRules([ignore.escape('[a]*.txt'), '# comment', '', '\\#b'])
+        self.assertTrue(rules.match('[a]*.txt'))
+        self.assertIsNone(rules.match('a.txt'))
+        self.assertTrue(rules.match('#b'))
+
+    def test_is_ignored(self):
+        rules = [ignore.IgnoreRules(['*.log']), ignore.IgnoreRules(['!a.log'])]
+        self.assertFalse(ignore.is_ignored(rules, 'a.log'))
+        self.assertTrue(ignore.is_ignored(rules, 'b.log'))
+        self.assertFalse(ignore.is_ignored(rules, 'b.txt'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import unittest
+
+from doodad.utils import retry
+
+
+class Flaky(object):
+    def __init__(self, failures, exception=ValueError):
+        self.failures = failures
+        self.exception = exception
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.exception('attempt %d' % self.calls)
+        return self.calls
+
+
+class TestRetry(unittest.TestCase):
+    def test_backoff_delays(self):
+        delays = retry.backoff_delays(initial_delay=1, max_delay=5, factor=2, jitter=0)
+        self.assertEqual([next(delays) for _ in range(5)], [1, 2, 4, 5, 5])
+
+    def test_retry(self):
+        sleeps = []
+        fn = Flaky(3)
+        self.assertEqual(retry.retry(fn, exceptions=(ValueError,), sleep=sleeps.append, jitter=0), 4)
+        self.assertEqual(sleeps, [1, 2, 4])
+
+    def test_max_attempts(self):
+        sleeps = []
+        fn = Flaky(5)
+        with self.assertRaises(ValueError):
+            retry.retry(fn, exceptions=(ValueError,), max_attempts=3, sleep=sleeps.append)
+        self.assertEqual(fn.calls, 3)
+        self.assertEqual(len(sleeps), 2)
+
+    def test_other_exceptions(self):
+        fn = Flaky(1, exception=KeyError)
+        with self.assertRaises(KeyError):
+            retry.retry(fn, exceptions=(ValueError,), sleep=lambda delay: None)
+        self.assertEqual(fn.calls, 1)
+
+    def test_retry_if(self):
+        fn = Flaky(3)
+        with self.assertRaises(ValueError):
+            retry.retry(fn, exceptions=(ValueError,), retry_if=lambda e: str(e) != 'attempt 2',
+                        sleep=lambda delay: None)
+        self.assertEqual(fn.calls, 2)
+
+    def test_timeout(self):
+        fn = Flaky(100)
+        with self.assertRaises(ValueError):
+            retry.retry(fn, exceptions=(ValueError,), timeout=0.05, initial_delay=0.01)
+        self.assertLess(fn.calls, 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
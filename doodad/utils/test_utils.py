@@ -0,0 +1,39 @@
+import unittest
+import os
+import os.path as path
+import shutil
+import tempfile
+
+from doodad import utils
+
+
+class TestCloneFile(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.src = path.join(self.work_dir, 'src.txt')
+        with open(self.src, 'w') as f:
+            f.write('apple')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_clone(self):
+        dst = path.join(self.work_dir, 'dst.txt')
+        utils.clone_file(self.src, dst)
+        with open(dst) as f:
+            self.assertEqual(f.read(), 'apple')
+        self.assertEqual(os.stat(self.src).st_mtime, os.stat(dst).st_mtime)
+
+    def test_link_or_copy_existing(self):
+        dst = path.join(self.work_dir, 'dst.txt')
+        linked = path.join(self.work_dir, 'linked.txt')
+        with open(linked, 'w') as f:
+            f.write('old')
+        os.link(linked, dst)
+        utils.link_or_copy(self.src, dst)
+        with open(dst) as f:
+            self.assertEqual(f.read(), 'apple')
+        # the file dst was linked to is left untouched
+        with open(linked) as f:
+            self.assertEqual(f.read(), 'old')
+        self.assertEqual(sorted(os.listdir(self.work_dir)), ['dst.txt', 'linked.txt', 'src.txt'])
@@ -10,7 +10,7 @@ from doodad.wrappers.easy_launch import run_experiment, metadata
 from doodad.wrappers.easy_launch import config
 from doodad.wrappers.easy_launch.metadata import save_doodad_config
 from doodad.wrappers.sweeper import DoodadSweeper
-from doodad.wrappers.sweeper.hyper_sweep import Sweeper
+from doodad.wrappers.sweeper.hyper_sweep import make_sweeper
 
 
 def sweep_function(
@@ -67,7 +67,8 @@ def sweep_function(
     :param method_call: A function that takes in two parameters:
         doodad_config: metadata.DoodadConfig
         variant: dictionary
-    :param params:
+    :param params: A dictionary of hyperparameters to grid search over, a
+    list of them, or a Sweeper or sampler (see doodad.wrappers.sweeper)
     :param log_path:
     :param name_runs_by_id: If true, then each run will be in its own
     ```
@@ -206,7 +207,7 @@ def _run_method_here_no_doodad(
         method_call, doodad_config, params, default_params, log_path,
         create_final_log_path
 ):
-    sweeper = Sweeper(params, default_params)
+    sweeper = make_sweeper(params, default_params)
     for xid, param in enumerate(sweeper):
         new_log_path = create_final_log_path(log_path, xid)
         doodad_config = doodad_config._replace(
@@ -13,10 +13,18 @@ or
 run_sweep_serial(path_to_script, args)
 
 """
+import bisect
+import collections
 import copy
-import itertools
+import functools
+import hashlib
+import json
 import os
+import threading
+import time
 import random
+import traceback
+from concurrent import futures
 
 from doodad import mount
 from doodad.darchive import archive_builder_docker as archive_builder
@@ -24,12 +32,111 @@ from doodad.launch import launch_api
 from doodad.wrappers.sweeper import pythonplusplus as ppp
 
 
-class Sweeper(object):
+class ConfigSequence(object):
+    """
+    A sequence of configs which are generated on demand.
+
+    It can be indexed, sliced and measured with len() without generating
+    the configs before the one asked for. A slice is another lazy sequence.
+
+    Subclasses implement _assignments(index), which returns the (key path,
+    value) of each hyperparameter in the config at index. Key paths are
+    compiled from names with _compile_paths.
+
+    Keys with periods in them are converted into nested dictionaries, and
+    default_parameters are added to every config. Each config gets its own
+    nested dicts, but values from default_parameters which are not dicts
+    (e.g. lists) are shared between configs rather than copied, so they
+    should not be mutated in place.
+    """
+    def __init__(self, size, default_parameters=None):
+        """
+        :param size: Number of configs
+        :param default_parameters: Default key-value pairs to add to generated
+        config.
+        """
+        self._default_kwargs = copy.deepcopy(default_parameters or {})
+        # indices of the configs in this sequence (all of them, unless this
+        # is a slice of another sequence)
+        self._indices = range(size)
+
+    @staticmethod
+    def _compile_paths(names):
+        """
+        :param names: Hyperparameter names, with periods separating keys of
+        nested dictionaries
+        :return: The tuple of keys of each name
+        """
+        # raises for conflicting keys such as 'a' and 'a.b'
+        ppp.dot_map_dict_to_nested_dict({name: None for name in names})
+        return [tuple(name.split('.')) for name in names]
+
+    def __len__(self):
+        return len(self._indices)
+
+    def __getitem__(self, index):
+        """
+        :param index: An int, or a slice to get a sequence over a subset of
+        the configs.
+        :return: The config at index, or a sequence of the same type if
+        index is a slice.
+        """
+        if isinstance(index, slice):
+            sequence = copy.copy(self)
+            sequence._indices = self._indices[index]
+            return sequence
+        return self._config(self._indices[index])
+
+    def __iter__(self):
+        """
+        :return: List of dictionaries. Each dictionary is a map from name to
+        hyperpameter.
+        """
+        for index in self._indices:
+            yield self._config(index)
+
+    def _assignments(self, index):
+        raise NotImplementedError()
+
+    def _config(self, index):
+        config = {}
+        for path, value in self._assignments(index):
+            node = config
+            for key in path[:-1]:
+                node = node.setdefault(key, {})
+            node[path[-1]] = _copy_dicts(value)
+        _fill_defaults(config, self._default_kwargs)
+        return config
+
+
+class Sweeper(ConfigSequence):
     """
     Do a grid search over hyperparameters based on a predefined set of
     hyperparameters.
+
+    Configs are generated on demand, so a sweeper takes memory proportional
+    to the number of hyperparameter values rather than the size of the grid:
+    ```
+    sweeper = Sweeper({'lr': [1e-3, 1e-4], 'seed': range(1000)})
+    len(sweeper)  # 2000
+    sweeper[1001]  # {'lr': 1e-4, 'seed': 1}
+    for config in sweeper[::100]:  # every 100th config
+        ...
+    ```
+    The configs are in the order of itertools.product over the
+    hyperparameters, i.e. the last hyperparameter varies fastest.
+
+    Invalid combinations are never enumerated if they are described with
+    sub-grids or exclusions, and len() and indexing count only valid
+    configs:
+    ```
+    Sweeper([
+        {'optimizer': ['sgd'], 'sgd.momentum': [0, 0.9]},
+        {'optimizer': ['adam'], 'adam.beta1': [0.9, 0.99]},
+    ], exclude=[{'optimizer': 'sgd', 'sgd.momentum': 0.9}])  # 3 configs
+    ```
     """
-    def __init__(self, hyperparameters, default_parameters=None):
+    def __init__(self, hyperparameters, default_parameters=None, exclude=None):
         """
 
         :param hyperparameters: A dictionary of the form
@@ -40,10 +147,23 @@ class Sweeper(object):
             ...
         }
         ```
+        or a list of such dictionaries to sweep over the union of their
+        grids, in order. A config which is in several grids is generated
+        once for each.
         This format is like the param_grid in SciKit-Learn:
         http://scikit-learn.org/stable/modules/grid_search.html#exhaustive-grid-search
         :param default_parameters: Default key-value pairs to add to generated
         config.
+        :param exclude: A list of dictionaries from hyperparameter name to a
+        value or a list of values. Configs matching every entry of one of
+        them are skipped, e.g. {'optimizer': 'sgd', 'lr': [1, 10]} skips
+        the configs with optimizer sgd and lr 1 or 10. An exclusion only
+        applies to the grids in which all its names are hyperparameters.
+        A ValueError is raised for an empty exclusion, which would exclude
+        every config, and for one which matches no config of any grid,
+        which is most likely a typo.
+        Without exclusions, the configs of each grid are in the order of
+        itertools.product; excluding configs reorders those which remain.
 
         Keys with periods in them are converted into nested dictionaries. I.e.
         ```
@@ -61,30 +181,135 @@ class Sweeper(object):
         ```
         """
         self._hyperparameters = hyperparameters
-        self._default_kwargs = default_parameters or {}
-        named_hyperparameters = []
-        for name, values in self._hyperparameters.items():
-            named_hyperparameters.append(
-                [(name, v) for v in values]
-            )
-        self._hyperparameters_dicts = [
-            ppp.dot_map_dict_to_nested_dict(dict(tuple_list))
-            for tuple_list in itertools.product(*named_hyperparameters)
-        ]
+        exclude = exclude or []
+        for exclusion in exclude:
+            if not exclusion:
+                raise ValueError('An empty exclusion would exclude every config')
+        # whether each exclusion matches a config of some grid
+        matched = [False] * len(exclude)
+        if isinstance(hyperparameters, (list, tuple)):
+            grids = hyperparameters
+        else:
+            grids = [hyperparameters]
+        # the valid configs, as a disjoint union of boxes. A box is a grid
+        # restricted to a subset of the values of each hyperparameter:
+        # (key paths, values, allowed value positions of each hyperparameter)
+        self._boxes = []
+        # index of the first config of each box
+        self._offsets = []
+        size = 0
+        for grid in grids:
+            paths = self._compile_paths(grid)
+            grid_values = [list(values) for values in grid.values()]
+            boxes = [[range(len(values)) for values in grid_values]]
+            for i, exclusion in enumerate(exclude):
+                if not all(name in grid for name in exclusion):
+                    continue
+                excluded = {}
+                for axis, name in enumerate(grid):
+                    if name in exclusion:
+                        excluded_values = _as_list(exclusion[name])
+                        excluded[axis] = {position for position, value in enumerate(grid_values[axis])
+                                          if value in excluded_values}
+                if all(excluded.values()):
+                    matched[i] = True
+                boxes = [piece for box in boxes for piece in _subtract_box(box, excluded)]
+            for box in boxes:
+                box_size = _box_size(box)
+                if box_size:
+                    self._boxes.append((paths, grid_values, box))
+                    self._offsets.append(size)
+                    size += box_size
+        for exclusion, exclusion_matched in zip(exclude, matched):
+            if not exclusion_matched:
+                raise ValueError('Exclusion {} matches no config'.format(exclusion))
+        super(Sweeper, self).__init__(size, default_parameters)
 
-    def __iter__(self):
-        """
-        Iterate over the hyperparameters in a grid-manner.
+    def _assignments(self, index):
+        box_index = bisect.bisect_right(self._offsets, index) - 1
+        paths, grid_values, box = self._boxes[box_index]
+        index -= self._offsets[box_index]
+        # decode index as a mixed-radix number, one digit per
+        # hyperparameter with the last one least significant
+        positions = []
+        for allowed in reversed(box):
+            index, digit = divmod(index, len(allowed))
+            positions.append(allowed[digit])
+        return [(path, values[position])
+                for path, values, position in zip(paths, grid_values, reversed(positions))]
 
-        :return: List of dictionaries. Each dictionary is a map from name to
-        hyperpameter.
-        """
-        for hyperparameters in self._hyperparameters_dicts:
-            yield ppp.merge_recursive_dicts(
-                hyperparameters,
-                copy.deepcopy(self._default_kwargs),
-                ignore_duplicate_keys_in_second_dict=True,
-            )
+
+def _as_list(value):
+    if isinstance(value, (list, tuple, set)):
+        return list(value)
+    return [value]
+
+
+def _box_size(box):
+    size = 1
+    for allowed in box:
+        size *= len(allowed)
+    return size
+
+
+def _subtract_box(box, excluded):
+    """
+    Remove the configs matching an exclusion from a box.
+
+    :param box: Allowed value positions of each hyperparameter
+    :param excluded: A dict from hyperparameter (axis) to the positions of
+    its excluded values. A config is excluded if it has an excluded value
+    for every axis in excluded.
+    :return: A list of disjoint boxes covering the rest of box
+    """
+    pieces = []
+    box = list(box)
+    for axis, positions in excluded.items():
+        outside = [position for position in box[axis] if position not in positions]
+        inside = [position for position in box[axis] if position in positions]
+        if outside:
+            pieces.append(box[:axis] + [outside] + box[axis + 1:])
+        if not inside:
+            return pieces
+        box[axis] = inside
+    # what remains of box is excluded
+    return pieces
+
+
+def make_sweeper(params, default_params=None):
+    """
+    :param params: A dictionary of hyperparameters to grid search over or a
+    list of them (see Sweeper), or a ConfigSequence such as a sampler from
+    doodad.wrappers.sweeper.samplers.
+    :param default_params: Default key-value pairs to add to each config of
+    a grid. A ConfigSequence takes these in its constructor instead.
+    :return: A ConfigSequence
+    """
+    if isinstance(params, ConfigSequence):
+        if default_params:
+            raise ValueError('Pass default parameters to the constructor of {}'.format(
+                type(params).__name__))
+        return params
+    return Sweeper(params, default_params)
+
+
+def _copy_dicts(value):
+    """ Copy the nested dicts of value, sharing everything else """
+    if isinstance(value, dict):
+        return {key: _copy_dicts(item) for key, item in value.items()}
+    return value
+
+
+def _fill_defaults(config, defaults):
+    """
+    Add the keys of defaults missing from config, recursing into dicts
+    present in both. Values already in config take precedence.
+    """
+    for key, default in defaults.items():
+        if key not in config:
+            config[key] = _copy_dicts(default)
+        elif isinstance(config[key], dict) and isinstance(default, dict):
+            _fill_defaults(config[key], default)
 
 
 def chunker(sweeper, num_chunks=10, confirm=True):
@@ -109,14 +334,186 @@ def chunker(sweeper, num_chunks=10, confirm=True):
         return []
 
 
+def config_hash(config):
+    """
+    A hash of config which is the same in every process, e.g. to recognize
+    a config when a sweep is resumed. Values which cannot be encoded as
+    JSON are hashed by their repr.
+
+    :return: A hex string
+    """
+    encoded = json.dumps(config, sort_keys=True, separators=(',', ':'), default=repr)
+    return hashlib.sha1(encoded.encode('utf-8')).hexdigest()[:16]
+
+
+class SweepManifest(object):
+    """
+    A local record of the jobs of a sweep, to resume it without launching
+    finished work again.
+
+    The manifest is a JSON lines file with one entry per status change,
+    keyed by config_hash: the job index, status, config, output location
+    (the log path of the mode) and time, and the error for failed launches.
+    A job's status is 'launched' once its launch returned (it may still be
+    running), 'failed' if the launch raised, and 'succeeded' once it is
+    known to have finished, see run_sweep_doodad.
+    """
+    LAUNCHED = 'launched'
+    FAILED = 'failed'
+    SUCCEEDED = 'succeeded'
+
+    def __init__(self, filename):
+        """
+        :param filename: Path of the manifest. Entries already in it are
+        loaded, and new ones are appended.
+        """
+        self.filename = filename
+        # config hash -> latest entry
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if os.path.exists(filename):
+            with open(filename) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # a line cut short by a crash
+                        continue
+                    self._entries[entry['hash']] = entry
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, config_hash):
+        """
+        :return: The latest entry for config_hash, or None
+        """
+        with self._lock:
+            return self._entries.get(config_hash)
+
+    def entries(self, status=None):
+        """
+        :return: The latest entry of each job, with the given status if
+        status is not None
+        """
+        with self._lock:
+            return [entry for entry in self._entries.values() if status is None or entry['status'] == status]
+
+    def record(self, config_hash, status, **fields):
+        """
+        Append an entry for config_hash.
+
+        :param fields: Other fields of the entry, e.g. idx, config, output
+        and error
+        """
+        entry = dict(fields, hash=config_hash, status=status, time=time.time())
+        line = json.dumps(entry, sort_keys=True, default=repr)
+        with self._lock:
+            with open(self.filename, 'a') as f:
+                f.write(line + '\n')
+            self._entries[config_hash] = json.loads(line)
+        return entry
+
+
+def _output_location(run_mode):
+    for attr in ['log_path', 'gcp_log_path', 's3_log_path']:
+        location = getattr(run_mode, attr, None)
+        if location:
+            return location
+    return None
+
+
+def _is_done(manifest, config_hash, is_complete):
+    """
+    Whether a resumed sweep should skip the job of config_hash.
+    """
+    entry = manifest.get(config_hash)
+    if entry is None or entry['status'] == SweepManifest.FAILED:
+        return False
+    if entry['status'] == SweepManifest.SUCCEEDED:
+        return True
+    if is_complete is None:
+        # launched, and may still be running
+        return True
+    if is_complete(entry):
+        manifest.record(config_hash, SweepManifest.SUCCEEDED,
+                        **{k: v for k, v in entry.items() if k not in ['hash', 'status', 'time']})
+        return True
+    return False
+
+
+class LaunchSummary(object):
+    """
+    The outcome of launching each job of a sweep.
+
+    succeeded is a list of (job index, config) and failed a list of
+    (job index, config, exception), both in job order. skipped is a list of
+    (job index, config) of jobs which a resumed sweep did not launch again.
+    """
+    def __init__(self):
+        self.succeeded = []
+        self.failed = []
+        self.skipped = []
+
+    @property
+    def njobs(self):
+        return len(self.succeeded) + len(self.failed)
+
+    def __str__(self):
+        summary = '%d jobs launched, %d failed' % (len(self.succeeded), len(self.failed))
+        if self.skipped:
+            summary += ', %d skipped' % len(self.skipped)
+        return summary
+
+
 def run_sweep_doodad(
         target, params, run_mode, mounts, test_one=False,
         docker_image='python:3',
         is_docker_interactive=False,
         return_output=False, verbose=False,
         postprocess_config_and_run_mode=lambda config, run_mode, idx: (config, run_mode),
-        default_params=None
+        default_params=None,
+        archive_cache=None,
+        layer_cache=None,
+        staging_workers=1,
+        max_concurrent_launches=None,
+        raise_on_failure=True,
+        launch_summary=None,
+        manifest=None,
+        resume=False,
+        is_complete=None,
 ):
+    """
+    Launch a job for every config of a hyperparameter sweep.
+
+    :param params: A dictionary of hyperparameters to grid search over, a
+    list of them (see Sweeper), or a ConfigSequence such as a Sweeper with
+    exclusions or a sampler from doodad.wrappers.sweeper.samplers.
+    :param max_concurrent_launches: If greater than 1, launch up to this many
+    jobs at a time on a thread pool. postprocess_config_and_run_mode is still
+    called in job order from the calling thread, but each job gets its own
+    copy of run_mode, so the hook may mutate it freely. Configs are only
+    generated once a launch slot is free.
+    :param raise_on_failure: If True, no more jobs are launched once one
+    fails to launch, and its exception is raised after the jobs already in
+    flight finish (with several failures in flight, the one with the lowest
+    job index). If False, failed jobs are printed and recorded in
+    launch_summary, and the others are still launched. Either way this
+    does not depend on max_concurrent_launches.
+    :param launch_summary: If given, a LaunchSummary which is filled in with
+    the outcome of every job.
+    :param manifest: A SweepManifest, or the path of one, where the launch of
+    each job is recorded. Not used if test_one is True.
+    :param resume: If True, skip the jobs which the manifest records as
+    succeeded or launched, and launch the others (including those which
+    failed to launch). Skipped jobs keep their job index, so the others get
+    the same index as in the first launch.
+    :param is_complete: Called with the manifest entry of a launched job
+    when resuming, e.g. to check for a file the job writes to its output
+    location when it finishes. If it returns False the job is assumed to
+    have died and launched again. If not given, launched jobs are skipped.
+    :return: A tuple of the outputs of each job if return_output is True.
+    """
     # build archive
     target_dir = os.path.dirname(target)
     target_mount_dir = os.path.join('target', os.path.basename(target_dir))
@@ -130,6 +527,26 @@ def run_sweep_doodad(
     print('Launching jobs with mode %s' % run_mode)
     results = []
     njobs = 0
+    if launch_summary is None:
+        launch_summary = LaunchSummary()
+    concurrent = max_concurrent_launches is not None and max_concurrent_launches > 1 and not test_one
+    if test_one:
+        manifest = None
+    elif isinstance(manifest, str):
+        manifest = SweepManifest(manifest)
+    if resume and manifest is None:
+        raise ValueError('A manifest is needed to resume a sweep')
+
+    def record(idx, config, config_hash, job_mode, error=None):
+        if manifest is None:
+            return
+        if error is None:
+            manifest.record(config_hash, SweepManifest.LAUNCHED, idx=idx, config=config,
+                            output=_output_location(job_mode))
+        else:
+            manifest.record(config_hash, SweepManifest.FAILED, idx=idx, config=config,
+                            output=_output_location(job_mode), error=repr(error))
+
     with archive_builder.temp_archive_file() as archive_file:
         archive = archive_builder.build_archive(archive_filename=archive_file,
                                                 payload_script=command,
@@ -137,28 +554,114 @@ def run_sweep_doodad(
                                                 docker_image=docker_image,
                                                 is_docker_interactive=is_docker_interactive,
                                                 use_nvidia_docker=run_mode.use_gpu,
-                                                mounts=mounts)
-
-        sweeper = Sweeper(params, default_params)
-        for config in sweeper:
-            config, run_mode = postprocess_config_and_run_mode(config, run_mode, njobs)
-            if config is None:
-                continue
-            njobs += 1
+                                                mounts=mounts,
+                                                cache=archive_cache,
+                                                layer_cache=layer_cache,
+                                                staging_workers=staging_workers)
+
+        def launch(config, job_mode):
             cli_args= ' '.join(['--%s %s' % (key, config[key]) for key in config])
             cmd = archive + ' -- ' + cli_args
-            result = run_mode.run_script(cmd, return_output=return_output, verbose=False)
+            result = job_mode.run_script(cmd, return_output=return_output, verbose=False)
             if return_output:
                 result = archive_builder._strip_stdout(result)
-                results.append(result)
-            if test_one:
-                break
-    print('Launching completed for %d jobs' % njobs)
+            return result
+
+        sweeper = make_sweeper(params, default_params)
+        if concurrent:
+            # at most max_concurrent_launches jobs (and copies of run_mode)
+            # are in flight, so configs are still generated lazily
+            slots = threading.BoundedSemaphore(max_concurrent_launches)
+            # job index -> (config, result, exception)
+            outcomes = {}
+            outcomes_lock = threading.Lock()
+            failed = threading.Event()
+
+            def on_done(job, idx, config, sweep_config, key, job_mode):
+                try:
+                    error = job.exception()
+                    # recorded as soon as each launch finishes, so the
+                    # manifest is up to date if the sweep dies
+                    record(idx, sweep_config, key, job_mode, error=error)
+                    if error is not None:
+                        failed.set()
+                        if not raise_on_failure:
+                            print('Failed to launch job %d:' % idx)
+                            traceback.print_exception(type(error), error, error.__traceback__)
+                    result = job.result() if error is None and return_output else None
+                    with outcomes_lock:
+                        outcomes[idx] = (config, result, error)
+                finally:
+                    slots.release()
+
+            with futures.ThreadPoolExecutor(max_concurrent_launches) as executor:
+                for config in sweeper:
+                    if raise_on_failure and failed.is_set():
+                        break
+                    key = config_hash(config)
+                    if resume and _is_done(manifest, key, is_complete):
+                        launch_summary.skipped.append((njobs, config))
+                        njobs += 1
+                        continue
+                    slots.acquire()
+                    if raise_on_failure and failed.is_set():
+                        slots.release()
+                        break
+                    sweep_config = config
+                    config, job_mode = postprocess_config_and_run_mode(config, copy.deepcopy(run_mode), njobs)
+                    if config is None:
+                        slots.release()
+                        continue
+                    job = executor.submit(launch, config, job_mode)
+                    job.add_done_callback(functools.partial(
+                        on_done, idx=njobs, config=config, sweep_config=sweep_config, key=key, job_mode=job_mode))
+                    njobs += 1
+            for idx in sorted(outcomes):
+                config, result, error = outcomes[idx]
+                if error is not None:
+                    launch_summary.failed.append((idx, config, error))
+                    continue
+                launch_summary.succeeded.append((idx, config))
+                if return_output:
+                    results.append(result)
+            if raise_on_failure and launch_summary.failed:
+                raise launch_summary.failed[0][2]
+        else:
+            for config in sweeper:
+                key = config_hash(config)
+                if resume and _is_done(manifest, key, is_complete):
+                    launch_summary.skipped.append((njobs, config))
+                    njobs += 1
+                    continue
+                sweep_config = config
+                config, run_mode = postprocess_config_and_run_mode(config, run_mode, njobs)
+                if config is None:
+                    continue
+                try:
+                    result = launch(config, run_mode)
+                except Exception as e:
+                    record(njobs, sweep_config, key, run_mode, error=e)
+                    launch_summary.failed.append((njobs, config, e))
+                    if raise_on_failure:
+                        raise
+                    print('Failed to launch job %d:' % njobs)
+                    traceback.print_exception(type(e), e, e.__traceback__)
+                else:
+                    launch_summary.succeeded.append((njobs, config))
+                    record(njobs, sweep_config, key, run_mode)
+                    if return_output:
+                        results.append(result)
+                njobs += 1
+                if test_one:
+                    break
+    print('Launching completed for %d jobs' % (njobs - len(launch_summary.skipped)))
+    if launch_summary.failed or launch_summary.skipped:
+        print(launch_summary)
     run_mode.print_launch_message()
     return tuple(results)
 
 
-def run_sweep_doodad_chunked(target, params, run_mode, mounts, num_chunks=10, docker_image='python:3', return_output=False, test_one=False, confirm=True, verbose=False):
+def run_sweep_doodad_chunked(target, params, run_mode, mounts, num_chunks=10, docker_image='python:3', return_output=False, test_one=False, confirm=True, verbose=False, archive_cache=None, layer_cache=None, staging_workers=1):
     # build archive
     target_dir = os.path.dirname(target)
     target_mount_dir = os.path.join('target', os.path.basename(target_dir))
@@ -178,9 +681,12 @@ def run_sweep_doodad_chunked(target, params, run_mode, mounts, num_chunks=10, do
                                                 verbose=verbose,
                                                 docker_image=docker_image,
                                                 use_nvidia_docker=run_mode.use_gpu,
-                                                mounts=mounts)
+                                                mounts=mounts,
+                                                cache=archive_cache,
+                                                layer_cache=layer_cache,
+                                                staging_workers=staging_workers)
 
-        sweeper = Sweeper(params)
+        sweeper = make_sweeper(params)
         chunks = chunker(sweeper, num_chunks, confirm=confirm)
         for chunk in chunks:
             command = ''
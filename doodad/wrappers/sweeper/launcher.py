@@ -138,6 +138,7 @@ class DoodadSweeper(object):
                         num_gpu=1,
                         gpu_model='nvidia-tesla-k80',
                         overwrite_logs=False,
+                        shared_network=False,
                         **kwargs):
         """
         Run a grid search on GCP
@@ -165,6 +166,7 @@ class DoodadSweeper(object):
             gpu_model=gpu_model,
             num_gpu=num_gpu,
             overwrite_logs=overwrite_logs,
+            shared_network=shared_network,
         )
         if num_chunks > 0:
             hyper_sweep.run_sweep_doodad_chunked(target, params,
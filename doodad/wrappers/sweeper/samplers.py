@@ -0,0 +1,250 @@
+"""
+Random search over hyperparameters.
+
+Usage
+
+sampler = LatinHypercubeSampler({
+    'lr': LogUniform(1e-5, 1e-2),
+    'dropout': Uniform(0, 0.5),
+    'optimizer': ['adam', 'sgd'],
+}, num_samples=100, seed=0)
+
+run_sweep_doodad(path_to_script, sampler, run_mode, mounts)
+
+Samplers can be used wherever a dictionary of hyperparameters to grid
+search over is accepted. Like Sweeper, they generate each config on demand
+from its index, so they can be indexed and sliced, and take constant memory
+however many samples are drawn. The same seed always gives the same configs.
+"""
+import math
+import random
+
+from doodad.wrappers.sweeper import hyper_sweep
+
+
+class Distribution(object):
+    """
+    A distribution over the values of one hyperparameter.
+    """
+    def from_unit(self, u):
+        """
+        :param u: A number in [0, 1)
+        :return: The value at quantile u of the distribution
+        """
+        raise NotImplementedError()
+
+
+class Uniform(Distribution):
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+
+    def from_unit(self, u):
+        return self.low + u * (self.high - self.low)
+
+
+class LogUniform(Distribution):
+    """
+    A distribution whose log is uniform, e.g. for learning rates.
+    """
+    def __init__(self, low, high):
+        if low <= 0 or high <= 0:
+            raise ValueError('LogUniform needs positive bounds, got {} and {}'.format(low, high))
+        self.low = low
+        self.high = high
+
+    def from_unit(self, u):
+        return math.exp(math.log(self.low) + u * (math.log(self.high) - math.log(self.low)))
+
+
+class Choice(Distribution):
+    """
+    Pick one of values, each with the same probability.
+    """
+    def __init__(self, values):
+        self.values = list(values)
+        if not self.values:
+            raise ValueError('Choice needs at least one value')
+
+    def from_unit(self, u):
+        return self.values[min(int(u * len(self.values)), len(self.values) - 1)]
+
+
+class Sampler(hyper_sweep.ConfigSequence):
+    """
+    Draw num_samples configs from a distribution over each hyperparameter.
+
+    Subclasses implement _unit_sample(index), which returns a point of the
+    unit hypercube with one coordinate per hyperparameter.
+    """
+    def __init__(self, hyperparameters, num_samples, default_parameters=None, seed=0):
+        """
+        :param hyperparameters: A dictionary from name to a Distribution.
+        Lists are sampled from with Choice. As with Sweeper, keys with
+        periods in them are converted into nested dictionaries.
+        :param num_samples: Number of configs
+        :param default_parameters: Default key-value pairs to add to generated
+        config.
+        :param seed: An int. The same seed always gives the same configs.
+        """
+        self._distributions = [
+            dist if isinstance(dist, Distribution) else Choice(dist)
+            for dist in hyperparameters.values()
+        ]
+        self.num_samples = num_samples
+        self.seed = seed
+        self._paths = self._compile_paths(hyperparameters)
+        super(Sampler, self).__init__(num_samples, default_parameters)
+
+    def _unit_sample(self, index):
+        raise NotImplementedError()
+
+    def _assignments(self, index):
+        return [(path, dist.from_unit(u))
+                for path, dist, u in zip(self._paths, self._distributions, self._unit_sample(index))]
+
+    def _rng(self, index):
+        # string seeds are hashed the same way on every platform and
+        # python version
+        return random.Random('{}-{}'.format(self.seed, index))
+
+
+class RandomSampler(Sampler):
+    """
+    Sample each config independently.
+    """
+    def _unit_sample(self, index):
+        rng = self._rng(index)
+        return [rng.random() for _ in self._distributions]
+
+
+class LatinHypercubeSampler(Sampler):
+    """
+    Latin hypercube sampling: for every hyperparameter, each of the
+    num_samples equal-probability strata of its distribution gets exactly
+    one sample. This covers each hyperparameter more evenly than
+    independent sampling.
+    """
+    def _unit_sample(self, index):
+        rng = self._rng(index)
+        return [
+            (_permute(index, self.num_samples, _mix(_mix(self.seed) ^ dim)) + rng.random()) / self.num_samples
+            for dim in range(len(self._distributions))
+        ]
+
+
+class SobolSampler(Sampler):
+    """
+    Sample from a Sobol sequence, which fills the hypercube more evenly
+    than independent samples. Its balance properties hold for prefixes of
+    2^k samples, so num_samples should preferably be a power of two.
+
+    The sequence is randomized with a digital shift determined by the seed.
+    Supports up to MAX_DIMENSIONS hyperparameters.
+    """
+    MAX_DIMENSIONS = 21
+
+    def __init__(self, hyperparameters, num_samples, default_parameters=None, seed=0):
+        if len(hyperparameters) > self.MAX_DIMENSIONS:
+            raise ValueError('SobolSampler supports up to {} hyperparameters, got {}'.format(
+                self.MAX_DIMENSIONS, len(hyperparameters)))
+        if num_samples > 1 << _SOBOL_BITS:
+            raise ValueError('SobolSampler supports up to 2^{} samples'.format(_SOBOL_BITS))
+        super(SobolSampler, self).__init__(hyperparameters, num_samples, default_parameters, seed=seed)
+        self._directions = [_sobol_directions(dim) for dim in range(len(self._distributions))]
+        rng = self._rng('shift')
+        self._shifts = [rng.getrandbits(_SOBOL_BITS) for _ in self._distributions]
+
+    def _unit_sample(self, index):
+        # the index-th point in gray code order, which is the xor of the
+        # direction numbers of the bits set in gray code of index
+        gray = index ^ (index >> 1)
+        sample = []
+        for directions, shift in zip(self._directions, self._shifts):
+            x = shift
+            bit = 0
+            while gray >> bit:
+                if (gray >> bit) & 1:
+                    x ^= directions[bit]
+                bit += 1
+            sample.append(x / float(1 << _SOBOL_BITS))
+        return sample
+
+
+_MASK64 = (1 << 64) - 1
+
+
+def _mix(x):
+    """ The splitmix64 finalizer, a fast bijective hash of 64 bit ints """
+    x = (x + 0x9e3779b97f4a7c15) & _MASK64
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & _MASK64
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & _MASK64
+    return x ^ (x >> 31)
+
+
+def _permute(index, n, key, rounds=4):
+    """
+    Map index to its position in a pseudorandom permutation of range(n)
+    determined by key, without storing the permutation.
+
+    A Feistel network is a bijection on the smallest power of 4 which is at
+    least n. Indices which it maps to n or more are mapped again until they
+    land in range(n) ("cycle walking"), which keeps it a bijection.
+    """
+    half_bits = max(1, ((n - 1).bit_length() + 1) // 2)
+    mask = (1 << half_bits) - 1
+    x = index
+    while True:
+        left, right = x >> half_bits, x & mask
+        for r in range(rounds):
+            left, right = right, left ^ (_mix(key ^ (r << 56) ^ right) & mask)
+        x = (left << half_bits) | right
+        if x < n:
+            return x
+
+
+_SOBOL_BITS = 32
+
+# Primitive polynomials (degree s, coefficients a) and initial direction
+# numbers m for dimensions 2 and up, from Joe and Kuo,
+# https://web.maths.unsw.edu.au/~fkuo/sobol/new-joe-kuo-6.21201
+_SOBOL_PARAMETERS = [
+    (1, 0, [1]),
+    (2, 1, [1, 3]),
+    (3, 1, [1, 3, 1]),
+    (3, 2, [1, 1, 1]),
+    (4, 1, [1, 1, 3, 3]),
+    (4, 4, [1, 3, 5, 13]),
+    (5, 2, [1, 1, 5, 5, 17]),
+    (5, 4, [1, 1, 5, 5, 5]),
+    (5, 7, [1, 1, 7, 11, 19]),
+    (5, 11, [1, 1, 5, 1, 1]),
+    (5, 13, [1, 1, 1, 3, 11]),
+    (5, 14, [1, 3, 5, 5, 31]),
+    (6, 1, [1, 3, 3, 9, 7, 49]),
+    (6, 13, [1, 1, 1, 15, 21, 21]),
+    (6, 16, [1, 3, 1, 13, 27, 49]),
+    (6, 19, [1, 1, 1, 15, 7, 5]),
+    (6, 22, [1, 3, 1, 15, 13, 25]),
+    (6, 25, [1, 1, 5, 5, 19, 61]),
+    (7, 1, [1, 3, 7, 11, 23, 15, 103]),
+    (7, 4, [1, 3, 7, 13, 13, 15, 69]),
+]
+
+
+def _sobol_directions(dim):
+    """
+    :return: The direction numbers v_1..v_32 of dimension dim (0-based),
+    scaled to _SOBOL_BITS bits.
+    """
+    if dim == 0:
+        return [1 << (_SOBOL_BITS - k) for k in range(1, _SOBOL_BITS + 1)]
+    s, a, m = _SOBOL_PARAMETERS[dim - 1]
+    v = [m_k << (_SOBOL_BITS - k) for k, m_k in enumerate(m, start=1)]
+    for k in range(s, _SOBOL_BITS):
+        value = v[k - s] ^ (v[k - s] >> s)
+        for j in range(1, s):
+            if (a >> (s - 1 - j)) & 1:
+                value ^= v[k - j]
+        v.append(value)
+    return v[:_SOBOL_BITS]
@@ -3,6 +3,11 @@ import contextlib
 import itertools
 import os
 import random
+import shutil
+import tempfile
+import time
+
+import six
 
 from doodad import mode
 from doodad.utils import TESTING_DIR
@@ -25,6 +30,270 @@ class TestSweeper(unittest.TestCase):
         self.assertIn({'arg1': 2, 'arg2': 'a'}, cross_sweep)
         self.assertIn({'arg1': 2, 'arg2': 'b'}, cross_sweep)
 
+    def test_indexing(self):
+        cfg = {
+            'arg1': [1, 2, 3],
+            'module.arg2': ['a', 'b'],
+            'arg3': range(100),
+        }
+        sweeper = hyper_sweep.Sweeper(cfg, default_parameters={'module': {'arg4': True}})
+        expected = [
+            {'arg1': arg1, 'module': {'arg2': arg2, 'arg4': True}, 'arg3': arg3}
+            for arg1, arg2, arg3 in itertools.product(*cfg.values())
+        ]
+        self.assertEqual(len(sweeper), 600)
+        self.assertEqual(list(sweeper), expected)
+        self.assertEqual(sweeper[0], expected[0])
+        self.assertEqual(sweeper[257], expected[257])
+        self.assertEqual(sweeper[-1], expected[-1])
+        with self.assertRaises(IndexError):
+            sweeper[600]
+
+    def test_slicing(self):
+        sweeper = hyper_sweep.Sweeper({'arg1': range(10), 'arg2': range(10)})
+        expected = list(sweeper)
+        self.assertEqual(list(sweeper[5:50:7]), expected[5:50:7])
+        self.assertEqual(len(sweeper[::3]), len(expected[::3]))
+        self.assertEqual(sweeper[::3][1:][2], expected[::3][1:][2])
+        self.assertEqual(list(sweeper[200:]), [])
+
+    def test_defaults(self):
+        defaults = {'module': {'arg2': 'default', 'arg3': 0}, 'arg4': [1, 2]}
+        sweeper = hyper_sweep.Sweeper({'module': [{'arg3': 1}], 'arg5.arg6': ['a', 'b']}, defaults)
+        stdout = six.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            configs = list(sweeper)
+        self.assertEqual(stdout.getvalue(), '')
+        self.assertEqual(configs, [
+            {'module': {'arg2': 'default', 'arg3': 1}, 'arg5': {'arg6': 'a'}, 'arg4': [1, 2]},
+            {'module': {'arg2': 'default', 'arg3': 1}, 'arg5': {'arg6': 'b'}, 'arg4': [1, 2]},
+        ])
+        # nested dicts are not shared between configs
+        configs[0]['module']['arg3'] = 2
+        self.assertEqual(sweeper[0]['module']['arg3'], 1)
+        self.assertEqual(defaults['module'], {'arg2': 'default', 'arg3': 0})
+
+    def test_conflicting_keys(self):
+        with self.assertRaises(TypeError):
+            hyper_sweep.Sweeper({'arg1': [1], 'arg1.arg2': [2]})
+
+    def test_sub_grids(self):
+        sweeper = hyper_sweep.Sweeper([
+            {'optimizer': ['sgd'], 'sgd.momentum': [0, 0.9]},
+            {'optimizer': ['adam'], 'adam.beta1': [0.9, 0.99], 'adam.beta2': [0.999]},
+        ], default_parameters={'lr': 1e-3})
+        expected = [
+            {'optimizer': 'sgd', 'sgd': {'momentum': 0}, 'lr': 1e-3},
+            {'optimizer': 'sgd', 'sgd': {'momentum': 0.9}, 'lr': 1e-3},
+            {'optimizer': 'adam', 'adam': {'beta1': 0.9, 'beta2': 0.999}, 'lr': 1e-3},
+            {'optimizer': 'adam', 'adam': {'beta1': 0.99, 'beta2': 0.999}, 'lr': 1e-3},
+        ]
+        self.assertEqual(len(sweeper), 4)
+        self.assertEqual(list(sweeper), expected)
+        self.assertEqual(sweeper[2], expected[2])
+        self.assertEqual(list(sweeper[1:3]), expected[1:3])
+
+    def test_exclude(self):
+        cfg = {
+            'arg1': [1, 2, 3, 4],
+            'arg2': ['a', 'b', 'c'],
+            'arg3': [0, 1],
+        }
+        exclude = [
+            {'arg1': [1, 2], 'arg2': 'a'},
+            {'arg3': 1, 'arg1': 4},
+            {'arg1': 3, 'arg2': ['b', 'c'], 'arg3': 0},
+        ]
+        def excluded(config):
+            return ((config['arg1'] in [1, 2] and config['arg2'] == 'a') or
+                    (config['arg3'] == 1 and config['arg1'] == 4) or
+                    (config['arg1'] == 3 and config['arg2'] in ['b', 'c'] and config['arg3'] == 0))
+        expected = [config for config in hyper_sweep.Sweeper(cfg) if not excluded(config)]
+        sweeper = hyper_sweep.Sweeper(cfg, exclude=exclude)
+        self.assertEqual(len(sweeper), len(expected))
+        configs = [sweeper[i] for i in range(len(sweeper))]
+        self.assertEqual(list(sweeper), configs)
+        self.assertEqual(sorted(configs, key=repr), sorted(expected, key=repr))
+
+    def test_invalid_exclusions(self):
+        cfg = {'arg1': [1, 2], 'arg2': ['a', 'b']}
+        for exclusion in [{}, {'arg3': 1}, {'arg1': 3}, {'arg1': [1, 2], 'arg2': 'c'}]:
+            with self.assertRaises(ValueError):
+                hyper_sweep.Sweeper(cfg, exclude=[exclusion])
+        # matching a config in one of the grids is enough
+        sweeper = hyper_sweep.Sweeper([cfg, {'arg3': [1, 2]}], exclude=[{'arg3': 2}])
+        self.assertEqual(len(sweeper), 5)
+
+    def test_huge_grid(self):
+        sweeper = hyper_sweep.Sweeper({'arg%d' % i: range(10) for i in range(9)})
+        self.assertEqual(len(sweeper), 10 ** 9)
+        self.assertEqual(sweeper[12345678], {'arg%d' % i: i for i in range(9)})
+
+
+class RecordingMode(mode.LaunchMode):
+    """ Records the commands it is asked to run, failing for n=3 """
+    def __init__(self, fail=True):
+        super(RecordingMode, self).__init__()
+        self.log_path = None
+        self.launched = []
+        self.fail = fail
+
+    def run_script(self, script_filename, dry=False, return_output=False, verbose=False):
+        if self.fail and '--n 3' in script_filename:
+            raise RuntimeError('launch failed')
+        self.launched.append(self.log_path)
+        return '%s %s' % (self.log_path, script_filename.split(' -- ')[1])
+
+
+class TestConcurrentLaunch(unittest.TestCase):
+    def test_concurrent(self):
+        run_mode = RecordingMode()
+        job_modes = []
+        def postprocess(config, run_mode, idx):
+            run_mode.log_path = 'run%d' % idx
+            job_modes.append(run_mode)
+            return config, run_mode
+        summary = hyper_sweep.LaunchSummary()
+        output = hyper_sweep.run_sweep_doodad(
+            target=SWEEPER_TEST_FILE,
+            params={'n': [1, 3, 5, 7]},
+            run_mode=run_mode,
+            mounts=[],
+            return_output=True,
+            postprocess_config_and_run_mode=postprocess,
+            max_concurrent_launches=4,
+            raise_on_failure=False,
+            launch_summary=summary,
+        )
+        self.assertEqual(output, ('run0 --n 1', 'run2 --n 5', 'run3 --n 7'))
+        self.assertEqual(summary.succeeded, [(0, {'n': 1}), (2, {'n': 5}), (3, {'n': 7})])
+        self.assertEqual([(idx, config) for idx, config, _ in summary.failed], [(1, {'n': 3})])
+        # every job launches with its own copy of the mode
+        self.assertEqual(run_mode.launched, [])
+        self.assertEqual([m.launched for m in job_modes], [['run0'], [], ['run2'], ['run3']])
+
+    def test_raise_on_failure(self):
+        # failures are handled the same way with and without concurrency
+        for max_concurrent_launches in [None, 4]:
+            summary = hyper_sweep.LaunchSummary()
+            with self.assertRaisesRegex(RuntimeError, 'launch failed'):
+                hyper_sweep.run_sweep_doodad(SWEEPER_TEST_FILE, {'n': [1, 3, 5, 7]}, RecordingMode(), [],
+                                             max_concurrent_launches=max_concurrent_launches,
+                                             launch_summary=summary)
+            self.assertEqual([(idx, config) for idx, config, _ in summary.failed], [(1, {'n': 3})])
+
+            summary = hyper_sweep.LaunchSummary()
+            output = hyper_sweep.run_sweep_doodad(SWEEPER_TEST_FILE, {'n': [1, 3, 5, 7]}, RecordingMode(), [],
+                                                  return_output=True,
+                                                  max_concurrent_launches=max_concurrent_launches,
+                                                  raise_on_failure=False, launch_summary=summary)
+            self.assertEqual(output, ('None --n 1', 'None --n 5', 'None --n 7'))
+            self.assertEqual(summary.succeeded, [(0, {'n': 1}), (2, {'n': 5}), (3, {'n': 7})])
+            self.assertEqual([(idx, config) for idx, config, _ in summary.failed], [(1, {'n': 3})])
+
+
+class SlowMode(mode.LaunchMode):
+    """ Counts the launches which finished """
+    def __init__(self):
+        super(SlowMode, self).__init__()
+        self.finished = []
+
+    def run_script(self, script_filename, dry=False, return_output=False, verbose=False):
+        time.sleep(0.01)
+        self.finished.append(script_filename)
+        return script_filename.split(' -- ')[1]
+
+
+class TestBoundedLaunch(unittest.TestCase):
+    def test_bounded(self):
+        run_mode = SlowMode()
+        in_flight = []
+        def postprocess(config, job_mode, idx):
+            in_flight.append(idx - len(run_mode.finished))
+            job_mode.finished = run_mode.finished
+            return config, job_mode
+        output = hyper_sweep.run_sweep_doodad(
+            target=SWEEPER_TEST_FILE,
+            params={'n': range(20)},
+            run_mode=run_mode,
+            mounts=[],
+            return_output=True,
+            postprocess_config_and_run_mode=postprocess,
+            max_concurrent_launches=2,
+        )
+        self.assertEqual(output, tuple('--n %d' % n for n in range(20)))
+        # a config is only generated once fewer than 2 jobs are in flight
+        self.assertLessEqual(max(in_flight), 1)
+
+
+class TestResume(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.manifest_path = os.path.join(self.work_dir, 'manifest.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def run_sweep(self, run_mode, **kwargs):
+        def postprocess(config, run_mode, idx):
+            run_mode.log_path = 'run%d' % idx
+            return config, run_mode
+        summary = hyper_sweep.LaunchSummary()
+        output = hyper_sweep.run_sweep_doodad(
+            target=SWEEPER_TEST_FILE,
+            params={'n': [1, 3, 5, 7]},
+            run_mode=run_mode,
+            mounts=[],
+            return_output=True,
+            postprocess_config_and_run_mode=postprocess,
+            launch_summary=summary,
+            manifest=self.manifest_path,
+            **kwargs
+        )
+        return output, summary
+
+    def test_config_hash(self):
+        self.assertEqual(hyper_sweep.config_hash({'a': 1, 'b': {'c': [1, 2]}}),
+                         hyper_sweep.config_hash({'b': {'c': [1, 2]}, 'a': 1}))
+        self.assertNotEqual(hyper_sweep.config_hash({'a': 1}), hyper_sweep.config_hash({'a': 2}))
+
+    def test_resume(self):
+        for max_concurrent_launches in [None, 4]:
+            if os.path.exists(self.manifest_path):
+                os.remove(self.manifest_path)
+            self.run_sweep(RecordingMode(), max_concurrent_launches=max_concurrent_launches,
+                           raise_on_failure=False)
+            manifest = hyper_sweep.SweepManifest(self.manifest_path)
+            self.assertEqual(sorted((entry['idx'], entry['output']) for entry in manifest.entries('launched')),
+                             [(0, 'run0'), (2, 'run2'), (3, 'run3')])
+            failed = manifest.entries('failed')
+            self.assertEqual([(entry['idx'], entry['config']) for entry in failed], [(1, {'n': 3})])
+            self.assertIn('launch failed', failed[0]['error'])
+
+            # only the failed job is launched again, with its original index
+            run_mode = RecordingMode(fail=False)
+            output, summary = self.run_sweep(run_mode, resume=True,
+                                             max_concurrent_launches=max_concurrent_launches)
+            self.assertEqual(output, ('run1 --n 3',))
+            self.assertEqual([idx for idx, _ in summary.skipped], [0, 2, 3])
+            self.assertEqual(hyper_sweep.SweepManifest(self.manifest_path).entries('failed'), [])
+
+    def test_is_complete(self):
+        self.run_sweep(RecordingMode(fail=False))
+        output, summary = self.run_sweep(RecordingMode(fail=False), resume=True,
+                                         is_complete=lambda entry: entry['output'] != 'run2')
+        self.assertEqual(output, ('run2 --n 5',))
+        manifest = hyper_sweep.SweepManifest(self.manifest_path)
+        self.assertEqual(sorted(entry['idx'] for entry in manifest.entries('succeeded')), [0, 1, 3])
+        self.assertEqual([entry['idx'] for entry in manifest.entries('launched')], [2])
+        # succeeded jobs are not checked again
+        output, summary = self.run_sweep(RecordingMode(fail=False), resume=True, is_complete=lambda entry: False)
+        self.assertEqual(output, ('run2 --n 5',))
+
+    def test_resume_needs_manifest(self):
+        with self.assertRaises(ValueError):
+            hyper_sweep.run_sweep_doodad(SWEEPER_TEST_FILE, {'n': [1]}, RecordingMode(), [], resume=True)
+
 
 class TestDoodadSweep(unittest.TestCase):
     def setUp(self):
@@ -0,0 +1,71 @@
+import unittest
+
+from doodad.wrappers.sweeper import hyper_sweep, samplers
+
+
+class TestDistributions(unittest.TestCase):
+    def test_from_unit(self):
+        self.assertEqual(samplers.Uniform(1, 3).from_unit(0.25), 1.5)
+        self.assertAlmostEqual(samplers.LogUniform(1e-4, 1).from_unit(0.5), 1e-2)
+        choice = samplers.Choice(['a', 'b', 'c'])
+        self.assertEqual([choice.from_unit(u) for u in [0, 0.3, 0.5, 0.99]], ['a', 'a', 'b', 'c'])
+        with self.assertRaises(ValueError):
+            samplers.LogUniform(0, 1)
+
+
+class TestSamplers(unittest.TestCase):
+    def setUp(self):
+        self.hyperparameters = {
+            'lr': samplers.LogUniform(1e-5, 1e-1),
+            'module.dropout': samplers.Uniform(0, 0.5),
+            'optimizer': ['adam', 'sgd'],
+        }
+
+    def test_configs(self):
+        for sampler_cls in [samplers.RandomSampler, samplers.LatinHypercubeSampler, samplers.SobolSampler]:
+            sampler = sampler_cls(self.hyperparameters, num_samples=16, default_parameters={'module': {'width': 4}},
+                                  seed=1)
+            configs = list(sampler)
+            self.assertEqual(len(configs), 16)
+            for config in configs:
+                self.assertEqual(set(config), {'lr', 'module', 'optimizer'})
+                self.assertTrue(1e-5 <= config['lr'] < 1e-1)
+                self.assertTrue(0 <= config['module']['dropout'] < 0.5)
+                self.assertEqual(config['module']['width'], 4)
+                self.assertIn(config['optimizer'], ['adam', 'sgd'])
+            # seeded and index-addressable
+            self.assertEqual(list(sampler_cls(self.hyperparameters, num_samples=16,
+                                              default_parameters={'module': {'width': 4}}, seed=1)), configs)
+            self.assertEqual(sampler[5], configs[5])
+            self.assertEqual(list(sampler[3::4]), configs[3::4])
+            self.assertNotEqual(list(sampler_cls(self.hyperparameters, num_samples=16, seed=2)), configs)
+
+    def test_latin_hypercube(self):
+        num_samples = 37
+        sampler = samplers.LatinHypercubeSampler(
+            {'x': samplers.Uniform(0, 1), 'y': samplers.Uniform(0, 1)}, num_samples=num_samples, seed=3)
+        for key in ['x', 'y']:
+            strata = sorted(int(config[key] * num_samples) for config in sampler)
+            self.assertEqual(strata, list(range(num_samples)))
+
+    def test_sobol(self):
+        sampler = samplers.SobolSampler({'x%d' % i: samplers.Uniform(0, 1) for i in range(3)}, num_samples=8)
+        sampler._shifts = [0, 0, 0]
+        points = [[config['x%d' % i] for i in range(3)] for config in sampler]
+        self.assertEqual(points[:5], [[0, 0, 0], [0.5, 0.5, 0.5], [0.75, 0.25, 0.25],
+                                      [0.25, 0.75, 0.75], [0.375, 0.375, 0.625]])
+        for dim in range(3):
+            self.assertEqual(sorted(point[dim] for point in points), [i / 8. for i in range(8)])
+        with self.assertRaises(ValueError):
+            samplers.SobolSampler({'x%d' % i: samplers.Uniform(0, 1) for i in range(22)}, num_samples=8)
+
+    def test_make_sweeper(self):
+        sampler = samplers.RandomSampler(self.hyperparameters, num_samples=4)
+        self.assertIs(hyper_sweep.make_sweeper(sampler), sampler)
+        with self.assertRaises(ValueError):
+            hyper_sweep.make_sweeper(sampler, {'width': 4})
+        self.assertIsInstance(hyper_sweep.make_sweeper({'x': [1, 2]}), hyper_sweep.Sweeper)
+
+
+if __name__ == '__main__':
+    unittest.main()
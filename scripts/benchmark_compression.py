@@ -0,0 +1,77 @@
+"""
+Compare archive compression backends on a local directory.
+
+For every installed backend, builds a Doodad Archive of the directory and
+reports the archive size, compression ratio, build time and extract time.
+
+Example:
+    python scripts/benchmark_compression.py ~/code/my_project -l 1 -t 0
+"""
+import os
+import time
+import shutil
+import tempfile
+import subprocess
+import argparse
+
+from doodad import mount
+from doodad.darchive import archive_builder_docker as archive_builder
+from doodad.utils import which
+
+
+def dir_size(dirname):
+    total = 0
+    for root, _, files in os.walk(dirname):
+        for fname in files:
+            fname = os.path.join(root, fname)
+            if not os.path.islink(fname):
+                total += os.path.getsize(fname)
+    return total
+
+
+def benchmark(local_dir, compression, level=None, threads=None):
+    work_dir = tempfile.mkdtemp()
+    try:
+        archive = os.path.join(work_dir, 'bench.dar')
+        mnt = mount.MountLocal(local_dir=local_dir, mount_point='./code')
+        start = time.time()
+        archive_builder.build_archive(archive_filename=archive,
+                                      payload_script='true',
+                                      mounts=[mnt],
+                                      compression=compression,
+                                      compression_level=level,
+                                      compression_threads=threads)
+        build_time = time.time() - start
+
+        target = os.path.join(work_dir, 'extracted')
+        start = time.time()
+        subprocess.check_call(['sh', archive, '--quiet', '--noexec', '--target', target])
+        extract_time = time.time() - start
+        return os.path.getsize(archive), dir_size(target), build_time, extract_time
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark archive compression backends.')
+    parser.add_argument('local_dir', type=str, help='Directory to archive')
+    parser.add_argument('-c', '--compression', type=str, nargs='+',
+                        default=sorted(archive_builder.COMPRESSION_BACKENDS),
+                        help='Backends to compare')
+    parser.add_argument('-l', '--level', type=int, default=None, help='Compression level')
+    parser.add_argument('-t', '--threads', type=int, default=None, help='Compression threads')
+    args = parser.parse_args()
+
+    print('%-6s %12s %8s %10s %10s' % ('codec', 'size', 'ratio', 'build(s)', 'extract(s)'))
+    for compression in args.compression:
+        binary = archive_builder.COMPRESSION_BACKENDS[compression][1]
+        if binary is not None and which(binary) is None:
+            print('%-6s not installed' % compression)
+            continue
+        size, raw_size, build_time, extract_time = benchmark(
+            args.local_dir, compression, level=args.level, threads=args.threads)
+        print('%-6s %12d %8.2f %10.2f %10.2f' % (
+            compression, size, raw_size / float(size), build_time, extract_time))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,10 @@
+"""
+Pretty-print an archive build report written by build_archive(report=...).
+
+Example:
+    python scripts/print_build_report.py report.json
+"""
+from doodad.darchive import report
+
+if __name__ == "__main__":
+    report.main()